@@ -1,11 +1,118 @@
-from .models import Database, ParserWrapper
+from .models import Database, AsyncDatabase, ParserWrapper, KeywordJobQueue, KeywordCache, DocxParsePool, RenderCache, \
+    SimilarityIndexCache, StructureCodec, TemplateCache, DatabaseRegistry, TenantDatabase, DEFAULT_TENANT, \
+    DATABASE_NAME, current_tenant, models, metrics, profiler
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
+# loads the models at import time, so that the processes forked later (for example, by `gunicorn --preload`
+# or by the worker pools) share them copy-on-write
+if os.environ.get('PRELOAD_MODELS', 'false').lower() == 'true':
+    models.preload()
+
 mongodb_connstring = os.environ['MONGODB_CONNSTRING']
 
-db = Database(mongodb_connstring)
+keyword_cache_options = {
+    'size': int(os.environ.get('KEYWORD_CACHE_SIZE', 1024)),
+    'ttl': int(os.environ.get('KEYWORD_CACHE_TTL', 3600)),
+    'persistent': os.environ.get('KEYWORD_CACHE_PERSISTENT', 'false').lower() == 'true',
+    'idf_tolerance': float(os.environ.get('KEYWORD_CACHE_IDF_TOLERANCE', 0.05))
+}
+
+mongodb_max_pool_size = int(os.environ.get('MONGODB_MAX_POOL_SIZE', 100))
+
+mongodb_client_options = {
+    'maxPoolSize': mongodb_max_pool_size,
+    'minPoolSize': int(os.environ.get('MONGODB_MIN_POOL_SIZE', 0)),
+    'serverSelectionTimeoutMS': int(os.environ.get('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 30000)),
+    'connectTimeoutMS': int(os.environ.get('MONGODB_CONNECT_TIMEOUT_MS', 20000)),
+    'waitQueueTimeoutMS': int(os.environ.get('MONGODB_WAIT_QUEUE_TIMEOUT_MS', 10000)),
+}
+mongodb_socket_timeout = os.environ.get('MONGODB_SOCKET_TIMEOUT_MS')
+if mongodb_socket_timeout:
+    mongodb_client_options['socketTimeoutMS'] = int(mongodb_socket_timeout)
+
+# durations of MongoDB commands are recorded as the `mongo` phase of the requests
+mongodb_client_options['event_listeners'] = [metrics.command_listener]
+
+metrics.server_timing = os.environ.get('SERVER_TIMING', 'false').lower() == 'true'
+
+similarity_index_options = {
+    'size': int(os.environ.get('SIMILARITY_INDEX_CACHE_SIZE', 4)),
+    'tolerance': float(os.environ.get('SIMILARITY_INDEX_TOLERANCE', 0.05))
+}
+
+template_cache_options = {
+    'size': int(os.environ.get('TEMPLATE_CACHE_SIZE', 64)),
+    'ttl': int(os.environ.get('TEMPLATE_CACHE_TTL', 60))
+}
+
+# format new document structures are stored in: `plain` or `compact` (see `python -m app.migrate`)
+structure_codec = StructureCodec(os.environ.get('STORAGE_FORMAT', 'plain').lower(),
+                                 int(os.environ.get('STORAGE_COMPRESSION_LEVEL', 6)))
+
+
+def create_database(database) -> Database:
+    # every tenant has its own caches, the clients are shared by the tenants on the same server
+    return Database(keyword_cache=KeywordCache(**keyword_cache_options), client_options=mongodb_client_options,
+                    similarity_indexes=SimilarityIndexCache(**similarity_index_options), codec=structure_codec,
+                    database=database, template_cache=TemplateCache(**template_cache_options))
+
+
+databases = DatabaseRegistry(create_database, mongodb_client_options)
+
+databases.register(DEFAULT_TENANT, mongodb_connstring, database_name=DATABASE_NAME)
+
+# additional tenants: whitespace-separated `name=uri` pairs, the database is taken from the URI path
+for tenant in os.environ.get('MONGODB_TENANTS', '').split():
+    tenant_name, _, tenant_uri = tenant.partition('=')
+    databases.register(tenant_name, tenant_uri)
+
+# the database of the tenant of the current request
+db = TenantDatabase(databases)
+
+async_db = AsyncDatabase(db, mongodb_max_pool_size)
+
+# options of the worker run by `python -m app.worker`
+derived_data_options = {
+    'batch_size': int(os.environ.get('DERIVED_DATA_BATCH_SIZE', 100)),
+    'max_wait': float(os.environ.get('DERIVED_DATA_MAX_WAIT', 1.0)),
+    'workers': int(os.environ.get('DERIVED_DATA_WORKERS', 4))
+}
 
 parser = ParserWrapper()
+
+render_cache = RenderCache(int(os.environ.get('RENDER_CACHE_SIZE', 64 * 1024 * 1024)))
+
+max_upload_size = int(os.environ.get('MAX_UPLOAD_SIZE', 20 * 1024 * 1024))
+
+# responses smaller than the minimal size are not compressed, compression is disabled if the level is 0
+compression_minimum_size = int(os.environ.get('COMPRESSION_MINIMUM_SIZE', 1024))
+compression_level = int(os.environ.get('COMPRESSION_LEVEL', 6))
+
+# token of the administrative operations (profiling, connections, tenants and clearing caches),
+# they are disabled if it is not set
+admin_token = os.environ.get('ADMIN_TOKEN') or None
+
+# every worker process of the keyword jobs and of the parsing loads its own models (hundreds of megabytes)
+# unless they are preloaded (PRELOAD_MODELS), so both pools are small by default instead of a process per processor
+# each; with the models preloaded the workers share them copy-on-write and the pools can be made larger
+default_pool_workers = min(2, os.cpu_count() or 1)
+
+keyword_job_workers = int(os.environ.get('KEYWORD_JOB_WORKERS') or default_pool_workers)
+
+# the keywords are saved to the database of the tenant that submitted the job
+jobs = KeywordJobQueue(lambda document_id, keywords: db.update_document_keywords(document_id, keywords),
+                       keyword_job_workers, scope=current_tenant)
+
+parse_workers = int(os.environ.get('PARSE_WORKERS') or default_pool_workers)
+
+parse_timeout = os.environ.get('PARSE_TIMEOUT')
+
+parse_pool = DocxParsePool(
+    parse_workers,
+    max_pending=int(os.environ.get('PARSE_MAX_PENDING', parse_workers * 4)),
+    timeout=float(parse_timeout) if parse_timeout else None,
+    parsers_size=int(os.environ.get('PARSE_TEMPLATES_CACHE_SIZE', 16))
+) if parse_workers > 0 else None
@@ -6,3 +6,28 @@ class FoundException(Exception):
 class ValidException(Exception):
     def __init__(self, name: str):
         self.name = name
+
+
+class StateException(Exception):
+    def __init__(self, name: str):
+        self.name = name
+
+
+class SizeException(Exception):
+    def __init__(self, name: str):
+        self.name = name
+
+
+class BusyException(Exception):
+    def __init__(self, name: str):
+        self.name = name
+
+
+class TimeoutException(Exception):
+    def __init__(self, name: str):
+        self.name = name
+
+
+class AccessException(Exception):
+    def __init__(self, name: str):
+        self.name = name
@@ -0,0 +1,100 @@
+import gzip
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies larger than this are compressed in a thread, so the event loop is not blocked
+THREAD_THRESHOLD = 256 * 1024
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses larger than `minimum_size` with brotli (if the `brotli` package is installed)
+    or gzip, the way the client accepts.
+
+    Only responses sent as a single body are compressed: streamed responses (NDJSON listings, batch parsing)
+    are passed as is, so their results keep arriving as soon as they are ready. The strong ETag of
+    a compressed response gets the suffix of the encoding, since the compressed bytes are another
+    representation (see :py:func:`strip_encoding`).
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, level: int = 6):
+        """
+        :param minimum_size: minimal size of the compressed bodies in bytes.
+        :param level: compression level of gzip (1-9), it is the quality of brotli as well.
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        encoding = self.__select_encoding(Headers(scope=scope).get('accept-encoding', '')) \
+            if scope['type'] == 'http' else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+
+        async def send_compressed(message: Message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            headers = MutableHeaders(raw=start['headers'])
+            if not message.get('more_body', False) and len(body) >= self.minimum_size \
+                    and 'content-encoding' not in headers:
+                if len(body) > THREAD_THRESHOLD:
+                    body = await run_in_threadpool(self.compress, body, encoding)
+                else:
+                    body = self.compress(body, encoding)
+                headers['Content-Encoding'] = encoding
+                headers['Content-Length'] = str(len(body))
+                headers.add_vary_header('Accept-Encoding')
+                etag = headers.get('etag')
+                if etag and etag.endswith('"') and not etag.startswith('W/'):
+                    headers['ETag'] = f'{etag[:-1]}-{encoding}"'
+                message = {**message, 'body': body}
+            initial, start = start, None
+            await send(initial)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=min(self.level, 11))
+        return gzip.compress(body, compresslevel=self.level)
+
+    @staticmethod
+    def __select_encoding(accept_encoding: str) -> Optional[str]:
+        accepted = set()
+        for item in accept_encoding.lower().split(','):
+            coding, _, parameters = item.partition(';')
+            if parameters.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(coding.strip())
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        return 'gzip' if 'gzip' in accepted else None
+
+
+def strip_encoding(etag: str) -> str:
+    """
+    Returns the ETag of the uncompressed representation of the one received in `If-None-Match`.
+    """
+    for encoding in ('gzip', 'br'):
+        if etag.endswith(f'-{encoding}"'):
+            return etag[:-len(encoding) - 2] + '"'
+    return etag
@@ -1,22 +1,47 @@
+import time
 from typing import Callable
 
 from fastapi import Request, Response, HTTPException
 from fastapi.routing import APIRoute
 
-from app.errors import ValidException, FoundException
+from app.errors import ValidException, FoundException, StateException, SizeException, \
+    BusyException, TimeoutException, AccessException
+from app.models.metrics import metrics
+from app.models.profiler import profiler
 
 
 class RouteErrorHandle(APIRoute):
     def get_route_handler(self) -> Callable:
         original_route_handler = super().get_route_handler()
+        route = self.path
 
         async def custom_route_handler(request: Request) -> Response:
+            # latency, status and phase timings of every request are recorded by the route template
+            with metrics.track_request(request.method, route) as tracked, profiler.track(route):
+                response = await handle_errors(request)
+                tracked.status = response.status_code
+                if metrics.server_timing:
+                    tracked.timings['total'] = time.perf_counter() - tracked.start
+                    response.headers['Server-Timing'] = metrics.format_server_timing(tracked.timings)
+                return response
+
+        async def handle_errors(request: Request) -> Response:
             try:
                 return await original_route_handler(request)
             except FoundException as ex:
                 raise HTTPException(status_code=404, detail=str(ex))
             except ValidException as ex:
                 raise HTTPException(status_code=422, detail=str(ex))
+            except StateException as ex:
+                raise HTTPException(status_code=409, detail=str(ex))
+            except SizeException as ex:
+                raise HTTPException(status_code=413, detail=str(ex))
+            except BusyException as ex:
+                raise HTTPException(status_code=503, detail=str(ex), headers={'Retry-After': '1'})
+            except TimeoutException as ex:
+                raise HTTPException(status_code=504, detail=str(ex))
+            except AccessException as ex:
+                raise HTTPException(status_code=403, detail=str(ex))
             except Exception as ex:
                 raise HTTPException(status_code=500, detail=str(ex))
 
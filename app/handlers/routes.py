@@ -1,149 +1,523 @@
-from fastapi import APIRouter, File, UploadFile, Form
-from fastapi.responses import FileResponse
-from typing import Optional, Dict
+from fastapi import APIRouter, Body, File, UploadFile, Form, Query, Header
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
+from pydantic import BaseModel
+import hashlib
+import hmac
+import io
+import orjson
+import os
+import zipfile
+from urllib.parse import quote
+from typing import Optional, Dict, List, AsyncIterator, Tuple, Iterable
 from app.schemas.schema import DocumentCreateStructure, \
-    Document, KeywordExtractionMode, TemplateCreateStructure, DocumentUpdate
-from app import db, parser
+    KeywordExtractionMode, TemplateCreateStructure, DocumentUpdate, JobStatus, \
+    KeywordGenerationBatch, SearchField, SearchResult, SimilarDocument, ProfileFormat
+from app import db, async_db, parser, jobs, parse_pool, max_upload_size, models, render_cache, metrics, profiler, \
+    admin_token, databases, current_tenant, DATABASE_NAME
+from app.models.templatecache import CompiledTemplate
+from .compression import strip_encoding
 from .error import RouteErrorHandle
-from app.errors import ValidException, FoundException
+from app.errors import ValidException, FoundException, StateException, BusyException, AccessException
 
-router = APIRouter(route_class=RouteErrorHandle)
+router = APIRouter(route_class=RouteErrorHandle, default_response_class=ORJSONResponse)
+
+DOCX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 
 
 @router.post('/api/documents', tags=['documents'])
-def create_document(data: DocumentCreateStructure):
-    created = db.create_document(data)
+async def create_document(data: DocumentCreateStructure):
+    created = await async_db.create_document(data)
     if not created:
         raise ValidException('input data is not valid')
     return 'OK'
 
 
 @router.get('/api/documents', tags=['documents'])
-def get_documents(short: bool = True):
-    if short:
-        return db.get_documents_short()
-    return db.get_documents()
+async def get_documents(short: bool = True, limit: Optional[int] = Query(None, gt=0), after: Optional[str] = None,
+                        fields: Optional[str] = None, stream: bool = False, name: Optional[str] = None,
+                        template_id: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    fields = _parse_fields(fields) or (['name'] if short else None)
+    # the same page is represented differently depending on the fields and the format, so they are a part of
+    # the version
+    version = _representation_version(await async_db.get_documents_version(limit, after, name, template_id),
+                                      short, ','.join(fields or ['*']), 'ndjson' if stream else 'json')
+    etag = _match_etag(if_none_match, version)
+    if etag:
+        return _not_modified_response(etag)
+    if stream:
+        return _ndjson_response(db.iter_documents(fields, limit, after, name, template_id), version)
+    return _versioned_response(await async_db.get_documents(fields, limit, after, name, template_id),
+                               if_none_match, version)
+
+
+@router.get('/api/documents/search', tags=['documents'], response_model=List[SearchResult])
+async def search_documents(query: str, section_name: Optional[str] = None, template_id: Optional[str] = None,
+                           field: SearchField = SearchField.all, limit: int = Query(10, gt=0, le=1000)):
+    fields = (SearchField.text.value, SearchField.keywords.value) if field == SearchField.all else (field.value,)
+    return await async_db.search_documents(query, section_name, template_id, fields, limit)
+
+
+@router.post('/api/documents/keywords/generation', tags=['documents'])
+def generation_documents_keywords(data: KeywordGenerationBatch):
+    if isinstance(data.documents, str) and data.documents != 'all':
+        raise ValidException('documents must be a list of ids or "all"')
+    document_ids = None if data.documents == 'all' else data.documents
+    documents = db.iter_documents_tf_idf_pairs(document_ids, data.sectionName,
+                                               with_structure=data.mode != KeywordExtractionMode.tf_idf)
+    return _ndjson_response(jobs.extract_many(documents, data.mode))
 
 
 @router.get('/api/documents/{document_id}', tags=['documents'])
-def get_document(document_id: str):
-    document = db.get_document(document_id)
+async def get_document(document_id: str, if_none_match: Optional[str] = Header(None)):
+    # the version is read without the structure, so unchanged documents are answered without reading it
+    version = await async_db.get_document_version(document_id)
+    etag = _match_etag(if_none_match, version)
+    if etag:
+        return _not_modified_response(etag)
+    document = await async_db.get_document(document_id)
     if not document:
         raise FoundException(f'document with _id={document_id} not found')
-    return document
+    return _versioned_response(document, if_none_match, version or None)
 
 
 @router.patch('/api/documents/{document_id}', tags=['documents'])
-def update_document(document_id: str, model: DocumentUpdate):
-    document = db.get_document(document_id)
-    if not document:
+async def update_document(document_id: str, model: DocumentUpdate):
+    if not await async_db.document_exists(document_id):
         raise FoundException(f'document with _id={document_id} not found')
     update_data = model.dict(exclude_unset=True)
     if "structure" in update_data:
-        return db.update_document_structure(document_id, update_data["structure"])
+        return await async_db.update_document_structure(document_id, update_data["structure"])
     if "keywords" in update_data:
-        return db.update_document_keywords(document_id, update_data["keywords"])
+        return await async_db.update_document_keywords(document_id, update_data["keywords"])
     raise ValidException('data is null')
 
 
 @router.delete('/api/documents/{document_id}', tags=['documents'])
-def delete_document(document_id: str):
-    document = db.get_document(document_id)
-    if not document:
+async def delete_document(document_id: str):
+    if not await async_db.document_exists(document_id):
         raise FoundException(f'document with _id={document_id} not found')
-    return db.delete_document(document_id)
+    return await async_db.delete_document(document_id)
 
 
 @router.get('/api/documents/{document_id}/keywords', tags=['documents'])
-def get_document_keywords(document_id: str):
-    document = db.get_document(document_id)
-    if not document:
+async def get_document_keywords(document_id: str, if_none_match: Optional[str] = Header(None)):
+    version = await async_db.get_document_version(document_id)
+    if version is None:
         raise FoundException(f'document with _id={document_id} not found')
-    return db.get_document_keywords(document_id)
+    etag = _match_etag(if_none_match, version)
+    if etag:
+        return _not_modified_response(etag)
+    return _versioned_response(await async_db.get_document_keywords(document_id), if_none_match, version or None)
 
 
 @router.get('/api/documents/{document_id}/keywords/generation', tags=['documents'])
 def generation_document_keywords(document_id: str, mode: KeywordExtractionMode, section_name: Optional[str] = None):
-    documents = db.get_mongo_documents()
-    document = Document(id='', name='', templateId='', structure=[])
-    for d in documents:
-        if str(d.get('_id')) == document_id:
-            document.id = str(d.get('_id'))
-            document.name = d.get('name')
-            document.templateId = d.get('templateId')
-            document.structure = [d.get('section_tree')]
-            break
-    if not document.id:
+    keywords = db.generate_document_keywords(document_id, mode, section_name)
+    if keywords is None:
+        raise FoundException(f'document with _id={document_id} not found')
+    return keywords
+
+
+@router.post('/api/documents/{document_id}/keywords/jobs', tags=['documents'])
+async def create_keywords_job(document_id: str, mode: KeywordExtractionMode, section_name: Optional[str] = None,
+                              save: bool = False):
+    job = jobs.find_in_flight(document_id, mode, section_name, save)
+    if job:
+        return job
+    # the section is found by the section index, the way the keywords of the section are generated at once
+    if section_name:
+        structure = await async_db.get_document_section_by_name(document_id, section_name)
+    else:
+        document = await async_db.get_document(document_id)
+        structure = document.structure[0] if document else None
+    if structure is None:
         raise FoundException(f'document with _id={document_id} not found')
-    if mode == KeywordExtractionMode.tf_idf:
-        return parser.extract_tf_idf_pairs(documents, document.name, section_name)
-    if mode == KeywordExtractionMode.pullenti:
-        return parser.extract_keywords(documents, document.name, section_name)
-    if mode == KeywordExtractionMode.combine:
-        return parser.extract_rationized_keywords(documents, document.name, section_name)
-    raise ValidException(f'keyword extraction mode {mode} is not valid')
+    tf_idf_pairs = None
+    if mode != KeywordExtractionMode.pullenti:
+        tf_idf_pairs = await async_db.get_document_tf_idf_pairs(document_id, section_name)
+    return jobs.submit(document_id, mode, structure, tf_idf_pairs, section_name, save)
+
+
+@router.get('/api/documents/{document_id}/similar', tags=['documents'], response_model=List[SimilarDocument])
+async def get_similar_documents(document_id: str, k: int = Query(10, gt=0, le=1000), section_name: Optional[str] = None,
+                                approximate: bool = False):
+    similar = await async_db.get_similar_documents(document_id, k, section_name, approximate)
+    if similar is None:
+        raise FoundException(f'document with _id={document_id} not found')
+    return similar
 
 
 @router.get('/api/documents/{document_id}/download', tags=['documents'])
-def download_document(document_id: str):
-    document = db.get_document(document_id)
+async def download_document(document_id: str):
+    document = await async_db.get_document(document_id)
     if not document:
         raise FoundException(f'document with _id={document_id} not found')
-    file_path = parser.save_document_as_docx(document.name, document.structure[0])
-    parser.clean_document(file_path)
-    return FileResponse(path=file_path, filename=file_path)
+    key = render_cache.make_key(document_id, document.structure[0])
+    content = render_cache.get(key)
+    if content is None:
+        content = await run_in_threadpool(parser.render_docx, document.structure[0])
+        render_cache.put(key, content)
+    return Response(content=content, media_type=DOCX_MEDIA_TYPE,
+                    headers={'Content-Disposition': f"attachment; filename*=utf-8''{quote(document.name)}.docx"})
 
 
 @router.get('/api/documents/{document_id}/sections', tags=['documents'])
-def get_sections(document_id: str):
-    document = db.get_document(document_id)
-    if not document:
+async def get_sections(document_id: str, details: bool = False):
+    sections = await async_db.get_section_index(document_id)
+    if sections is None:
         raise FoundException(f'document with _id={document_id} not found')
-    document_structure: Dict = document.structure[0]
-    return parser.get_section_names(document_structure)
+    if details:
+        return sections
+    return [section['name'] for section in sections]
+
+
+@router.get('/api/documents/{document_id}/sections/{path}', tags=['documents'])
+async def get_section(document_id: str, path: str):
+    section = await async_db.get_document_section(document_id, _parse_path(path))
+    if section is None:
+        raise FoundException(f'section {path} of document with _id={document_id} not found')
+    return section
+
+
+@router.patch('/api/documents/{document_id}/sections/{path}', tags=['documents'])
+async def update_section(document_id: str, path: str, section: Dict = Body(...)):
+    result = await async_db.update_document_section(document_id, _parse_path(path), section)
+    if result is None:
+        raise FoundException(f'section {path} of document with _id={document_id} not found')
+    return result
 
 
 @router.post('/api/templates', tags=['templates'])
-def create_template(data: TemplateCreateStructure):
-    created = db.create_template(data)
+async def create_template(data: TemplateCreateStructure):
+    created = await async_db.create_template(data)
     if not created:
         raise ValidException('input data is not valid')
     return 'OK'
 
 
 @router.get('/api/templates', tags=['templates'])
-def get_templates():
-    return db.get_templates_short()
+async def get_templates(limit: Optional[int] = Query(None, gt=0), after: Optional[str] = None,
+                        fields: Optional[str] = None, stream: bool = False):
+    fields = _parse_fields(fields) or ['name']
+    if stream:
+        return _ndjson_response(db.iter_templates(fields, limit, after))
+    return await async_db.get_templates(fields, limit, after)
 
 
 @router.get('/api/templates/{template_id}', tags=['templates'])
-def get_template(template_id: str):
-    template = db.get_template(template_id)
+async def get_template(template_id: str, if_none_match: Optional[str] = Header(None)):
+    template = await async_db.get_template(template_id)
     if not template:
         raise FoundException(f'template with _id={template_id} not found')
-    return template
+    # templates are not versioned, their ETags are the hashes of the content
+    return _versioned_response(template, if_none_match)
 
 
 @router.delete('/api/templates/{template_id}', tags=['templates'])
-def delete_template(template_id: str):
-    template = db.get_template(template_id)
+async def delete_template(template_id: str):
+    template = await async_db.get_template(template_id)
     if not template:
         raise FoundException(f'template with _id={template_id} not found')
-    return db.delete_template(template_id)
+    return await async_db.delete_template(template_id)
 
 
 @router.post('/api/files', tags=['other'])
 async def parse_file(file: UploadFile = File(...), template_id: str = Form(...)):
-    template = db.get_template(template_id)
+    template = await async_db.get_compiled_template(template_id)
     if not template:
         raise FoundException(f'template with _id={template_id} not found')
-    return await db.parse_docx_by_template(template, file)
+    if parse_pool:
+        return [await parse_pool.parse(template, file, max_upload_size)]
+    return await db.parse_docx_by_template(template, file, max_upload_size)
+
+
+@router.get('/api/jobs/{job_id}', tags=['other'])
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        raise FoundException(f'job with id={job_id} not found')
+    return job
+
+
+@router.get('/api/jobs/{job_id}/result', tags=['other'])
+def get_job_result(job_id: str):
+    found = jobs.get_result(job_id)
+    if not found:
+        raise FoundException(f'job with id={job_id} not found')
+    job, future = found
+    if job.status == JobStatus.failed:
+        raise Exception(job.error)
+    if job.status != JobStatus.done:
+        raise StateException(f'job with id={job_id} is {job.status.value}')
+    return future.result()
+
+
+@router.get('/api/cache/keywords', tags=['other'])
+def get_keyword_cache_statistics():
+    return db.keyword_cache.get_statistics()
+
+
+@router.delete('/api/cache/keywords', tags=['other'])
+def clear_keyword_cache(x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    db.keyword_cache.clear()
+    return 'OK'
+
+
+@router.get('/api/cache/templates', tags=['other'])
+def get_template_cache_statistics():
+    return db.template_cache.get_statistics()
+
+
+@router.delete('/api/cache/templates', tags=['other'])
+def clear_template_cache(x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    db.template_cache.clear()
+    return 'OK'
+
+
+@router.post('/api/files/batch', tags=['other'])
+async def parse_files(files: List[UploadFile] = File(None), archive: Optional[UploadFile] = File(None),
+                      template_id: str = Form(...), save: bool = Form(False)):
+    template = await async_db.get_compiled_template(template_id)
+    if not template:
+        raise FoundException(f'template with _id={template_id} not found')
+    if not files and not archive:
+        raise ValidException('no files uploaded')
+    if archive and not zipfile.is_zipfile(archive.file):
+        raise ValidException(f'{archive.filename} is not a zip archive')
+    return StreamingResponse(_parse_files(template, files or [], archive, save),
+                             media_type='application/x-ndjson')
+
+
+async def _read_files(files: List[UploadFile], archive: Optional[UploadFile]) -> AsyncIterator[Tuple[str, bytes]]:
+    # files that cannot be parsed are yielded with the content set to None
+    for file in files:
+        file.file.seek(0, os.SEEK_END)
+        if file.file.tell() > max_upload_size:
+            yield file.filename, None
+            continue
+        await file.seek(0)
+        yield file.filename, await file.read()
+    if archive:
+        with zipfile.ZipFile(archive.file) as zip_file:
+            for info in zip_file.infolist():
+                if info.is_dir() or not info.filename.lower().endswith('.docx'):
+                    continue
+                if info.file_size > max_upload_size:
+                    yield info.filename, None
+                    continue
+                # decompression does not block the event loop
+                yield info.filename, await run_in_threadpool(zip_file.read, info)
+
+
+async def _parse_files(template: CompiledTemplate, files: List[UploadFile], archive: Optional[UploadFile],
+                       save: bool, batch_size: int = 50) -> AsyncIterator[str]:
+    oversized = []
+
+    async def readable_files():
+        async for name, content in _read_files(files, archive):
+            if content is None:
+                oversized.append(name)
+            else:
+                yield name, content
+
+    async def parse() -> AsyncIterator[Tuple[str, Optional[dict], Optional[str]]]:
+        if parse_pool:
+            async for result in parse_pool.parse_many(template, readable_files()):
+                yield result
+        else:
+            async for name, content in readable_files():
+                try:
+                    yield name, await run_in_threadpool(parser.parse_docx, template.structure, io.BytesIO(content),
+                                                        template.get_plan(parser)), None
+                except Exception as ex:
+                    yield name, None, str(ex)
+        for name in oversized:
+            yield name, None, f'file size exceeds the limit of {max_upload_size} bytes'
+
+    parsed: List[Tuple[str, dict]] = []
+
+    async def flush() -> AsyncIterator[str]:
+        documents = [(os.path.splitext(os.path.basename(name))[0], structure) for name, structure in parsed]
+        ids = await async_db.create_documents(template.id, documents)
+        for (name, structure), document_id in zip(parsed, ids):
+            if document_id:
+                yield _ndjson_line({'name': name, 'id': document_id, 'structure': [structure]})
+            else:
+                yield _ndjson_line({'name': name, 'error': 'parsed structure is not valid', 'structure': [structure]})
+        parsed.clear()
+
+    async for name, structure, error in parse():
+        if error is not None:
+            yield _ndjson_line({'name': name, 'error': error})
+        elif save:
+            parsed.append((name, structure))
+            if len(parsed) >= batch_size:
+                async for result in flush():
+                    yield result
+        else:
+            yield _ndjson_line({'name': name, 'structure': [structure]})
+    if parsed:
+        async for result in flush():
+            yield result
+
+
+@router.get('/api/ready', tags=['other'])
+def get_readiness():
+    if not models.is_ready():
+        raise BusyException('models are loading')
+    return 'OK'
+
+
+@router.get('/metrics', tags=['other'])
+def get_metrics():
+    return Response(content=metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@router.get('/api/profile', tags=['other'])
+async def get_profile(seconds: Optional[float] = Query(None, gt=0, le=600), route: Optional[str] = None,
+                      requests: int = Query(1, gt=0), timeout: float = Query(60, gt=0, le=600),
+                      interval: float = Query(0.005, ge=0.001, le=1),
+                      format: ProfileFormat = ProfileFormat.collapsed, x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    if (seconds is None) == (route is None):
+        raise ValidException('either seconds or route must be set')
+    if route is not None and route not in {item.path for item in router.routes}:
+        raise FoundException(f'route {route} not found')
+    profile = await profiler.profile_async(seconds, route, requests, timeout, interval)
+    headers = {'X-Profile-Duration': f'{profile.duration:.3f}', 'X-Profile-Requests': str(profile.requests),
+               'X-Profile-Samples': str(sum(profile.samples.values()))}
+    if format == ProfileFormat.pstats:
+        headers['Content-Disposition'] = 'attachment; filename="profile.pstats"'
+        return Response(content=profile.to_pstats(), media_type='application/octet-stream', headers=headers)
+    content = profile.to_text() if format == ProfileFormat.text else profile.to_collapsed()
+    return Response(content=content, media_type='text/plain', headers=headers)
 
 
 @router.put('/api/db', tags=['other'])
-def change_connect_database(uri: str, dev_mode: bool = False):
+def change_connect_database(uri: str, dev_mode: bool = False, x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    # the connection of the current tenant is changed, requests of other tenants are not affected
+    try:
+        databases.register(current_tenant(), uri, dev_mode, DATABASE_NAME, verify=True)
+        return 'OK'
+    except Exception:
+        raise Exception('error connecting to database')
+
+
+@router.get('/api/tenants', tags=['other'], response_model=List[str])
+def get_tenants(x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    return databases.names()
+
+
+@router.put('/api/tenants/{name}', tags=['other'])
+def register_tenant(name: str, uri: str, dev_mode: bool = False, database: Optional[str] = None,
+                    x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
     try:
-        db.change_connect_database(uri, dev_mode)
+        databases.register(name, uri, dev_mode, database, verify=True)
         return 'OK'
+    except ValidException:
+        raise
     except Exception:
         raise Exception('error connecting to database')
+
+
+@router.delete('/api/tenants/{name}', tags=['other'])
+def remove_tenant(name: str, x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    databases.remove(name)
+    return 'OK'
+
+
+def _check_admin_token(x_admin_token: Optional[str]):
+    # administrative operations are disabled unless the token is configured
+    if admin_token is None:
+        raise AccessException('administrative operations are disabled')
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, admin_token):
+        raise AccessException('admin token is not valid')
+
+
+def _parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+def _parse_path(path: str) -> Tuple[int, ...]:
+    # the path is made of child indexes separated by dots ("0.2.1"), the root section is "root"
+    if path == 'root':
+        return ()
+    indexes = path.split('.')
+    if not all(index.isdecimal() for index in indexes):
+        raise ValidException(f'section path {path} is not valid')
+    return tuple(int(index) for index in indexes)
+
+
+def _ndjson_line(item: dict) -> bytes:
+    return _json_body(item) + b'\n'
+
+
+def _ndjson_response(items: Iterable[dict], version: Optional[str] = None) -> StreamingResponse:
+    headers = {'ETag': f'"{version}"'} if version else None
+    return StreamingResponse((_ndjson_line(item) for item in items), media_type='application/x-ndjson',
+                             headers=headers)
+
+
+def _encode_json(value):
+    # models are serialized by their fields without copying them, nested values are serialized by orjson
+    if isinstance(value, BaseModel):
+        return dict(value)
+    return jsonable_encoder(value)
+
+
+def _json_body(content) -> bytes:
+    return orjson.dumps(content, default=_encode_json, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _match_etag(if_none_match: Optional[str], version: Optional[str]) -> Optional[str]:
+    """
+    Returns the ETag of the version received in `If-None-Match` (weak comparison, the way If-None-Match is
+    evaluated) or None if the client does not have the version. The ETag keeps the suffix of the encoding,
+    so the 304 response carries the same ETag as the compressed 200 response (see :py:func:`strip_encoding`).
+    """
+    if not if_none_match or not version:
+        return None
+    if if_none_match.strip() == '*':
+        return f'"{version}"'
+    for etag in if_none_match.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if strip_encoding(etag) == f'"{version}"':
+            return etag
+    return None
+
+
+def _representation_version(version: Optional[str], *parameters) -> Optional[str]:
+    # versions of the data combined with the parameters of its representation
+    if not version:
+        return version
+    return hashlib.blake2b('\0'.join([version, *map(str, parameters)]).encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+
+def _not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag})
+
+
+def _versioned_response(content, if_none_match: Optional[str], version: Optional[str] = None) -> Response:
+    """
+    Returns the JSON response with the ETag of the version (or of the hash of the body if there is no version)
+    or 304 if the client has the same version.
+    """
+    body = _json_body(content)
+    version = version or hashlib.blake2b(body, digest_size=16).hexdigest()
+    etag = _match_etag(if_none_match, version)
+    if etag:
+        return _not_modified_response(etag)
+    return Response(content=body, media_type='application/json', headers={'ETag': f'"{version}"'})
@@ -0,0 +1,55 @@
+from typing import Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.models.databaseregistry import DatabaseRegistry, DEFAULT_TENANT, use_tenant
+
+
+class TenantMiddleware:
+    """
+    Selects the tenant of the request: from the `/tenants/{name}` prefix of the path (it is removed before
+    routing, so `/tenants/{name}/api/documents` is served by `/api/documents`) or from the `X-Tenant` header.
+    Requests without either work with the default tenant, requests to unknown tenants are answered with 404.
+
+    The tenant is kept in a context variable for the whole request, including the database calls made in
+    threads and the streamed responses.
+    """
+
+    def __init__(self, app: ASGIApp, registry: DatabaseRegistry, header: str = 'x-tenant',
+                 prefix: str = '/tenants/'):
+        self.app = app
+        self.registry = registry
+        self.header = header.lower().encode('latin-1')
+        self.prefix = prefix
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        name: Optional[str] = None
+        path: str = scope['path']
+        if path.startswith(self.prefix):
+            name, _, rest = path[len(self.prefix):].partition('/')
+            mount = self.prefix + name
+            scope = dict(scope, path='/' + rest, root_path=scope.get('root_path', '') + mount)
+            raw_path = scope.get('raw_path')
+            if raw_path is not None:
+                if raw_path.startswith(mount.encode('utf-8')):
+                    scope['raw_path'] = raw_path[len(mount):] or b'/'
+                else:
+                    del scope['raw_path']
+        else:
+            for key, value in scope.get('headers', []):
+                if key == self.header:
+                    name = value.decode('latin-1').strip()
+                    break
+        name = name or DEFAULT_TENANT
+
+        if name not in self.registry:
+            response = JSONResponse({'detail': f'tenant {name} not found'}, status_code=404)
+            await response(scope, receive, send)
+            return
+        with use_tenant(name):
+            await self.app(scope, receive, send)
@@ -1,6 +1,12 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from app import jobs, parse_pool, async_db, models, databases, compression_minimum_size, compression_level
+from app.models.databaseregistry import use_tenant
 from app.handlers import routes
+from app.handlers.compression import CompressionMiddleware
+from app.handlers.tenant import TenantMiddleware
 
 tags_metadata = [
     {
@@ -19,6 +25,12 @@ tags_metadata = [
 
 app = FastAPI(openapi_tags=tags_metadata)
 
+if compression_level > 0:
+    app.add_middleware(CompressionMiddleware, minimum_size=compression_minimum_size, level=compression_level)
+
+# CORS is added later, so it wraps the tenant selection and answers preflight requests of any tenant
+app.add_middleware(TenantMiddleware, registry=databases)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -28,3 +40,22 @@ app.add_middleware(
 )
 
 app.include_router(routes.router)
+
+
+@app.on_event('startup')
+async def startup():
+    for name in databases.names():
+        with use_tenant(name):
+            await async_db.ensure_indexes()
+    if not models.is_ready():
+        # the models are loaded in background, /api/ready reports when they are ready
+        asyncio.get_running_loop().run_in_executor(None, models.warm_up)
+
+
+@app.on_event('shutdown')
+def shutdown():
+    jobs.shutdown()
+    async_db.shutdown()
+    databases.close()
+    if parse_pool:
+        parse_pool.shutdown()
@@ -0,0 +1,36 @@
+"""
+Converts the structures of the stored documents into another storage format:
+
+    python -m app.migrate --format compact
+    python -m app.migrate --format plain --tenant <name>
+
+The database is the one of the tenant (MONGODB_CONNSTRING by default). Documents in both formats are read
+transparently, so the service can keep working during the migration; set STORAGE_FORMAT to the same format,
+so new documents are stored in it.
+"""
+import argparse
+import sys
+from typing import List, Optional
+
+from app import databases, structure_codec, DEFAULT_TENANT
+from app.models.structurecodec import StructureCodec, STRUCTURE_FIELDS
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Converts the stored document structures into another format.')
+    parser.add_argument('--format', choices=list(STRUCTURE_FIELDS), default=structure_codec.storage_format,
+                        help='target storage format (default: STORAGE_FORMAT)')
+    parser.add_argument('--compression-level', type=int, default=structure_codec.level,
+                        help='zlib compression level of the compact format (default: STORAGE_COMPRESSION_LEVEL)')
+    parser.add_argument('--batch-size', type=int, default=100, help='documents converted with a single write')
+    parser.add_argument('--tenant', default=DEFAULT_TENANT, help='tenant whose documents are converted')
+    args = parser.parse_args(argv)
+
+    db = databases.get(args.tenant)
+    converted = db.migrate_structures(StructureCodec(args.format, args.compression_level), args.batch_size)
+    print(f'{converted} documents converted to the {args.format} format', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
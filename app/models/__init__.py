@@ -1,2 +1,16 @@
+from .registry import ModelRegistry, models
+from .metrics import Metrics, metrics
+from .profiler import Profile, SamplingProfiler, profiler
 from .parserwrapper import ParserWrapper
-from .database import Database
+from .keywordcache import KeywordCache
+from .database import Database, DATABASE_NAME
+from .asyncdatabase import AsyncDatabase
+from .jobqueue import KeywordJobQueue
+from .parsepool import DocxParsePool
+from .rendercache import RenderCache
+from .similarityindex import SimilarityIndex, SimilarityIndexCache
+from .structurecodec import StructureCodec
+from .parseplan import ParsePlan
+from .templatecache import CompiledTemplate, TemplateCache
+from .derivedworker import DerivedDataWorker
+from .databaseregistry import DatabaseRegistry, TenantDatabase, DEFAULT_TENANT, current_tenant, use_tenant
@@ -0,0 +1,44 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
+from app.models.database import Database
+
+
+class AsyncDatabase:
+    """
+    Asynchronous interface of :py:class:`Database`.
+
+    Every method of the wrapped database is exposed as a coroutine that runs the blocking pymongo call in
+    a dedicated thread pool sized as the connection pool (the way motor does it), so routes neither block
+    the event loop nor occupy the threads of the FastAPI threadpool while waiting for MongoDB.
+    Attributes that are not methods are returned as is.
+    """
+
+    def __init__(self, database: Database, workers: int):
+        """
+        :param database: synchronous database.
+        :param workers: number of threads executing database calls (the size of the connection pool).
+        """
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mongodb')
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.database, name)
+        if not callable(attribute) or inspect.iscoroutinefunction(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # the context carries the timings of the current request
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, functools.partial(context.run, attribute, *args,
+                                                                               **kwargs))
+
+        return method
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
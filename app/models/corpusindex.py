@@ -0,0 +1,240 @@
+import math
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo.collection import Collection
+
+
+class CorpusIndex:
+    """
+    Persisted corpus statistics used to build TF-IDF models without rescanning the whole document collection.
+
+    For every document the index stores term vectors (term -> number of occurrences) of the whole structure and
+    of each of its sections. For every section (the empty name stands for the whole structure) it stores document
+    frequencies of the terms. The weighting matches the `ntc` SMART scheme used by :py:class:`LanguageProcessor`.
+
+    Every change of the corpus increments its revision, which is stored next to the whole structure frequencies.
+    """
+
+    # weights less than this value are discarded (as gensim does)
+    EPSILON = 1e-12
+
+    def __init__(self, vectors: Collection, frequencies: Collection):
+        """
+        :param vectors: collection with per-document (and per-section) term vectors.
+        :param frequencies: collection with per-section term document frequencies.
+        """
+        self.vectors = vectors
+        self.frequencies = frequencies
+
+    def add(self, document_id: str, sections: Dict[str, Counter]):
+        """
+        Adds term vectors of the document to the index and increments document frequencies of its terms.
+
+        :param document_id: string representation of the document object id.
+        :param sections: term vectors of the document sections (see :py:meth:`ParserWrapper.get_term_vectors`).
+        """
+        self.update(document_id, sections)
+
+    def add_many(self, documents: List[Tuple[str, Dict[str, Counter]]]):
+        """
+        Adds term vectors of several documents with a single insert and one frequency update per section.
+
+        :param documents: pairs of string representations of the document object ids and their term vectors.
+        """
+        if not documents:
+            return
+        self.vectors.insert_many([{'_id': ObjectId(document_id), 'sections': self.__encode_sections(sections)}
+                                  for document_id, sections in documents])
+        frequencies: Dict[str, Counter] = {}
+        for _, sections in documents:
+            for section_name, terms in sections.items():
+                frequencies.setdefault(section_name, Counter()).update(terms.keys())
+        for section_name, terms in frequencies.items():
+            increments = {f'frequencies.{term}': count for term, count in terms.items()}
+            self.frequencies.update_one({'_id': section_name}, {'$inc': increments}, upsert=True)
+        self.__inc_revision(len(documents))
+
+    def update(self, document_id: str, sections: Dict[str, Counter]):
+        """
+        Replaces term vectors of the document (or adds them if the document is not indexed). Only document
+        frequencies of the terms that appeared in or disappeared from a section are changed.
+
+        The vectors are swapped with a single atomic operation and the frequencies are changed by the difference
+        from the replaced vectors, so concurrent updates of a document apply consecutive differences
+        and do not drift the frequencies.
+        """
+        old_vector = self.vectors.find_one_and_replace({'_id': ObjectId(document_id)},
+                                                       {'sections': self.__encode_sections(sections)}, upsert=True)
+        old_sections = self.__decode_sections(old_vector) if old_vector is not None else {}
+        for section_name in set(old_sections) | set(sections):
+            old_terms = set(old_sections.get(section_name, {}))
+            new_terms = set(sections.get(section_name, {}))
+            self.__inc_frequencies(section_name, new_terms - old_terms, 1)
+            self.__inc_frequencies(section_name, old_terms - new_terms, -1)
+        self.__inc_revision()
+
+    def remove(self, document_id: str):
+        """
+        Removes the document from the index and decrements document frequencies of its terms.
+        """
+        old_vector = self.vectors.find_one_and_delete({'_id': ObjectId(document_id)})
+        if old_vector is None:
+            return
+
+        for section_name, terms in self.__decode_sections(old_vector).items():
+            self.__inc_frequencies(section_name, terms.keys(), -1)
+        self.__inc_revision()
+
+    def rebuild(self, documents: Iterable[Tuple[str, Dict[str, Counter]]]):
+        """
+        Drops the index and builds it again from scratch.
+
+        :param documents: pairs of string representations of the document object ids and their term vectors.
+        """
+        revision = self.revision()
+        self.vectors.delete_many({})
+        self.frequencies.delete_many({})
+
+        frequencies: Dict[str, Counter] = {}
+        for document_id, sections in documents:
+            self.vectors.insert_one({'_id': ObjectId(document_id), 'sections': self.__encode_sections(sections)})
+            for section_name, terms in sections.items():
+                frequencies.setdefault(section_name, Counter()).update(terms.keys())
+
+        for section_name, terms in frequencies.items():
+            self.frequencies.insert_one({'_id': section_name, 'frequencies': dict(terms)})
+        self.frequencies.update_one({'_id': ''}, {'$set': {'revision': revision + 1}}, upsert=True)
+
+    def count(self) -> int:
+        """
+        Returns the number of indexed documents.
+        """
+        return self.vectors.estimated_document_count()
+
+    def revision(self) -> int:
+        """
+        Returns the number of changes of the corpus.
+        """
+        statistics = self.frequencies.find_one({'_id': ''}, {'revision': 1})
+        return statistics.get('revision', 0) if statistics else 0
+
+    def get_sections(self, document_id: str) -> Optional[Dict[str, Dict[str, int]]]:
+        """
+        Returns term vectors of all document sections or None if the document is not indexed.
+        """
+        vector = self.vectors.find_one({'_id': ObjectId(document_id)})
+        if vector is None:
+            return None
+        return self.__decode_sections(vector)
+
+    def get_terms(self, document_id: str, section_name: str = '') -> Optional[Dict[str, int]]:
+        """
+        Returns the term vector of the document section or None if the document is not indexed.
+        A section that is missing in the document has an empty term vector.
+        """
+        vector = self.vectors.find_one({'_id': ObjectId(document_id)},
+                                       {'sections': {'$elemMatch': {'name': section_name}}})
+        if vector is None:
+            return None
+        sections = vector.get('sections', [])
+        return sections[0]['terms'] if sections else {}
+
+    def get_terms_many(self, document_ids: List[str], section_name: str = '') -> Dict[str, Dict[str, int]]:
+        """
+        Returns term vectors of the section for several documents with a single query.
+        Documents that are not indexed are missing in the result.
+        """
+        vectors = self.vectors.find({'_id': {'$in': [ObjectId(document_id) for document_id in document_ids]}},
+                                    {'sections': {'$elemMatch': {'name': section_name}}})
+        result = {}
+        for vector in vectors:
+            sections = vector.get('sections', [])
+            result[str(vector['_id'])] = sections[0]['terms'] if sections else {}
+        return result
+
+    def iter_terms(self, section_name: str = '') -> Iterator[Tuple[str, Dict[str, int]]]:
+        """
+        Iterates over term vectors of the section of all indexed documents.
+        A section that is missing in the document has an empty term vector.
+        """
+        for vector in self.vectors.find({}, {'sections': {'$elemMatch': {'name': section_name}}}):
+            sections = vector.get('sections', [])
+            yield str(vector['_id']), sections[0]['terms'] if sections else {}
+
+    def get_all_frequencies(self, section_name: str = '') -> Dict[str, int]:
+        """
+        Returns document frequencies of all the terms of the section.
+        """
+        statistics = self.frequencies.find_one({'_id': section_name}, {'frequencies': 1})
+        if statistics is None:
+            return {}
+        return statistics.get('frequencies', {})
+
+    def get_frequencies(self, terms: List[str], section_name: str = '') -> Dict[str, int]:
+        """
+        Returns document frequencies of the given terms only.
+        """
+        if not terms:
+            return {}
+        projection = {f'frequencies.{term}': 1 for term in terms}
+        statistics = self.frequencies.find_one({'_id': section_name}, projection)
+        if statistics is None:
+            return {}
+        return statistics.get('frequencies', {})
+
+    def get_tf_idf_pairs(self, document_id: str, section_name: str = '') -> Optional[List[List]]:
+        """
+        Returns TF-IDF pairs for the document section. Only the target document vector and the document
+        frequencies of its terms are read.
+
+        :param document_id: string representation of the document object id.
+        :param section_name: the name of a specific section of the structure.
+        :return: TF-IDF pair ([word: str, weight: float]) list or None if the document is not indexed.
+        """
+        terms = self.get_terms(document_id, section_name)
+        if terms is None:
+            return None
+        return self.weigh(terms, self.get_frequencies(list(terms), section_name), self.count())
+
+    @classmethod
+    def weigh(cls, terms: Dict[str, int], frequencies: Dict[str, int], documents_count: int) -> List[List]:
+        """
+        Calculates `ntc` TF-IDF weights: natural term frequency, inverse document frequency
+        (log2((N + 1) / df), as gensim defines it) and cosine normalization.
+
+        :param terms: term vector of the document.
+        :param frequencies: document frequencies of the terms.
+        :param documents_count: total number of documents in the corpus.
+        :return: TF-IDF pair ([word: str, weight: float]) list sorted by weight.
+        """
+        weights = []
+        for term, frequency in terms.items():
+            document_frequency = frequencies.get(term, 0)
+            if document_frequency <= 0:
+                continue
+            weight = frequency * math.log2((documents_count + 1) / document_frequency)
+            if abs(weight) > cls.EPSILON:
+                weights.append((term, weight))
+
+        norm = math.sqrt(sum(weight ** 2 for _, weight in weights))
+        weights.sort(key=lambda item: (-item[1], item[0]))
+        return [[term, round(weight / norm, 3)] for term, weight in weights]
+
+    def __inc_frequencies(self, section_name: str, terms, value: int):
+        increments = {f'frequencies.{term}': value for term in terms}
+        if increments:
+            self.frequencies.update_one({'_id': section_name}, {'$inc': increments}, upsert=True)
+
+    def __inc_revision(self, value: int = 1):
+        self.frequencies.update_one({'_id': ''}, {'$inc': {'revision': value}}, upsert=True)
+
+    @staticmethod
+    def __encode_sections(sections: Dict[str, Counter]) -> List[dict]:
+        # section names may contain dots and dollar signs, so they are not used as keys
+        return [{'name': name, 'terms': dict(terms)} for name, terms in sections.items()]
+
+    @staticmethod
+    def __decode_sections(vector: dict) -> Dict[str, Dict[str, int]]:
+        return {section['name']: section['terms'] for section in vector['sections']}
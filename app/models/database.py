@@ -1,15 +1,58 @@
+import hashlib
+
 import bson.errors
 from bson.objectid import ObjectId
 
-from pymongo import MongoClient, uri_parser, errors
+from pymongo import MongoClient, UpdateOne, uri_parser, errors, ASCENDING
+from pymongo.database import Database as MongoDatabase
 from fastapi import File, UploadFile
 
-from typing import List, Dict, Union
+from collections import Counter
+from itertools import islice
+from typing import List, Dict, Union, Optional, Iterator, Tuple, Set
+
+from app.schemas.schema import Document,\
+    DocumentCreateStructure, TemplateCreateStructure, Template, KeywordExtractionMode
+from app.models.parserwrapper import ParserWrapper, Path
+from app.models.corpusindex import CorpusIndex
+from app.models.keywordcache import KeywordCache
+from app.models.metrics import metrics
+from app.models.searchindex import SearchIndex, TEXT, KEYWORDS
+from app.models.similarityindex import SimilarityIndex, SimilarityIndexCache
+from app.models.templatecache import CompiledTemplate, TemplateCache
+from app.models.structurecodec import StructureCodec, STRUCTURE_FIELDS, COMPACT
+from app.errors import ValidException, StateException
+
+# database of the service on the MongoDB server
+DATABASE_NAME = 'documentsAnalysis'
+
+DOCUMENT_FIELDS = ('name', 'templateId', 'structure', 'keywords')
+TEMPLATE_FIELDS = ('name', 'structure')
+
+# projection of the document structure without section texts (deeper sections keep their texts);
+# compact trees are read with their texts, they are compressed and are rewritten as a whole
+SKELETON_DEPTH = 16
+SKELETON_PROJECTION = {'keywords': 0, **{'structure' + '.children' * depth + '.text': 0
+                                         for depth in range(SKELETON_DEPTH)}}
+
+# projection of the document structure stored in any format
+STRUCTURE_PROJECTION = {field: 1 for field in STRUCTURE_FIELDS.values()}
 
-from app.schemas.schema import Entity, Document,\
-    DocumentCreateStructure, TemplateCreateStructure, Template
-from app.models.parserwrapper import ParserWrapper
-from app.errors import ValidException
+# field set to a new value by every write that updates the derived data of the document (the section index,
+# the corpus and search indexes, cached keywords) by itself, so the change stream worker skips such writes;
+# the worker sets it as well when it refreshes documents changed bypassing the API, so it also versions the documents
+INDEX_REVISION = 'indexRevision'
+
+# projection of the fields the version of the document is made of (see :py:meth:`Database.get_document_version`)
+VERSION_PROJECTION = {'name': 1, 'templateId': 1, INDEX_REVISION: 1}
+
+# number of times a section update is retried when the document is changed concurrently
+SECTION_UPDATE_ATTEMPTS = 5
+
+# parts of the documents whose derived data is refreshed (see :py:meth:`Database.refresh_documents`)
+TEXT_CHANGED = 'text'
+KEYWORDS_CHANGED = 'keywords'
+TEMPLATE_CHANGED = 'template'
 
 
 class Database:
@@ -17,31 +60,77 @@ class Database:
     A class for working with MongoDB database collections.
     """
 
-    def __init__(self, uri: str, dev_mode: bool = False):
-        self.documents, self.templates = self.__connect_database(uri, dev_mode)
+    def __init__(self, uri: Optional[str] = None, dev_mode: bool = False, keyword_cache: Optional[KeywordCache] = None,
+                 client_options: Optional[Dict] = None, similarity_indexes: Optional[SimilarityIndexCache] = None,
+                 codec: Optional[StructureCodec] = None, database: Optional[MongoDatabase] = None,
+                 template_cache: Optional[TemplateCache] = None):
+        """
+        :param uri: URI to connect to the database
+        :param dev_mode: parameter turns on a develop mode
+        :param keyword_cache: cache of keyword extraction results
+        :param client_options: connection pool and timeout options of :py:class:`MongoClient`
+            (for example, maxPoolSize, serverSelectionTimeoutMS, socketTimeoutMS)
+        :param similarity_indexes: cache of the indexes used to find similar documents
+        :param codec: storage format of the document structures (plain by default)
+        :param database: database of a client owned by the caller, used instead of connecting to `uri`
+        :param template_cache: cache of the compiled section templates
+        """
         self.parser = ParserWrapper()
+        self.keyword_cache = keyword_cache or KeywordCache()
+        self.template_cache = template_cache or TemplateCache()
+        self.similarity_indexes = similarity_indexes or SimilarityIndexCache()
+        self.codec = codec or StructureCodec()
+        self.client_options = client_options or {}
+        # the client created by this class is closed when the connection is changed
+        self.client: Optional[MongoClient] = None
+        if database is None:
+            self.client = self.create_client(uri, dev_mode, self.client_options)
+            database = self.client[DATABASE_NAME]
+        self.__bind(database)
+
+    def __bind(self, database: MongoDatabase):
+        self.documents = database['requirementsSpecifications']
+        self.templates = database['sectionTreeTemplates']
+        self.change_stream_tokens = database['changeStreamTokens']
+        self.corpus_index = CorpusIndex(database['corpusTermVectors'], database['corpusTermFrequencies'])
+        self.corpus_index_checked = False
+        self.search_index = SearchIndex(database['searchPostings'], database['searchDocuments'],
+                                        database['searchStatistics'])
+        self.search_index_checked = False
+        self.keyword_cache.bind(database['keywordCache'])
+        self.similarity_indexes.clear()
+        self.template_cache.clear()
 
     @staticmethod
-    def __connect_database(uri, dev_mode: bool = False) -> Union[tuple, ValidException]:
+    def create_client(uri, dev_mode: bool = False, client_options: Optional[Dict] = None) -> MongoClient:
         """
-        Returns a tuple that contains collections with documents and templates
+        Returns the client connected to the server with the database that contains collections with documents
+        and templates
 
         :param uri: URI to connect to the database
         :param dev_mode: parameter turns on a develop mode
+        :param client_options: connection pool and timeout options of :py:class:`MongoClient`
         """
         try:
             uri_parser.parse_uri(uri)
         except errors.InvalidURI as ex:
             raise ValidException(str(ex))
 
+        client_options = client_options or {}
         if dev_mode:
-            client = MongoClient(uri, tls=True, tlsAllowInvalidCertificates=True)
-        else:
-            client = MongoClient(uri)
-        database = client['documentsAnalysis']
-        documents = database['requirementsSpecifications']
-        templates = database['sectionTreeTemplates']
-        return documents, templates
+            return MongoClient(uri, tls=True, tlsAllowInvalidCertificates=True, **client_options)
+        return MongoClient(uri, **client_options)
+
+    def ensure_indexes(self):
+        """
+        Creates the indexes used by the service (existing indexes are left as is).
+        Compound indexes with `_id` also serve paginated listings filtered by the first field.
+        """
+        self.documents.create_index([('templateId', ASCENDING), ('_id', ASCENDING)])
+        self.documents.create_index([('name', ASCENDING), ('_id', ASCENDING)])
+        self.documents.create_index([('sections.name', ASCENDING)])
+        self.templates.create_index([('name', ASCENDING)])
+        self.search_index.ensure_indexes()
 
     def change_connect_database(self, uri, dev_mode: bool = False):
         """
@@ -50,32 +139,48 @@ class Database:
         :param uri: URI to connect to the database
         :param dev_mode: parameter turns on a develop mode
         """
-        self.documents, self.templates = self.__connect_database(uri, dev_mode)
-
-    def get_documents_short(self) -> Dict[str, List[Entity]]:
+        client, old_client = self.create_client(uri, dev_mode, self.client_options), self.client
+        self.__bind(client[DATABASE_NAME])
+        self.client = client
+        # the pool of the previous connection is not leaked
+        if old_client is not None:
+            old_client.close()
+        self.ensure_indexes()
+
+    def get_documents_short(self, limit: Optional[int] = None, after: Optional[str] = None) -> Dict[str, List]:
         """
-        Returns short information about all documents in the database (ids and names).
+        Returns short information about documents in the database (ids and names).
 
-        :return: dictionary containing :py:class:`DocumentShort` elements.
+        :param limit: maximal number of documents in the page.
+        :param after: continuation token (the id of the last document of the previous page).
+        :return: dictionary containing document ids and names.
         """
-        return self.__get_entities(self.documents)
+        return self.get_documents(['name'], limit, after)
 
-    def get_documents(self) -> Dict[str, List[Document]]:
+    def get_documents(self, fields: Optional[List[str]] = None, limit: Optional[int] = None,
+                      after: Optional[str] = None, name: Optional[str] = None,
+                      template_id: Optional[str] = None) -> Dict[str, List]:
+        """
+        Returns information about documents in the database (ids, names, template ids, structures and keywords).
+
+        :param fields: fields of the documents to be returned (all fields by default).
+        :param limit: maximal number of documents in the page.
+        :param after: continuation token (the id of the last document of the previous page).
+        :param name: return only documents with this name.
+        :param template_id: return only documents created according to this template.
+        :return: dictionary containing the page of documents and the continuation token (if `limit` is set).
         """
-        Returns information about all documents in the database (ids, names and structures).
+        return self.__get_page(self.iter_documents(fields, limit, after, name, template_id), limit)
 
-        :return: a list of :py:class:`Document` elements.
+    def iter_documents(self, fields: Optional[List[str]] = None, limit: Optional[int] = None,
+                       after: Optional[str] = None, name: Optional[str] = None,
+                       template_id: Optional[str] = None) -> Iterator[Dict]:
         """
-        documents: List[Document] = []
-        for document in self.documents.find({}):
-            documents.append(Document(
-                id=str(document.get('_id')),
-                name=document.get('name'),
-                templateId=document.get('templateId'),
-                structure=[document.get('structure')],
-                keywords=[document.get('keywords')]
-            ))
-        return {'data': documents}
+        Iterates over documents in the order of their ids reading only the requested fields.
+        Documents can be filtered by the name and by the template id (both fields are indexed).
+        """
+        return self.__iter_entities(self.documents, fields or list(DOCUMENT_FIELDS), DOCUMENT_FIELDS, limit, after,
+                                    self.__get_documents_query(name, template_id))
 
     def get_document(self, document_id: str) -> Union[Document, None]:
         """
@@ -86,17 +191,59 @@ class Database:
         except bson.errors.InvalidId:
             return None
 
-        document = self.documents.find_one({'_id': object_id})
+        document = self.documents.find_one({'_id': object_id}, {'name': 1, 'templateId': 1, 'keywords': 1,
+                                                                **STRUCTURE_PROJECTION})
         if document:
-            return Document(
+            # stored documents have been validated when they were written
+            return Document.construct(
                 id=str(document.get('_id')),
                 name=document.get('name'),
                 templateId=document.get('templateId'),
-                structure=[document.get('structure')],
+                structure=[self.codec.decode(document)],
                 keywords=[document.get('keywords')]
             )
         return None
 
+    def document_exists(self, document_id: str) -> bool:
+        """
+        Checks whether the document exists reading only its id.
+        """
+        try:
+            object_id = ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return False
+        return self.documents.find_one({'_id': object_id}, {'_id': 1}) is not None
+
+    def get_document_version(self, document_id: str) -> Optional[str]:
+        """
+        Returns the version of the document reading neither its structure nor its keywords: the version changes
+        whenever the document is changed. Returns None if the document does not exist and an empty string if
+        the document has no version (it was written bypassing the API and has not been refreshed yet).
+        """
+        try:
+            object_id = ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+        document = self.documents.find_one({'_id': object_id}, VERSION_PROJECTION)
+        if document is None:
+            return None
+        return self.__get_version(document) or ''
+
+    def get_documents_version(self, limit: Optional[int] = None, after: Optional[str] = None,
+                              name: Optional[str] = None, template_id: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the version of the page of documents (see :py:meth:`get_documents`) reading only the fields
+        the versions of the documents are made of, or None if some document of the page has no version.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for document in self.__find_page(self.documents, self.__get_documents_query(name, template_id),
+                                         VERSION_PROJECTION, limit, after):
+            version = self.__get_version(document)
+            if version is None:
+                return None
+            digest.update(version.encode('ascii'))
+        return digest.hexdigest()
+
     def get_mongo_documents(self) -> List[dict]:
         """
         Returns a list of objects stored in the resulting collection.
@@ -113,14 +260,146 @@ class Database:
         """
         # we do not check the id for valid, since we first call the receiving method, which has a check
         document = {'_id': ObjectId(document_id)}
-        new_data = {'$set': {'structure': structure[0]}}
+        fields = self.codec.encode(structure[0])
+        new_data = {'$set': {**fields, 'sections': self.parser.get_section_index(structure[0]),
+                             INDEX_REVISION: ObjectId()},
+                    '$unset': self.codec.get_unset_fields(fields)}
         self.documents.update_one(document, new_data)
+        sections = self.parser.get_term_vectors(structure[0])
+        self.corpus_index.update(document_id, sections)
+        self.search_index.update_text(document_id, sections)
+        self.keyword_cache.invalidate_document(document_id)
         return 'OK'
 
+    def get_document_section(self, document_id: str, path: Path) -> Optional[Dict]:
+        """
+        Returns the section of the document by its path. Only the section subtree is read from the database.
+
+        :param document_id: string representation of the document object id.
+        :param path: indexes of the children on the way from the root of the structure to the section.
+        :return: the section subtree or None if the document or the section does not exist.
+        """
+        try:
+            object_id = ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+        return self.__get_section(object_id, path)
+
+    def update_document_section(self, document_id: str, path: Path, section: Dict) -> Union[str, None]:
+        """
+        Replaces the section of the document by its path. Only the new section is validated and written
+        to the database; term vectors of the corpus index are updated tokenizing only the old and the new section.
+
+        :param document_id: string representation of the document object id.
+        :param path: indexes of the children on the way from the root of the structure to the section.
+        :param section: new section subtree.
+        :return: status or None if the document or the section does not exist.
+        """
+        if not self.parser.is_valid(section):
+            raise ValidException('section structure is not valid')
+        if not path:
+            return self.update_document_structure(document_id, [section]) if self.document_exists(document_id) else None
+
+        try:
+            object_id = ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+        # the document is written only if it has not been changed since it was read (every write changes
+        # its revision), otherwise it is read again, so concurrent updates of its sections are not lost
+        for _ in range(SECTION_UPDATE_ATTEMPTS):
+            document = self.documents.find_one({'_id': object_id}, SKELETON_PROJECTION)
+            skeleton = self.codec.decode(document) if document is not None else None
+            if skeleton is None or self.parser.get_section(skeleton, path) is None:
+                return None
+
+            query = {'_id': object_id, INDEX_REVISION: document.get(INDEX_REVISION)}
+            compact = STRUCTURE_FIELDS[COMPACT] in document
+            if compact:
+                # the compact tree is rewritten as a whole (in the current storage format)
+                structure = self.codec.decode(document)
+                old_section = self.parser.get_section(structure, path)
+                self.parser.get_section(structure, path[:-1])['children'][path[-1]] = section
+                new_data = self.codec.encode(structure)
+                update = {'$set': new_data, '$unset': self.codec.get_unset_fields(new_data)}
+            else:
+                old_section = self.__get_section(object_id, path)
+                field = self.__get_section_field(path)
+                new_data = {field: section}
+                query[field] = {'$exists': True}
+                update = {'$set': new_data}
+            if 'sections' in document:
+                new_data['sections'] = self.parser.update_section_index(document['sections'], path, section)
+            new_data[INDEX_REVISION] = ObjectId()
+            if self.documents.update_one(query, update).matched_count:
+                break
+        else:
+            raise StateException(f'document with _id={document_id} is being changed concurrently, try again later')
+
+        sections = self.corpus_index.get_sections(document_id)
+        if sections is None or 'sections' not in document:
+            # the document was created before the indexes appeared, so they are built from the whole structure
+            structure = self.__get_structure(object_id)
+            self.documents.update_one({'_id': object_id},
+                                      {'$set': {'sections': self.parser.get_section_index(structure)}})
+            vectors = self.parser.get_term_vectors(structure)
+        else:
+            def get_vector(section_path: Path) -> Counter:
+                if compact:
+                    new_section = self.parser.get_section(structure, section_path)
+                else:
+                    new_section = self.__get_section(object_id, section_path)
+                return self.parser.get_section_vectors(new_section, section_path)[section_path]
+
+            vectors = self.parser.update_term_vectors(sections, skeleton, path, old_section, section, get_vector)
+        self.corpus_index.update(document_id, vectors)
+        self.search_index.update_text(document_id, vectors)
+        self.keyword_cache.invalidate_document(document_id)
+        return 'OK'
+
+    def get_section_index(self, document_id: str) -> Union[List[Dict], None]:
+        """
+        Returns the section index of the document (see :py:meth:`ParserWrapper.get_section_index`) stored next
+        to its structure. The index of a document created before the indexes appeared is built and stored.
+
+        :param document_id: string representation of the document object id.
+        :return: list of the section index entries or None if the document does not exist.
+        """
+        try:
+            object_id = ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+
+        document = self.documents.find_one({'_id': object_id}, {'sections': 1})
+        if document is None:
+            return None
+        if 'sections' not in document:
+            document['sections'] = self.parser.get_section_index(self.__get_structure(object_id))
+            self.documents.update_one({'_id': object_id}, {'$set': {'sections': document['sections']}})
+        return document['sections']
+
+    def get_document_section_by_name(self, document_id: str, section_name: str) -> Union[Dict, None]:
+        """
+        Returns the first section with the name (in the pre-order, as :py:meth:`ParserWrapper.get_term_vectors`
+        does). The section is found by the section index and only its subtree is read from the database.
+
+        :param document_id: string representation of the document object id.
+        :param section_name: the name of the section.
+        :return: the section subtree, an empty section if the document has no section with the name
+            or None if the document does not exist.
+        """
+        index = self.get_section_index(document_id)
+        if index is None:
+            return None
+        path = self.parser.find_section_path(index, section_name)
+        if path is None:
+            return {'name': section_name, 'text': ''}
+        return self.__get_section(ObjectId(document_id), path)
+
     def update_document_keywords(self, document_id: str, keywords: List):
         document = {'_id': ObjectId(document_id)}
-        new_keywords = {'$set': {'keywords': keywords}}
+        new_keywords = {'$set': {'keywords': keywords, INDEX_REVISION: ObjectId()}}
         self.documents.update_one(document, new_keywords)
+        self.search_index.update_keywords(document_id, self.parser.get_keyword_vector(keywords))
         return 'OK'
 
     def get_document_keywords(self, document_id: str) -> Union[List, None]:
@@ -129,7 +408,7 @@ class Database:
         except bson.errors.InvalidId:
             return None
 
-        document = self.documents.find_one({'_id': ObjectId(document_id)})
+        document = self.documents.find_one({'_id': ObjectId(document_id)}, {'keywords': 1})
         if document:
             return document.get("keywords")
         return None
@@ -141,23 +420,50 @@ class Database:
         :param data: class containing information about the document (name and structure).
         :return: returns True if the document was created successfully. Otherwise returns False.
         """
-        try:
-            template_id = ObjectId(data.templateId)
-        except bson.errors.InvalidId:
-            return False
-
-        is_template_valid = self.templates.find_one({'_id': template_id})
-        if not is_template_valid:
+        if self.get_compiled_template(data.templateId) is None:
             return False
 
         is_structure_valid = self.parser.is_valid(data.structure[0])
         if not is_structure_valid:
             return False
 
-        self.documents.insert_one({'name': data.name, 'templateId': data.templateId,
-                                   'structure': data.structure[0], 'keywords': []})
+        result = self.documents.insert_one({'name': data.name, 'templateId': data.templateId,
+                                            **self.codec.encode(data.structure[0]), 'keywords': [],
+                                            'sections': self.parser.get_section_index(data.structure[0]),
+                                            INDEX_REVISION: ObjectId()})
+        sections = self.parser.get_term_vectors(data.structure[0])
+        self.corpus_index.add(str(result.inserted_id), sections)
+        self.search_index.add(str(result.inserted_id), data.templateId, sections, Counter())
         return True
 
+    def create_documents(self, template_id: str, documents: List[Tuple[str, Dict]]) -> List[Union[str, None]]:
+        """
+        Adds several documents created according to the same template with a single insert.
+        The template is supposed to be checked by the caller.
+
+        :param template_id: string representation of the template object id.
+        :param documents: pairs of document names and structures.
+        :return: string representations of the created document object ids (None for invalid structures).
+        """
+        flags = [self.parser.is_valid(structure) for _, structure in documents]
+        valid = [document for document, flag in zip(documents, flags) if flag]
+        if not valid:
+            return [None] * len(documents)
+
+        result = self.documents.insert_many([{'name': name, 'templateId': template_id,
+                                              **self.codec.encode(structure), 'keywords': [],
+                                              'sections': self.parser.get_section_index(structure),
+                                              INDEX_REVISION: ObjectId()}
+                                             for name, structure in valid])
+        inserted_ids = [str(inserted_id) for inserted_id in result.inserted_ids]
+        vectors = [self.parser.get_term_vectors(structure) for _, structure in valid]
+        self.corpus_index.add_many(list(zip(inserted_ids, vectors)))
+        self.search_index.add_many([(document_id, template_id, sections, Counter())
+                                    for document_id, sections in zip(inserted_ids, vectors)])
+
+        ids = iter(inserted_ids)
+        return [next(ids) if flag else None for flag in flags]
+
     def delete_document(self, document_id: str) -> Union[str, None]:
         try:
             object_id = ObjectId(document_id)
@@ -165,13 +471,357 @@ class Database:
             return None
 
         self.documents.delete_one({'_id':  object_id})
+        self.corpus_index.remove(document_id)
+        self.search_index.remove(document_id)
+        self.keyword_cache.invalidate_document(document_id)
         return 'OK'
 
-    def get_templates_short(self) -> Dict[str, List[Entity]]:
+    def get_document_tf_idf_pairs(self, document_id: str, section_name: Optional[str] = None) -> Union[List, None]:
+        """
+        Returns TF-IDF pairs for the document (section) using the corpus statistics index, so only the target
+        document is processed.
+
+        :param document_id: string representation of the document object id.
+        :param section_name: the name of a specific section of the structure.
+        :return: TF-IDF pair list or None if the document does not exist.
+        """
+        try:
+            ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+
+        self.ensure_corpus_index()
+        return self.corpus_index.get_tf_idf_pairs(document_id, section_name or '')
+
+    def generate_document_keywords(self, document_id: str, mode: KeywordExtractionMode,
+                                   section_name: Optional[str] = None) -> Union[List, None]:
         """
-        Returns all structures templates for recognizing text documents.
+        Extracts keywords from the document (section) in the given mode. Results are taken from
+        the keyword cache when the section content has already been processed.
+
+        :param document_id: string representation of the document object id.
+        :param mode: keyword extraction mode.
+        :param section_name: the name of a specific section of the structure.
+        :return: keyword (or TF-IDF pair) list or None if the document does not exist.
         """
-        return self.__get_entities(self.templates)
+        try:
+            object_id = ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+
+        if section_name:
+            structure = self.get_document_section_by_name(document_id, section_name)
+        else:
+            structure = self.__get_structure(object_id)
+        if structure is None:
+            return None
+
+        key = self.keyword_cache.make_key(self.parser.get_content(structure), mode, section_name)
+        revision, documents_count = 0, 0
+        if self.keyword_cache.depends_on_corpus(mode):
+            self.ensure_corpus_index()
+            revision, documents_count = self.corpus_index.revision(), self.corpus_index.count()
+        keywords = self.keyword_cache.get(key, revision, documents_count)
+        if keywords is not None:
+            return keywords
+
+        with metrics.timer(f'keywords_{mode.value}'):
+            if mode == KeywordExtractionMode.tf_idf:
+                keywords = self.get_document_tf_idf_pairs(document_id, section_name)
+            elif mode == KeywordExtractionMode.pullenti:
+                keywords = self.parser.extract_keywords(structure)
+            else:
+                tf_idf_pairs = self.get_document_tf_idf_pairs(document_id, section_name)
+                keywords = self.parser.extract_rationized_keywords(structure, tf_idf_pairs)
+        self.keyword_cache.put(key, document_id, mode, keywords, revision)
+        return keywords
+
+    def iter_documents_tf_idf_pairs(self, document_ids: Optional[List[str]] = None,
+                                    section_name: Optional[str] = None, with_structure: bool = True,
+                                    batch_size: int = 100) -> Iterator[Tuple[str, Optional[Dict], Optional[List]]]:
+        """
+        Iterates over the documents and their TF-IDF pairs in one pass over the corpus: document frequencies
+        are loaded once, documents and their term vectors are read in batches.
+
+        :param document_ids: string representations of the document object ids (all documents if None).
+        :param section_name: the name of a specific section of the structure.
+        :param with_structure: whether to read the document structures.
+        :param batch_size: number of documents read with a single query.
+        :return: iterator of triples (document id, structure, TF-IDF pairs), the structure is the subtree
+            of the section if `section_name` is set (see :py:meth:`get_document_section_by_name`), the structure
+            and the pairs of the documents that do not exist are None.
+        """
+        self.ensure_corpus_index()
+        section_name = section_name or ''
+        frequencies = self.corpus_index.get_all_frequencies(section_name)
+        documents_count = self.corpus_index.count()
+        projection = {**STRUCTURE_PROJECTION, 'sections': 1} if with_structure else {'_id': 1}
+
+        if document_ids is None:
+            cursor = self.documents.find({}, projection)
+            batches = iter(lambda: list(islice(cursor, batch_size)), [])
+        else:
+            batches = (document_ids[i:i + batch_size] for i in range(0, len(document_ids), batch_size))
+
+        for batch in batches:
+            if document_ids is None:
+                documents = {str(document['_id']): document for document in batch}
+                batch = list(documents)
+            else:
+                object_ids = [ObjectId(document_id) for document_id in batch if ObjectId.is_valid(document_id)]
+                documents = {str(document['_id']): document
+                             for document in self.documents.find({'_id': {'$in': object_ids}}, projection)}
+
+            vectors = self.corpus_index.get_terms_many(list(documents), section_name)
+            for document_id in batch:
+                document = documents.get(document_id.lower())
+                if document is None:
+                    yield document_id, None, None
+                    continue
+                terms = vectors.get(str(document['_id']), {})
+                tf_idf_pairs = self.corpus_index.weigh(terms, frequencies, documents_count)
+                structure = self.codec.decode(document)
+                if structure is not None and section_name:
+                    # the section is found the way it is found for a single document
+                    index = document.get('sections') or self.parser.get_section_index(structure)
+                    path = self.parser.find_section_path(index, section_name)
+                    structure = self.parser.get_section(structure, path) if path is not None \
+                        else {'name': section_name, 'text': ''}
+                yield document_id, structure, tf_idf_pairs
+
+    def get_similar_documents(self, document_id: str, k: int = 10, section_name: Optional[str] = None,
+                              approximate: bool = False) -> Union[List[Dict], None]:
+        """
+        Finds the documents most similar to the document by cosine similarity of their TF-IDF vectors
+        (or of the vectors of the sections with the same name).
+
+        :param document_id: string representation of the document object id.
+        :param k: number of the documents to find.
+        :param section_name: compare the sections with this name instead of the whole documents.
+        :param approximate: use the approximate index instead of comparing with every document.
+        :return: list of the found documents (ids, names, template ids and similarities), most similar first,
+            or None if the document does not exist.
+        """
+        try:
+            ObjectId(document_id)
+        except bson.errors.InvalidId:
+            return None
+
+        self.ensure_corpus_index()
+        section_name = section_name or ''
+        terms = self.corpus_index.get_terms(document_id, section_name)
+        if terms is None:
+            return None
+
+        revision, documents_count = self.corpus_index.revision(), self.corpus_index.count()
+        index = self.similarity_indexes.get(section_name, revision, documents_count, lambda: SimilarityIndex.build(
+            self.corpus_index.iter_terms(section_name), self.corpus_index.get_all_frequencies(section_name),
+            documents_count, revision))
+        # documents deleted since the index was built are skipped, so more of them are requested
+        results = index.most_similar(index.vectorize([terms]), k + revision - index.revision, [document_id],
+                                     approximate)[0]
+
+        documents = {document['_id']: document for document in self.documents.find(
+            {'_id': {'$in': [ObjectId(found_id) for found_id, _ in results]}}, {'name': 1, 'templateId': 1})}
+        similar = []
+        for found_id, similarity in results:
+            document = documents.get(ObjectId(found_id))
+            if document is not None and len(similar) < k:
+                similar.append({'id': found_id, 'name': document.get('name'),
+                                'templateId': document.get('templateId'), 'similarity': similarity})
+        return similar
+
+    def refresh_documents(self, changes: Dict[str, Set[str]]):
+        """
+        Refreshes the derived data of the documents changed bypassing this class (by other services or by hand):
+        the section index, term vectors of the corpus index, postings of the search index and cached keywords.
+        The current state of the documents is read with a single query, documents that no longer exist are
+        removed from the indexes.
+
+        :param changes: changed parts of the documents (`text`, `keywords`, `template`) by their ids.
+        """
+        object_ids = [ObjectId(document_id) for document_id in changes]
+        documents = {str(document['_id']): document for document in self.documents.find(
+            {'_id': {'$in': object_ids}}, {'templateId': 1, 'keywords': 1, 'sections': 1, **STRUCTURE_PROJECTION})}
+        # the documents whose section index is not rewritten get new versions by a single write
+        unversioned = []
+        for document_id, parts in changes.items():
+            document = documents.get(document_id)
+            if document is None:
+                self.corpus_index.remove(document_id)
+                self.search_index.remove(document_id)
+                self.keyword_cache.invalidate_document(document_id)
+                continue
+
+            if TEMPLATE_CHANGED in parts:
+                # postings keep the template id, so the document is indexed again
+                self.search_index.remove(document_id)
+            indexed = self.search_index.contains(document_id)
+            if TEXT_CHANGED in parts or not indexed:
+                structure = self.codec.decode(document)
+                section_index = self.parser.get_section_index(structure)
+                if section_index != document.get('sections'):
+                    self.documents.update_one({'_id': document['_id']},
+                                              {'$set': {'sections': section_index, INDEX_REVISION: ObjectId()}})
+                else:
+                    unversioned.append(document['_id'])
+                vectors = self.parser.get_term_vectors(structure)
+                self.corpus_index.update(document_id, vectors)
+                if indexed:
+                    self.search_index.update_text(document_id, vectors)
+                self.keyword_cache.invalidate_document(document_id)
+            if not indexed or KEYWORDS_CHANGED in parts:
+                keywords = self.parser.get_keyword_vector(document.get('keywords') or [])
+                if indexed:
+                    self.search_index.update_keywords(document_id, keywords)
+                else:
+                    self.search_index.add(document_id, document.get('templateId'), vectors, keywords)
+            if TEXT_CHANGED not in parts and indexed:
+                unversioned.append(document['_id'])
+        if unversioned:
+            self.documents.update_many({'_id': {'$in': unversioned}}, {'$set': {INDEX_REVISION: ObjectId()}})
+
+    def refresh_template_documents(self, template_id: str, batch_size: int = 100) -> int:
+        """
+        Reacts to the template changed bypassing this class: the compiled template is dropped from the cache and
+        the derived data of the documents created according to the template is refreshed in batches.
+
+        :param template_id: string representation of the template object id.
+        :param batch_size: number of documents refreshed at once.
+        :return: number of the refreshed documents.
+        """
+        self.template_cache.invalidate(template_id)
+        cursor = self.documents.find({'templateId': template_id}, {'_id': 1}).sort('_id', ASCENDING)
+        refreshed = 0
+        for batch in iter(lambda: list(islice(cursor, batch_size)), []):
+            self.refresh_documents({str(document['_id']): {TEMPLATE_CHANGED} for document in batch})
+            refreshed += len(batch)
+        return refreshed
+
+    def ensure_corpus_index(self):
+        """
+        Rebuilds the corpus statistics index if it does not match the collection with documents
+        (for example, the documents were created before the index appeared).
+        """
+        if self.corpus_index_checked:
+            return
+        if self.corpus_index.count() != self.documents.count_documents({}):
+            self.rebuild_corpus_index()
+        self.corpus_index_checked = True
+
+    def rebuild_corpus_index(self):
+        """
+        Builds the corpus statistics index from scratch over all documents.
+        """
+        self.corpus_index.rebuild(
+            (str(document['_id']), self.parser.get_term_vectors(self.codec.decode(document)))
+            for document in self.documents.find({}, STRUCTURE_PROJECTION)
+        )
+
+    def search_documents(self, query: str, section_name: Optional[str] = None, template_id: Optional[str] = None,
+                         fields: Tuple[str, ...] = (TEXT, KEYWORDS), limit: int = 10) -> List[Dict]:
+        """
+        Finds documents by their text and keywords. The query is lemmatized the same way as the documents and
+        the results are ranked by BM25 using the search index.
+
+        :param query: search query.
+        :param section_name: search the text of this section only.
+        :param template_id: search the documents created according to this template only.
+        :param fields: fields to search (`text` and `keywords`).
+        :param limit: maximal number of the found documents.
+        :return: list of the found documents (ids, names, template ids and scores), best first.
+        """
+        terms = self.parser.langproc.tokenize(query)
+        if not terms:
+            return []
+        self.ensure_search_index()
+        results = self.search_index.search(terms, section_name, template_id, fields, limit)
+        documents = {document['_id']: document for document in self.documents.find(
+            {'_id': {'$in': [ObjectId(document_id) for document_id, _ in results]}}, {'name': 1, 'templateId': 1})}
+        found = []
+        for document_id, score in results:
+            document = documents.get(ObjectId(document_id), {})
+            found.append({'id': document_id, 'name': document.get('name'), 'templateId': document.get('templateId'),
+                          'score': score})
+        return found
+
+    def ensure_search_index(self):
+        """
+        Rebuilds the search index if it does not match the collection with documents.
+        """
+        if self.search_index_checked:
+            return
+        if self.search_index.count() != self.documents.count_documents({}):
+            self.rebuild_search_index()
+        self.search_index_checked = True
+
+    def rebuild_search_index(self):
+        """
+        Builds the search index from scratch over all documents.
+        """
+        self.search_index.rebuild(
+            (str(document['_id']), document.get('templateId'),
+             self.parser.get_term_vectors(self.codec.decode(document)),
+             self.parser.get_keyword_vector(document.get('keywords') or []))
+            for document in self.documents.find({}, {'templateId': 1, 'keywords': 1, **STRUCTURE_PROJECTION})
+        )
+
+    def migrate_structures(self, codec: Optional[StructureCodec] = None, batch_size: int = 100) -> int:
+        """
+        Rewrites the structures of the stored documents in the storage format of the codec. Documents are
+        converted in batches in the order of their ids, the service can keep working meanwhile (documents
+        in both formats are read transparently).
+
+        :param codec: the target storage format (the current one by default).
+        :param batch_size: number of documents converted with a single write.
+        :return: number of the converted documents.
+        """
+        codec = codec or self.codec
+        sources = [field for field in STRUCTURE_FIELDS.values() if field != codec.field]
+        query = {'$or': [{field: {'$exists': True}} for field in sources]}
+        converted, last_id = 0, None
+        while True:
+            page_query = {**query, '_id': {'$gt': last_id}} if last_id else query
+            batch = list(self.documents.find(page_query, STRUCTURE_PROJECTION).sort('_id', 1).limit(batch_size))
+            if not batch:
+                return converted
+            requests = []
+            for document in batch:
+                fields = codec.encode(codec.decode(document))
+                # structures the target format cannot represent are left as they are
+                if codec.field in fields:
+                    # the content does not change, so there is nothing to refresh
+                    requests.append(UpdateOne({'_id': document['_id']},
+                                              {'$set': {**fields, INDEX_REVISION: ObjectId()},
+                                               '$unset': codec.get_unset_fields(fields)}))
+            if requests:
+                converted += self.documents.bulk_write(requests, ordered=False).modified_count
+            last_id = batch[-1]['_id']
+
+    def get_templates_short(self, limit: Optional[int] = None, after: Optional[str] = None) -> Dict[str, List]:
+        """
+        Returns short information about structures templates for recognizing text documents (ids and names).
+        """
+        return self.get_templates(['name'], limit, after)
+
+    def get_templates(self, fields: Optional[List[str]] = None, limit: Optional[int] = None,
+                      after: Optional[str] = None) -> Dict[str, List]:
+        """
+        Returns structures templates for recognizing text documents.
+
+        :param fields: fields of the templates to be returned (all fields by default).
+        :param limit: maximal number of templates in the page.
+        :param after: continuation token (the id of the last template of the previous page).
+        :return: dictionary containing the page of templates and the continuation token (if `limit` is set).
+        """
+        return self.__get_page(self.iter_templates(fields, limit, after), limit)
+
+    def iter_templates(self, fields: Optional[List[str]] = None, limit: Optional[int] = None,
+                       after: Optional[str] = None) -> Iterator[Dict]:
+        """
+        Iterates over templates in the order of their ids reading only the requested fields.
+        """
+        return self.__iter_entities(self.templates, fields or list(TEMPLATE_FIELDS), TEMPLATE_FIELDS, limit, after)
 
     def get_template(self, template_id: str) -> Union[Template, None]:
         """
@@ -197,14 +847,10 @@ class Database:
         except bson.errors.InvalidId:
             return None
 
-        flag = False
-        for document in self.documents.find({}):
-            current_temp_id = document.get('templateId')
-            if current_temp_id == template_id:
-                flag = True
-
-        if flag is False:
+        # indexed lookup that stops at the first referencing document
+        if self.documents.find_one({'templateId': template_id}, {'_id': 1}) is None:
             self.templates.delete_one({'_id':  object_id})
+            self.template_cache.invalidate(template_id)
             return 'OK'
         else:
             raise ValidException('template fastens to document')
@@ -220,22 +866,112 @@ class Database:
         if not is_structure_valid:
             return False
 
-        self.templates.insert_one({'name': data.name, 'structure': data.structure})
+        result = self.templates.insert_one({'name': data.name, 'structure': data.structure})
+        # drops an entry left by a template with the same id (restored bypassing the API)
+        self.template_cache.invalidate(str(result.inserted_id))
         return True
 
-    async def parse_docx_by_template(self, template: Template, file: UploadFile = File(...)) -> list:
+    def get_compiled_template(self, template_id: str) -> Optional[CompiledTemplate]:
+        """
+        Returns the section template from the cache of the compiled templates, the template is read from
+        the collection with templates if it is not cached.
+        """
+        template = self.template_cache.get(template_id)
+        if template is None:
+            found = self.get_template(template_id)
+            if found is None:
+                return None
+            template = self.template_cache.put(CompiledTemplate(found))
+        return template
+
+    async def parse_docx_by_template(self, template: CompiledTemplate, file: UploadFile = File(...),
+                                     max_size: Optional[int] = None) -> list:
         """
         The wrapper method over method `parse_docx_by_template` from :py:class:`ParserWrapper`.
         """
-        document_structure = await self.parser.parse_docx_by_template(template.structure[0], file)
+        document_structure = await self.parser.parse_docx_by_template(template.structure, file, max_size,
+                                                                      template.get_plan(self.parser))
         return [document_structure]
 
+    def __get_structure(self, object_id: ObjectId) -> Optional[Dict]:
+        document = self.documents.find_one({'_id': object_id}, STRUCTURE_PROJECTION)
+        return self.codec.decode(document) if document is not None else None
+
+    def __get_section(self, object_id: ObjectId, path: Path) -> Optional[Dict]:
+        # every stage descends one level, so only the section subtree leaves the server
+        # (compact trees are read and decoded as a whole)
+        tree = STRUCTURE_FIELDS[COMPACT]
+        pipeline = [{'$match': {'_id': object_id}}, {'$project': {'_id': 0, 'section': '$structure', tree: 1}}]
+        for index in path:
+            pipeline.append({'$project': {tree: 1, 'section': {'$arrayElemAt': ['$section.children', index]}}})
+        for document in self.documents.aggregate(pipeline):
+            if tree in document:
+                return self.parser.get_section(self.codec.decode(document), path)
+            return document.get('section')
+        return None
+
+    @staticmethod
+    def __get_section_field(path: Path) -> str:
+        return 'structure' + ''.join(f'.children.{index}' for index in path)
+
+    @staticmethod
+    def __get_documents_query(name: Optional[str] = None, template_id: Optional[str] = None) -> Dict:
+        query = {}
+        if name is not None:
+            query['name'] = name
+        if template_id is not None:
+            query['templateId'] = template_id
+        return query
+
+    @staticmethod
+    def __get_version(document: Dict) -> Optional[str]:
+        # the name and the template are not refreshed by the worker, so they are a part of the version
+        if document.get(INDEX_REVISION) is None:
+            return None
+        content = f'{document["_id"]}:{document[INDEX_REVISION]}:{document.get("name")}:{document.get("templateId")}'
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def __find_page(collection, query: Dict, projection: Dict, limit: Optional[int] = None,
+                    after: Optional[str] = None):
+        query = dict(query)
+        if after:
+            try:
+                query['_id'] = {'$gt': ObjectId(after)}
+            except bson.errors.InvalidId:
+                raise ValidException(f'continuation token {after} is not valid')
+        cursor = collection.find(query, projection).sort('_id', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    @staticmethod
+    def __iter_entities(collection, fields: List[str], allowed_fields: Tuple[str, ...], limit: Optional[int] = None,
+                        after: Optional[str] = None, query: Optional[Dict] = None) -> Iterator[Dict]:
+        for field in fields:
+            if field not in allowed_fields:
+                raise ValidException(f'unknown field {field}, allowed fields: {", ".join(allowed_fields)}')
+
+        projection = {field: 1 for field in fields}
+        if 'structure' in fields:
+            projection.update(STRUCTURE_PROJECTION)
+        cursor = Database.__find_page(collection, query or {}, projection, limit, after)
+        return (Database.__to_entity(value, fields) for value in cursor)
+
+    @staticmethod
+    def __to_entity(value: Dict, fields: List[str]) -> Dict:
+        entity = {'id': str(value.get('_id'))}
+        for field in fields:
+            # structures and keywords are returned wrapped into lists as in :py:class:`Document`
+            if field == 'structure':
+                entity[field] = [StructureCodec.decode(value)]
+            else:
+                entity[field] = [value.get(field)] if field == 'keywords' else value.get(field)
+        return entity
+
     @staticmethod
-    def __get_entities(entity) -> Dict[str, List[Entity]]:
-        entities: List[Entity] = []
-        for value in entity.find({}):
-            entities.append(Entity(
-                id=str(value.get('_id')),
-                name=value.get('name')
-            ))
-        return {'data': entities}
+    def __get_page(entities: Iterator[Dict], limit: Optional[int] = None) -> Dict[str, List]:
+        data = list(entities)
+        if not limit:
+            return {'data': data}
+        return {'data': data, 'next': data[-1]['id'] if len(data) == limit else None}
@@ -0,0 +1,185 @@
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import MongoClient, uri_parser
+from pymongo.database import Database as MongoDatabase
+
+from app.errors import FoundException, ValidException, StateException
+from app.models.database import Database, DATABASE_NAME
+
+DEFAULT_TENANT = 'default'
+
+TENANT_NAME = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# tenant of the current request, it is set by the tenant middleware
+_tenant: ContextVar[str] = ContextVar('tenant', default=DEFAULT_TENANT)
+
+
+def current_tenant() -> str:
+    """
+    Returns the name of the tenant the current request (or task) works with.
+    """
+    return _tenant.get()
+
+
+@contextmanager
+def use_tenant(name: str) -> Iterator[None]:
+    """
+    Makes the tenant current within the context (and within the tasks and threads started with its copy).
+    """
+    token = _tenant.set(name)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+class _Client:
+    def __init__(self, client: MongoClient):
+        self.client = client
+        # number of tenants using the client
+        self.references = 0
+
+
+class _Tenant:
+    def __init__(self, key: Tuple[str, bool], database_name: str, database: Database):
+        self.key = key
+        self.database_name = database_name
+        self.database = database
+
+
+class DatabaseRegistry:
+    """
+    Registry of the named databases (tenants) served by the service.
+
+    Every tenant gets its own :py:class:`Database` with its own caches and indexes, while tenants on the same
+    server (the same URI) share a single :py:class:`MongoClient` and its connection pool. Clients are created
+    when the first tenant using them is registered and closed when the last one is removed, so re-registering
+    a tenant does not leak pools and tenants are not affected by the connections of each other.
+    """
+
+    def __init__(self, create: Callable[[MongoDatabase], Database], client_options: Optional[Dict] = None):
+        """
+        :param create: function creating the :py:class:`Database` of a tenant from its MongoDB database.
+        :param client_options: options of the created :py:class:`MongoClient` instances.
+        """
+        self.create = create
+        self.client_options = client_options or {}
+        self.clients: Dict[Tuple[str, bool], _Client] = {}
+        self.tenants: Dict[str, _Tenant] = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, uri: str, dev_mode: bool = False, database_name: Optional[str] = None,
+                 verify: bool = False) -> Database:
+        """
+        Registers the tenant or changes its connection and returns its database. The database of the tenant
+        is returned as is if the connection does not change.
+
+        :param name: the name of the tenant.
+        :param uri: URI to connect to the server.
+        :param dev_mode: parameter turns on a develop mode.
+        :param database_name: the database of the tenant on the server (the database of the URI or
+            `documentsAnalysis` by default).
+        :param verify: create the indexes of the database before it is registered, so a connection that does
+            not work does not replace the previous one (its client is released then).
+        """
+        if not TENANT_NAME.fullmatch(name):
+            raise ValidException(f'tenant name {name} is not valid')
+        if database_name is None:
+            try:
+                database_name = uri_parser.parse_uri(uri)['database'] or DATABASE_NAME
+            except Exception as ex:
+                raise ValidException(str(ex))
+        key = (uri, dev_mode)
+        with self.lock:
+            previous = self.tenants.get(name)
+            if previous is not None and previous.key == key and previous.database_name == database_name:
+                return previous.database
+
+            entry = self.clients.get(key)
+            if entry is None:
+                entry = _Client(Database.create_client(uri, dev_mode, self.client_options))
+                self.clients[key] = entry
+            entry.references += 1
+
+        # the connection is checked without holding the lock, it may take until the server selection times out
+        try:
+            database = self.create(entry.client[database_name])
+            if verify:
+                database.ensure_indexes()
+        except Exception:
+            with self.lock:
+                self.__release(key)
+            raise
+
+        with self.lock:
+            previous = self.tenants.get(name)
+            self.tenants[name] = _Tenant(key, database_name, database)
+            if previous is not None:
+                self.__release(previous.key)
+            return database
+
+    def remove(self, name: str):
+        """
+        Removes the tenant, the client is closed if no other tenant uses it.
+        """
+        if name == DEFAULT_TENANT:
+            raise StateException('default tenant cannot be removed')
+        with self.lock:
+            tenant = self.tenants.pop(name, None)
+            if tenant is None:
+                raise FoundException(f'tenant {name} not found')
+            self.__release(tenant.key)
+
+    def get(self, name: str) -> Database:
+        tenant = self.tenants.get(name)
+        if tenant is None:
+            raise FoundException(f'tenant {name} not found')
+        return tenant.database
+
+    def names(self) -> List[str]:
+        return list(self.tenants)
+
+    def close(self):
+        """
+        Closes the clients of all tenants.
+        """
+        with self.lock:
+            for entry in self.clients.values():
+                entry.client.close()
+            self.clients.clear()
+            self.tenants.clear()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.tenants
+
+    def __release(self, key: Tuple[str, bool]):
+        entry = self.clients.get(key)
+        # the clients are closed by `close` while a connection may still be verified
+        if entry is None:
+            return
+        entry.references -= 1
+        if entry.references <= 0:
+            del self.clients[key]
+            entry.client.close()
+
+
+class TenantDatabase:
+    """
+    The database of the current tenant (see :py:func:`current_tenant`).
+
+    Attributes and methods are looked up in the database of the tenant at the time they are accessed, so
+    the proxy can be shared by the routes and the background jobs the way a single database was.
+    """
+
+    def __init__(self, registry: DatabaseRegistry):
+        object.__setattr__(self, 'registry', registry)
+
+    def __getattr__(self, name: str):
+        return getattr(self.registry.get(current_tenant()), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self.registry.get(current_tenant()), name, value)
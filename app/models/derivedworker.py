@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set
+
+from app.models.database import Database, INDEX_REVISION, TEXT_CHANGED, KEYWORDS_CHANGED, TEMPLATE_CHANGED
+from app.models.structurecodec import STRUCTURE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# document fields whose changes make the derived data of the document stale
+WATCHED_FIELDS = {**{field: TEXT_CHANGED for field in STRUCTURE_FIELDS.values()},
+                  'keywords': KEYWORDS_CHANGED, 'templateId': TEMPLATE_CHANGED}
+
+
+class DerivedDataWorker:
+    """
+    Background worker keeping the derived data of the documents up to date when the documents are changed
+    bypassing the API (by other services, scripts or by hand).
+
+    The worker tails a change stream of the collections with documents and templates. Writes of the API update
+    the derived data by themselves and mark the documents (see :py:data:`INDEX_REVISION`), so their events are
+    skipped. Other changes are collected into batches coalesced by documents, and every batch is refreshed
+    by :py:meth:`Database.refresh_documents` in a pool of `workers` threads. The stream is not read while a batch
+    is being refreshed, so a burst of changes waits in the oplog instead of the memory of the worker. The resume
+    token is stored after every batch, so a restarted worker continues where it stopped (changes of a batch that
+    was interrupted are refreshed again, refreshing is idempotent).
+
+    Change streams need a replica set: a single-node replica set started locally is enough.
+    """
+
+    def __init__(self, database: Database, name: str = 'derivedData', batch_size: int = 100, max_wait: float = 1.0,
+                 workers: int = 4, template_listeners: Optional[List[Callable[[str], None]]] = None):
+        """
+        :param database: database with the documents (resume tokens are stored next to them).
+        :param name: the id of the resume token of the worker.
+        :param batch_size: maximal number of the documents refreshed in a batch.
+        :param max_wait: maximal time in seconds changes wait in an incomplete batch.
+        :param workers: number of threads refreshing the documents of a batch.
+        :param template_listeners: functions called with the id of every changed template.
+        """
+        self.database = database
+        self.name = name
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.template_listeners = template_listeners or []
+        self.changes: Dict[str, Set[str]] = {}
+        self.statistics = {'events': 0, 'skipped': 0, 'batches': 0, 'refreshed': 0, 'failed': 0}
+
+    def run(self, stop: Optional[threading.Event] = None):
+        """
+        Tails the change stream until `stop` is set.
+        """
+        stop = stop or threading.Event()
+        documents, templates = self.database.documents, self.database.templates
+        pipeline = [{'$match': {'ns.coll': {'$in': [documents.name, templates.name]}}}]
+        token, invalidated = self.load_token()
+        # the indexes may miss the changes made while no worker was running
+        self.database.ensure_corpus_index()
+        self.database.ensure_search_index()
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='derived-data') as executor:
+            while not stop.is_set():
+                options = {'start_after': token} if invalidated else {'resume_after': token}
+                with documents.database.watch(pipeline, max_await_time_ms=int(self.max_wait * 1000),
+                                              **options) as stream:
+                    invalidated = False
+                    started = None
+                    while not stop.is_set() and not invalidated:
+                        event = stream.try_next()
+                        if event is not None:
+                            invalidated = self.__collect(event)
+                            if started is None and self.changes:
+                                started = time.monotonic()
+                        flush = bool(self.changes) and (len(self.changes) >= self.batch_size or invalidated
+                                                        or event is None or time.monotonic() - started >= self.max_wait)
+                        if flush:
+                            self.__refresh(executor)
+                            started = None
+                        # the token is stored after batches and when the stream is idle, not after every event
+                        if not self.changes and (flush or invalidated or event is None) \
+                                and stream.resume_token is not None and stream.resume_token != token:
+                            token = stream.resume_token
+                            self.save_token(token, invalidated)
+
+    def load_token(self):
+        """
+        Returns the stored resume token (None if there is no token) and whether the stream was invalidated.
+        """
+        entry = self.database.change_stream_tokens.find_one({'_id': self.name})
+        if entry is None:
+            return None, False
+        return entry.get('token'), entry.get('invalidated', False)
+
+    def save_token(self, token, invalidated: bool = False):
+        self.database.change_stream_tokens.update_one(
+            {'_id': self.name}, {'$set': {'token': token, 'invalidated': invalidated, 'updatedAt': datetime.utcnow()}},
+            upsert=True)
+
+    def __collect(self, event: Dict) -> bool:
+        self.statistics['events'] += 1
+        operation = event['operationType']
+        if operation == 'invalidate':
+            return True
+        collection = event.get('ns', {}).get('coll')
+        if operation in ('drop', 'rename', 'dropDatabase'):
+            if collection != self.database.templates.name:
+                self.database.rebuild_corpus_index()
+                self.database.rebuild_search_index()
+            return False
+        document_id = str(event['documentKey']['_id'])
+
+        if collection == self.database.templates.name:
+            for listener in self.template_listeners:
+                listener(document_id)
+            return False
+
+        if operation == 'insert' and INDEX_REVISION in event.get('fullDocument', {}):
+            parts = set()
+        elif operation == 'update':
+            description = event.get('updateDescription', {})
+            fields = list(description.get('updatedFields', {})) + list(description.get('removedFields', []))
+            if INDEX_REVISION in fields:
+                parts = set()
+            else:
+                # nested fields (structure.children.0.text) belong to the parts of their top-level fields
+                parts = {WATCHED_FIELDS[field.split('.')[0]] for field in fields
+                         if field.split('.')[0] in WATCHED_FIELDS}
+        else:
+            # external inserts, replaces and deletes refresh everything
+            parts = {TEXT_CHANGED, KEYWORDS_CHANGED, TEMPLATE_CHANGED}
+
+        if not parts:
+            self.statistics['skipped'] += 1
+            return False
+        self.changes.setdefault(document_id, set()).update(parts)
+        return False
+
+    def __refresh(self, executor: ThreadPoolExecutor):
+        changes, self.changes = self.changes, {}
+        items = list(changes.items())
+        chunks = [dict(items[i::self.workers]) for i in range(min(self.workers, len(items)))]
+
+        def refresh(chunk: Dict[str, Set[str]]):
+            try:
+                self.database.refresh_documents(chunk)
+                return len(chunk), 0
+            except Exception:
+                # documents are refreshed one by one to find the failing ones
+                refreshed = 0
+                for document_id, parts in chunk.items():
+                    try:
+                        self.database.refresh_documents({document_id: parts})
+                        refreshed += 1
+                    except Exception:
+                        logger.exception('derived data of document %s cannot be refreshed', document_id)
+                return refreshed, len(chunk) - refreshed
+
+        for refreshed, failed in executor.map(refresh, chunks):
+            self.statistics['refreshed'] += refreshed
+            self.statistics['failed'] += failed
+        self.statistics['batches'] += 1
+        logger.info('refreshed %d documents', len(items))
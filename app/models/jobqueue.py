@@ -0,0 +1,192 @@
+import contextvars
+import os
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.models.parserwrapper import ParserWrapper
+from app.schemas.schema import KeywordExtractionMode, KeywordJob, JobStatus
+
+# parser of the worker process, it is created once by the pool initializer
+_worker_parser: Optional[ParserWrapper] = None
+
+
+def _init_worker():
+    global _worker_parser
+    _worker_parser = ParserWrapper()
+
+
+def _extract_keywords(mode: KeywordExtractionMode, structure: dict, tf_idf_pairs: Optional[List]) -> List:
+    # the structure is the section the keywords are extracted from, it is found by the caller
+    if mode == KeywordExtractionMode.tf_idf:
+        return tf_idf_pairs
+    if mode == KeywordExtractionMode.pullenti:
+        return _worker_parser.extract_keywords(structure)
+    return _worker_parser.extract_rationized_keywords(structure, tf_idf_pairs)
+
+
+class _Job:
+    def __init__(self, key: Tuple[str, str, KeywordExtractionMode, Optional[str]], save: bool):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.save = save
+        # the result is saved within the context of the request that submitted the job
+        self.context = contextvars.copy_context()
+        self.future: Optional[Future] = None
+
+    def to_schema(self) -> KeywordJob:
+        _, document_id, mode, section_name = self.key
+        error = None
+        if self.future.cancelled():
+            error = 'job is cancelled'
+            status = JobStatus.failed
+        elif self.future.done():
+            error = self.future.exception()
+            status = JobStatus.failed if error else JobStatus.done
+        elif self.future.running():
+            status = JobStatus.running
+        else:
+            status = JobStatus.pending
+        return KeywordJob(id=self.id, documentId=document_id, mode=mode, sectionName=section_name,
+                          save=self.save, status=status, error=str(error) if error else None)
+
+
+class KeywordJobQueue:
+    """
+    Queue of keyword generation jobs executed by a pool of worker processes.
+
+    Identical jobs (the same document, mode and section) that are in flight are deduplicated.
+    The finished jobs are kept until `history_size` newer jobs are submitted.
+    Jobs belong to the scope (tenant) they are submitted in: jobs of other scopes are neither deduplicated
+    with nor visible from it.
+    """
+
+    def __init__(self, save_keywords: Callable[[str, List], str], workers: Optional[int] = None,
+                 history_size: int = 1000, scope: Optional[Callable[[], str]] = None):
+        """
+        :param save_keywords: function that writes the result back to the document (`document_id`, `keywords`).
+        :param workers: number of worker processes (the number of processors by default).
+        :param history_size: number of jobs whose statuses and results are kept.
+        :param scope: function returning the scope of the current request (a single scope by default).
+        """
+        self.save_keywords = save_keywords
+        self.scope = scope or (lambda: '')
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        self.history_size = history_size
+        self.jobs: Dict[str, _Job] = OrderedDict()
+        self.in_flight: Dict[tuple, _Job] = {}
+        self.lock = Lock()
+
+    def find_in_flight(self, document_id: str, mode: KeywordExtractionMode, section_name: Optional[str] = None,
+                       save: bool = False) -> Optional[KeywordJob]:
+        """
+        Returns the identical job that is in flight or None.
+        If `save` is True, the result of the found job will be written back to the document.
+        """
+        with self.lock:
+            job = self.in_flight.get((self.scope(), document_id, mode, section_name))
+            if job is None:
+                return None
+            job.save = job.save or save
+            return job.to_schema()
+
+    def submit(self, document_id: str, mode: KeywordExtractionMode, structure: dict,
+               tf_idf_pairs: Optional[List] = None, section_name: Optional[str] = None,
+               save: bool = False) -> KeywordJob:
+        """
+        Submits keyword generation job for the document.
+
+        :param document_id: string representation of the document object id.
+        :param mode: keyword extraction mode.
+        :param structure: section structure of the document (the section subtree if `section_name` is set,
+            see :py:meth:`Database.get_document_section_by_name`).
+        :param tf_idf_pairs: TF-IDF pairs of the document (section), required by `tf_idf` and `combine` modes.
+        :param section_name: the name of a specific section of the structure.
+        :param save: write the result back to the document keywords.
+        :return: the submitted (or the identical in-flight) job.
+        """
+        key = (self.scope(), document_id, mode, section_name)
+        with self.lock:
+            job = self.in_flight.get(key)
+            if job is not None:
+                job.save = job.save or save
+                return job.to_schema()
+
+            job = _Job(key, save)
+            job.future = self.executor.submit(_extract_keywords, mode, structure, tf_idf_pairs)
+            self.in_flight[key] = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history_size:
+                self.jobs.popitem(last=False)
+        job.future.add_done_callback(lambda future: self.__on_done(job))
+        return job.to_schema()
+
+    def get(self, job_id: str) -> Optional[KeywordJob]:
+        """
+        Returns the job status or None if the job is unknown.
+        """
+        job = self.__find(job_id)
+        return job.to_schema() if job else None
+
+    def get_result(self, job_id: str) -> Optional[Tuple[KeywordJob, Future]]:
+        """
+        Returns the job status and the future holding the job result or None if the job is unknown.
+        Both are taken from a single lookup, so the job evicted from the history meanwhile is still returned.
+        """
+        job = self.__find(job_id)
+        return (job.to_schema(), job.future) if job else None
+
+    def extract_many(self, documents: Iterable[Tuple[str, Optional[dict], Optional[List]]],
+                     mode: KeywordExtractionMode, max_in_flight: Optional[int] = None) -> Iterator[dict]:
+        """
+        Extracts keywords from many documents using the pool of worker processes and yields the results
+        as soon as they are ready (not necessarily in the order of the documents).
+
+        :param documents: triples (document id, structure or section, TF-IDF pairs),
+            see :py:meth:`Database.iter_documents_tf_idf_pairs`.
+        :param mode: keyword extraction mode.
+        :param max_in_flight: maximal number of documents submitted to the pool at once
+            (four per worker process by default).
+        :return: iterator of dictionaries with the document id and either its keywords or an error.
+        """
+        max_in_flight = max_in_flight or self.workers * 4
+        in_flight: Dict[Future, str] = {}
+
+        def collect(return_when) -> Iterator[dict]:
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                document_id = in_flight.pop(future)
+                if future.exception() is not None:
+                    yield {'id': document_id, 'error': str(future.exception())}
+                else:
+                    yield {'id': document_id, 'keywords': future.result()}
+
+        for document_id, structure, tf_idf_pairs in documents:
+            if structure is None and tf_idf_pairs is None:
+                yield {'id': document_id, 'error': f'document with _id={document_id} not found'}
+            elif mode == KeywordExtractionMode.tf_idf:
+                yield {'id': document_id, 'keywords': tf_idf_pairs}
+            else:
+                future = self.executor.submit(_extract_keywords, mode, structure, tf_idf_pairs)
+                in_flight[future] = document_id
+                if len(in_flight) >= max_in_flight:
+                    yield from collect(FIRST_COMPLETED)
+        while in_flight:
+            yield from collect(FIRST_COMPLETED)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def __find(self, job_id: str) -> Optional[_Job]:
+        job = self.jobs.get(job_id)
+        return job if job is not None and job.key[0] == self.scope() else None
+
+    def __on_done(self, job: _Job):
+        with self.lock:
+            if self.in_flight.get(job.key) is job:
+                del self.in_flight[job.key]
+        if job.save and not job.future.cancelled() and job.future.exception() is None:
+            job.context.run(self.save_keywords, job.key[1], job.future.result())
@@ -0,0 +1,156 @@
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from typing import Dict, List, Optional
+
+from pymongo.collection import Collection
+
+from app.schemas.schema import KeywordExtractionMode, CacheStatistics
+
+
+class KeywordCache:
+    """
+    Content-addressed cache of keyword extraction results.
+
+    Results are keyed by a hash of the section content and the extraction mode (and of the section name
+    for the modes that depend on the document frequencies of the section). The cache has a size-bounded
+    in-memory LRU tier and an optional persistent tier stored in MongoDB (entries expire after `ttl` seconds
+    in both tiers). Results that depend on IDF values remember the corpus revision they were computed for and
+    become stale when the corpus has changed more than `idf_tolerance` of its documents since then.
+    """
+
+    def __init__(self, size: int = 1024, ttl: int = 3600, persistent: bool = False, idf_tolerance: float = 0.05):
+        """
+        :param size: maximal number of entries of the in-memory tier.
+        :param ttl: lifetime of the entries in seconds.
+        :param persistent: whether to use MongoDB tier.
+        :param idf_tolerance: share of corpus changes after which IDF dependent entries are stale.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.persistent = persistent
+        self.idf_tolerance = idf_tolerance
+        self.collection: Optional[Collection] = None
+        self.entries: Dict[str, dict] = OrderedDict()
+        self.lock = Lock()
+        self.statistics = {'hits': 0, 'persistentHits': 0, 'misses': 0, 'stale': 0, 'evictions': 0,
+                           'invalidations': 0}
+
+    def bind(self, collection: Collection):
+        """
+        Binds the cache to the database: the in-memory tier is cleared and the collection is used as
+        the persistent tier (if it is turned on).
+        """
+        with self.lock:
+            self.entries.clear()
+        self.collection = collection if self.persistent else None
+        if self.collection is not None:
+            self.collection.create_index('createdAt', expireAfterSeconds=self.ttl)
+            self.collection.create_index('documents')
+
+    @staticmethod
+    def make_key(content: str, mode: KeywordExtractionMode, section_name: Optional[str] = None) -> str:
+        """
+        Returns the cache key for the section content and the extraction mode.
+
+        :param content: content of the section.
+        :param mode: keyword extraction mode.
+        :param section_name: the name of the section (None or an empty string for the whole document), the same
+            text weighs differently in different sections, so it is a part of the keys of corpus-dependent modes.
+        """
+        if KeywordCache.depends_on_corpus(mode):
+            return hashlib.sha256(f'{mode.value}\0{section_name or ""}\0{content}'.encode('utf-8')).hexdigest()
+        return hashlib.sha256(f'{mode.value}\0{content}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def depends_on_corpus(mode: KeywordExtractionMode) -> bool:
+        return mode != KeywordExtractionMode.pullenti
+
+    def get(self, key: str, revision: int = 0, documents_count: int = 0) -> Optional[List]:
+        """
+        Returns the cached result or None.
+
+        :param key: cache key (see :py:meth:`make_key`).
+        :param revision: current corpus revision.
+        :param documents_count: current number of documents in the corpus.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['expires'] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                if self.__is_fresh(entry, revision, documents_count):
+                    self.entries.move_to_end(key)
+                    self.statistics['hits'] += 1
+                    return entry['value']
+                del self.entries[key]
+                self.statistics['stale'] += 1
+
+        if self.collection is not None:
+            entry = self.collection.find_one({'_id': key})
+            if entry is not None and self.__is_fresh(entry, revision, documents_count):
+                self.__put_memory(key, entry['value'], entry['mode'], entry['revision'], set(entry['documents']))
+                with self.lock:
+                    self.statistics['persistentHits'] += 1
+                return entry['value']
+
+        with self.lock:
+            self.statistics['misses'] += 1
+        return None
+
+    def put(self, key: str, document_id: str, mode: KeywordExtractionMode, value: List, revision: int = 0):
+        """
+        Puts the result computed for the document into the cache.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            documents = entry['documents'] | {document_id} if entry is not None else {document_id}
+        self.__put_memory(key, value, mode.value, revision, documents)
+
+        if self.collection is not None:
+            self.collection.update_one({'_id': key}, {
+                '$set': {'value': value, 'mode': mode.value, 'revision': revision, 'createdAt': datetime.utcnow()},
+                '$addToSet': {'documents': document_id}
+            }, upsert=True)
+
+    def invalidate_document(self, document_id: str):
+        """
+        Removes all the entries computed for the document.
+        """
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if document_id in entry['documents']]
+            for key in keys:
+                del self.entries[key]
+            self.statistics['invalidations'] += len(keys)
+
+        if self.collection is not None:
+            result = self.collection.delete_many({'documents': document_id})
+            with self.lock:
+                self.statistics['invalidations'] += result.deleted_count
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.collection is not None:
+            self.collection.delete_many({})
+
+    def get_statistics(self) -> CacheStatistics:
+        with self.lock:
+            return CacheStatistics(size=len(self.entries), **self.statistics)
+
+    def __put_memory(self, key: str, value: List, mode: str, revision: int, documents: set):
+        with self.lock:
+            self.entries[key] = {'value': value, 'mode': mode, 'revision': revision, 'documents': documents,
+                                 'expires': time.monotonic() + self.ttl}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.statistics['evictions'] += 1
+
+    def __is_fresh(self, entry: dict, revision: int, documents_count: int) -> bool:
+        if not self.depends_on_corpus(KeywordExtractionMode(entry['mode'])):
+            return True
+        return revision - entry['revision'] <= self.idf_tolerance * documents_count
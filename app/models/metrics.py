@@ -0,0 +1,165 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import monitoring
+
+# upper bounds of the histogram buckets in seconds (the default buckets of the Prometheus clients)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# durations of the phases of the current request
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('timings', default=None)
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.series: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, labels: Tuple[str, ...], value: float):
+        series = self.series.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self, name: str, label_names: Tuple[str, ...]) -> Iterator[str]:
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            pairs = list(zip(label_names, labels))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f'{name}_bucket{_format_labels(pairs + [("le", repr(bound))])} {bucket_count}'
+            yield f'{name}_bucket{_format_labels(pairs + [("le", "+Inf")])} {count}'
+            yield f'{name}_sum{_format_labels(pairs)} {total}'
+            yield f'{name}_count{_format_labels(pairs)} {count}'
+
+
+def _format_labels(pairs: List[Tuple[str, str]]) -> str:
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class TrackedRequest:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.status = 200
+        # durations of the request phases (phase -> seconds)
+        self.timings: Dict[str, float] = {}
+
+
+class _CommandListener(monitoring.CommandListener):
+    """
+    Records the duration of every MongoDB command as the `mongo` phase.
+    """
+
+    def __init__(self, metrics: 'Metrics'):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.observe_phase('mongo', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.observe_phase('mongo', event.duration_micros / 1e6)
+
+
+class Metrics:
+    """
+    Process-wide performance metrics of the service exposed in the Prometheus text format.
+
+    Requests are tracked by routes: latency histograms by the route, the method and the response status
+    (error rates are the share of the responses with error statuses) and the numbers of requests in flight.
+    Phases of request processing (MongoDB commands, document parsing, keyword extraction, rendering) are
+    timed separately, and their durations within the current request can be sent in the `Server-Timing` header.
+    """
+
+    def __init__(self, server_timing: bool = False):
+        """
+        :param server_timing: whether to add the `Server-Timing` header to the responses.
+        """
+        self.server_timing = server_timing
+        self.requests = _Histogram()
+        self.phases = _Histogram()
+        self.in_flight: Dict[Tuple[str, str], int] = {}
+        self.command_listener = _CommandListener(self)
+        self.lock = Lock()
+
+    @contextmanager
+    def track_request(self, method: str, route: str) -> Iterator[TrackedRequest]:
+        """
+        Tracks the request processed within the context. Exceptions are counted as the responses with
+        the status of :py:class:`HTTPException` or 500.
+
+        :param method: HTTP method.
+        :param route: the path template of the route.
+        :return: the tracked request, its status is to be set when the response is ready.
+        """
+        request = TrackedRequest()
+        token = _timings.set(request.timings)
+        key = (method, route)
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        try:
+            yield request
+        except HTTPException as ex:
+            request.status = ex.status_code
+            raise
+        except BaseException:
+            request.status = 500
+            raise
+        finally:
+            elapsed = time.perf_counter() - request.start
+            with self.lock:
+                self.in_flight[key] -= 1
+                self.requests.observe((method, route, str(request.status)), elapsed)
+            _timings.reset(token)
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        """
+        Times the phase of request processing executed within the context.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - start)
+
+    def observe_phase(self, phase: str, seconds: float):
+        with self.lock:
+            self.phases.observe((phase,), seconds)
+        timings = _timings.get()
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + seconds
+
+    @staticmethod
+    def format_server_timing(timings: Dict[str, float]) -> str:
+        """
+        Returns the value of the `Server-Timing` header for the phase durations.
+        """
+        return ', '.join(f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in sorted(timings.items()))
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = ['# HELP http_request_duration_seconds Latency of the requests by routes.',
+                     '# TYPE http_request_duration_seconds histogram']
+            lines += self.requests.render('http_request_duration_seconds', ('method', 'route', 'status'))
+            lines += ['# HELP http_requests_in_flight Number of the requests being processed by routes.',
+                      '# TYPE http_requests_in_flight gauge']
+            lines += [f'http_requests_in_flight{_format_labels([("method", method), ("route", route)])} {count}'
+                      for (method, route), count in sorted(self.in_flight.items())]
+            lines += ['# HELP phase_duration_seconds Duration of the phases of request processing.',
+                      '# TYPE phase_duration_seconds histogram']
+            lines += self.phases.render('phase_duration_seconds', ('phase',))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
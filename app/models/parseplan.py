@@ -0,0 +1,82 @@
+from typing import Dict, FrozenSet, Iterator, List, Tuple
+
+from docx.text.paragraph import Paragraph
+from srsparser import LanguageProcessor, Parser, SectionsTree, configs
+
+Tokens = FrozenSet[str]
+
+
+class ParsePlan:
+    """
+    Section template compiled for parsing.
+
+    :py:class:`Parser` tokenizes (and lemmatizes) the names of all leaf sections of the template every time
+    a paragraph is compared with them, that is several times for every paragraph of every parsed document.
+    The plan tokenizes the names once, so parsers created by :py:meth:`create_parser` only tokenize
+    the paragraphs. The results are the same as the results of :py:class:`Parser`.
+    """
+
+    def __init__(self, template: dict, langproc: LanguageProcessor):
+        """
+        :param template: section template.
+        :param langproc: language processor shared by the parsers.
+        """
+        self.template = template
+        self.langproc = langproc
+        # token sets of the names of the leaf sections in the order of :py:meth:`SectionsTree.get_leaf_sections`
+        self.leaf_tokens: List[Tokens] = [frozenset(langproc.tokenize(section.name))
+                                          for section in SectionsTree(template).get_leaf_sections()]
+
+    def create_parser(self) -> Parser:
+        """
+        Returns a parser for a single document (parsing fills the sections tree of the parser).
+        """
+        return PlannedParser(self)
+
+
+class PlannedParser(Parser):
+    """
+    :py:class:`Parser` comparing paragraphs with the precompiled names of the leaf sections of its plan.
+    Paragraph texts are tokenized once per document and table cells are collected once per document.
+    """
+
+    def __init__(self, plan: ParsePlan):
+        # the constructor of the parser would load its own language processor
+        self.nlp = plan.langproc
+        self.sections_tree = SectionsTree(plan.template)
+        self.leaves = list(zip(self.sections_tree.get_leaf_sections(), plan.leaf_tokens))
+        self.tokens: Dict[str, Tokens] = {}
+        self.table_texts = frozenset()
+
+    def get_sections_structure(self, doc) -> dict:
+        self.table_texts = frozenset(cell.text.strip() for table in doc.tables for row in table.rows
+                                     for cell in row.cells)
+        return super().get_sections_structure(doc)
+
+    def fill_tree(self, sections: dict):
+        for heading, text in sections.items():
+            max_ratio = 0
+            text_parent = None
+            for section, ratio in self.__iter_similarities(heading):
+                if ratio >= max_ratio:
+                    max_ratio = ratio
+                    text_parent = section
+            if text_parent is not None:
+                text_parent.text = text.strip()
+
+    def is_heading(self, p_text: str) -> bool:
+        return any(ratio >= configs.MIN_SIMILARITY_RATIO for _, ratio in self.__iter_similarities(p_text))
+
+    def is_table_element(self, paragraph: Paragraph, doc) -> bool:
+        return paragraph.text.strip() in self.table_texts
+
+    def __iter_similarities(self, text: str) -> Iterator[Tuple[object, float]]:
+        # the cosine similarity of the token sets, the way :py:meth:`LanguageProcessor.strings_similarity` does it
+        tokens = self.tokens.get(text)
+        if tokens is None:
+            tokens = self.tokens[text] = frozenset(self.nlp.tokenize(text))
+        for section, leaf_tokens in self.leaves:
+            if not tokens or not leaf_tokens:
+                yield section, 0.0
+            else:
+                yield section, len(tokens & leaf_tokens) / float((len(tokens) * len(leaf_tokens)) ** 0.5)
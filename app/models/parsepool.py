@@ -0,0 +1,200 @@
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Dict, Optional, Tuple, Union
+
+import docx
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.errors import BusyException, TimeoutException
+from app.models.metrics import metrics
+from app.models.parseplan import ParsePlan
+from app.models.parserwrapper import ParserWrapper
+from app.models.registry import models
+from app.models.templatecache import CompiledTemplate
+
+# uploads larger than this are passed to the workers by the paths of temporary files instead of their contents
+# (it is the size of the spooled buffer of the uploads, larger uploads are already written to the disk)
+INLINE_SIZE = 1024 * 1024
+
+# parse plans of the worker process cached by template ids and versions
+_worker_plans: Dict[Tuple[str, str], ParsePlan] = OrderedDict()
+_worker_plans_size = 16
+
+
+def _init_worker(plans_size: int):
+    global _worker_plans_size
+    _worker_plans_size = plans_size
+
+
+def _get_plan(template_id: str, version: str, template: dict) -> ParsePlan:
+    # templates changed in the database bypassing the API get new versions
+    key = (template_id, version)
+    plan = _worker_plans.get(key)
+    if plan is None:
+        # the language processor (and its dictionaries) is shared by the plans of all templates
+        plan = models.compile_template(template)
+        _worker_plans[key] = plan
+        while len(_worker_plans) > _worker_plans_size:
+            _worker_plans.popitem(last=False)
+    _worker_plans.move_to_end(key)
+    return plan
+
+
+def _parse_docx(template_id: str, version: str, template: dict, source: Union[bytes, str]) -> dict:
+    # parsing fills the sections tree, so every document gets a fresh parser
+    parser = _get_plan(template_id, version, template).create_parser()
+    return parser.get_sections_structure(docx.Document(source if isinstance(source, str) else io.BytesIO(source)))
+
+
+def _spool(file: BinaryIO) -> str:
+    # the upload is copied to a named file in chunks, so it is neither read into memory nor pickled
+    with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as spooled:
+        file.seek(0)
+        shutil.copyfileobj(file, spooled)
+    return spooled.name
+
+
+def _remove(source: Union[bytes, str]):
+    if isinstance(source, str):
+        try:
+            os.remove(source)
+        except OSError:
+            pass
+
+
+class DocxParsePool:
+    """
+    Pool of worker processes parsing .docx documents, so the event loop is not blocked by parsing.
+
+    The number of documents that are queued or being parsed is limited: when the limit is reached,
+    new documents are rejected instead of waiting. Parse plans are cached by template versions in every worker.
+    Uploads larger than :py:data:`INLINE_SIZE` are passed to the workers as temporary files, smaller ones
+    are passed in memory.
+
+    The timeout covers the time the document waits in the queue of the pool as well: it is the time the client
+    waits for the result (the queue is at most `max_pending` documents long).
+    """
+
+    def __init__(self, workers: int, max_pending: int, timeout: Optional[float] = None, parsers_size: int = 16):
+        """
+        :param workers: number of worker processes.
+        :param max_pending: maximal number of documents that are queued or being parsed.
+        :param timeout: maximal time in seconds to wait for a document to be queued and parsed.
+        :param parsers_size: number of template parse plans cached in every worker.
+        """
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(parsers_size,))
+        self.slots = BoundedSemaphore(max_pending)
+        self.timeout = timeout
+        # events of the batches waiting for free slots (with their event loops), they are set on every release
+        self.waiters: Dict[asyncio.Event, asyncio.AbstractEventLoop] = {}
+        self.lock = Lock()
+
+    async def parse(self, template: CompiledTemplate, file: UploadFile, max_size: Optional[int] = None) -> dict:
+        """
+        Parses the uploaded .docx document according to the section template in a worker process.
+
+        :param template: the section template according to which sections are extracted from the uploaded file.
+        :param file: the file uploaded by the user.
+        :param max_size: maximal size of the uploaded file in bytes.
+        :return: the structure of the sections of the uploaded file.
+        """
+        ParserWrapper.check_file_size(file.file, max_size)
+        if not self.slots.acquire(blocking=False):
+            raise BusyException('too many documents are being parsed, try again later')
+
+        source: Union[bytes, str] = b''
+        try:
+            file.file.seek(0, os.SEEK_END)
+            if file.file.tell() > INLINE_SIZE:
+                source = await run_in_threadpool(_spool, file.file)
+            else:
+                await file.seek(0)
+                source = await file.read()
+            future = self.executor.submit(_parse_docx, template.id, template.version, template.structure, source)
+        except BaseException:
+            self.slots.release()
+            _remove(source)
+            raise
+        # the slot is released (and the file is removed) when the worker is really done,
+        # even if the client stopped waiting
+        future.add_done_callback(lambda _: self.__release(source))
+
+        try:
+            with metrics.timer('parse_docx'):
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException(f'document parsing takes more than {self.timeout} seconds')
+
+    async def parse_many(self, template: CompiledTemplate, files: AsyncIterable[Tuple[str, bytes]]
+                         ) -> AsyncIterator[Tuple[str, Optional[dict], Optional[str]]]:
+        """
+        Parses many .docx documents according to the same section template in parallel and yields the results
+        as soon as they are ready. Instead of being rejected, documents wait for free pool slots.
+
+        :param template: the section template according to which sections are extracted from the files.
+        :param files: pairs of file names and contents.
+        :return: async iterator of triples (file name, structure, error).
+        """
+        pending: Dict[asyncio.Future, str] = {}
+
+        async def collect():
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results = []
+            for future in done:
+                name = pending.pop(future)
+                if isinstance(future.exception(), asyncio.TimeoutError):
+                    results.append((name, None, f'document parsing takes more than {self.timeout} seconds'))
+                elif future.exception() is not None:
+                    results.append((name, None, str(future.exception())))
+                else:
+                    results.append((name, future.result(), None))
+            return results
+
+        async for name, content in files:
+            while not self.slots.acquire(blocking=False):
+                if not pending:
+                    # the slots are taken by other requests
+                    await self.__acquire()
+                    break
+                for result in await collect():
+                    yield result
+            future = self.executor.submit(_parse_docx, template.id, template.version, template.structure, content)
+            future.add_done_callback(lambda _: self.__release(content))
+            pending[asyncio.ensure_future(asyncio.wait_for(asyncio.wrap_future(future), self.timeout))] = name
+        while pending:
+            for result in await collect():
+                yield result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    async def __acquire(self):
+        # waits for a free slot without polling, the event is registered before the slot is tried,
+        # so a slot released meanwhile is not missed
+        event = asyncio.Event()
+        with self.lock:
+            self.waiters[event] = asyncio.get_running_loop()
+        try:
+            while not self.slots.acquire(blocking=False):
+                await event.wait()
+                event.clear()
+        finally:
+            with self.lock:
+                del self.waiters[event]
+
+    def __release(self, source: Union[bytes, str]):
+        # it is called by the threads of the executor
+        self.slots.release()
+        _remove(source)
+        with self.lock:
+            waiters = list(self.waiters.items())
+        for event, loop in waiters:
+            loop.call_soon_threadsafe(event.set)
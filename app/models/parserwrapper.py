@@ -1,10 +1,20 @@
+import io
 import os
-from threading import Timer
+from collections import Counter
 
+import docx
 from fastapi import File, UploadFile
-from srsparser import Parser, LanguageProcessor, SectionsTree
-from typing import List, Optional, Tuple, Dict
-import numpy
+from srsparser import LanguageProcessor, SectionsTree
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional, Dict, BinaryIO, Callable, Iterator, Tuple
+
+from app.errors import SizeException
+from app.models.metrics import metrics
+from app.models.parseplan import ParsePlan
+from app.models.registry import ModelRegistry, models
+
+# path of a section in the structure: indexes of the children on the way from the root
+Path = Tuple[int, ...]
 
 
 class ParserWrapper:
@@ -12,96 +22,321 @@ class ParserWrapper:
     Wrapper for the :py:class:`Parser` class.
     """
 
-    def __init__(self):
-        # initialization of a class containing natural language processing methods
-        self.langproc = LanguageProcessor()
+    def __init__(self, registry: Optional[ModelRegistry] = None):
+        # the class containing natural language processing methods is shared through the registry
+        self.registry = registry or models
+
+    @property
+    def langproc(self) -> LanguageProcessor:
+        return self.registry.get_language_processor()
 
-    async def parse_docx_by_template(self, template: dict, file: UploadFile = File(...)) -> dict:
+    async def parse_docx_by_template(self, template: dict, file: UploadFile = File(...),
+                                     max_size: Optional[int] = None, plan: Optional[ParsePlan] = None) -> dict:
         """
         Reads .docx document and returns sections tree structure filled according to the section template and document
         content.
 
+        The uploaded file is read from its spooled buffer directly, no copies and temporary files are made.
+        The parsing is CPU-bound, so it runs in the threadpool instead of blocking the event loop.
+
         :param template: the section template according to which sections are extracted from the uploaded file.
         :param file: the file uploaded by the user.
+        :param max_size: maximal size of the uploaded file in bytes.
+        :param plan: the compiled section template (it is compiled for the document if it is not set).
         :return: the structure of the sections of the uploaded file.
         """
-        contents = await file.read()
-        self.save_file(file.filename, contents)
+        self.check_file_size(file.file, max_size)
+        await file.seek(0)
+        return await run_in_threadpool(self.parse_docx, template, file.file, plan)
+
+    def compile_template(self, template: dict) -> ParsePlan:
+        """
+        Returns the parse plan of the section template (see :py:class:`ParsePlan`).
+        """
+        return self.registry.compile_template(template)
+
+    def parse_docx(self, template: dict, file: BinaryIO, plan: Optional[ParsePlan] = None) -> dict:
+        """
+        Reads .docx document from the file-like object and returns sections tree structure filled according to
+        the section template and document content.
+        """
         try:
-            parser = Parser(template)
-            document_structure = parser.parse_docx(f'./app/{file.filename}')
-            os.remove(f'./app/{file.filename}')
-            return document_structure
+            parser = (plan or self.compile_template(template)).create_parser()
+            with metrics.timer('parse_docx'):
+                return parser.get_sections_structure(docx.Document(file))
         except Exception as ex:
-            os.remove(f'./app/{file.filename}')
             raise Exception(str(ex))
 
     @staticmethod
-    def save_document_as_docx(name: str, structure: Dict) -> str:
-        try:
-            Parser.save_as_docx(structure, name)
-            return f'./{name}.docx'
-        except Exception as ex:
-            raise Exception(str(ex))
+    def check_file_size(file: BinaryIO, max_size: Optional[int] = None):
+        """
+        Checks that the file does not exceed `max_size` bytes.
 
-    def extract_tf_idf_pairs(self, documents: List[dict], document_name: str,
-                             section_name: Optional[str] = None) -> List[List[Tuple[str, numpy.float64]]]:
+        :param file: file-like object.
+        :param max_size: maximal size of the file in bytes.
         """
-        Extracts TF-IDF pairs from a document. The required document is searched by `document_name` among all documents.
+        if max_size is None:
+            return
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+        if size > max_size:
+            raise SizeException(f'file size {size} exceeds the limit of {max_size} bytes')
 
-        :param documents: a collection of documents with a template structure.
-        :param document_name: The name of the document from which the TF-IDF pairs will be extracted.
-        :param section_name: the name of a specific section of the structure.
-        :return: TF-IDF pair list for the document.
+    @staticmethod
+    def render_docx(structure: Dict) -> bytes:
         """
-        if section_name:
-            return self.langproc.get_structure_tf_idf_pairs(documents, document_name, section_name)
-        return self.langproc.get_structure_tf_idf_pairs(documents, document_name)
+        Converts the section structure into a Word document (.docx file) in memory
+        (the same way as `save_as_docx` from :py:class:`Parser`, which writes the file to the disk).
+
+        :param structure: section structure.
+        :return: contents of the .docx file.
+        """
+        with metrics.timer('render_docx'):
+            tree = SectionsTree(structure)
+            document = docx.Document()
+            for section in tree.get_all_sections():
+                document.add_heading(section.name, level=section.depth)
+                if hasattr(section, 'text'):
+                    document.add_paragraph(section.text)
+            buffer = io.BytesIO()
+            document.save(buffer)
+            return buffer.getvalue()
 
-    def extract_keywords(self, documents: List[dict], document_name: str,
-                         section_name: Optional[str] = None) -> List[str]:
+    def extract_keywords(self, structure: dict, section_name: Optional[str] = None) -> List[str]:
         """
-        Extracts keywords from a document. The required document is searched by `document_name` among all documents.
+        Extracts keywords from a document structure.
 
-        :param documents: a collection of documents with a template structure.
-        :param document_name: the name of the document from which the keywords will be extracted.
+        :param structure: section structure of the document.
         :param section_name: the name of a specific section of the structure.
         :return: keyword list.
         """
-        if section_name:
-            return self.langproc.get_structure_keywords_pullenti(documents, document_name, section_name)
-        return self.langproc.get_structure_keywords_pullenti(documents, document_name)
+        return self.langproc.get_keywords_pullenti(self.get_content(structure, section_name))
 
-    def extract_rationized_keywords(self, documents: List[dict], document_name: str,
-                                    section_name: Optional[str] = None) -> List[List[Tuple[str, numpy.float64]]]:
+    def extract_rationized_keywords(self, structure: dict, tf_idf_pairs: List[List],
+                                    section_name: Optional[str] = None) -> List[List]:
         """
-        Extracts TF-IDF keyword pairs from a document. The required document is searched by `document_name`
-        among all documents.
+        Extracts keywords from a document structure and matches them with TF-IDF weights of the same structure
+        (see `get_structure_rationized_keywords` from :py:class:`LanguageProcessor`).
 
-        :param documents: a collection of documents with a template structure.
-        :param document_name: The name of the document from which the rationized keywords will be extracted.
+        :param structure: section structure of the document.
+        :param tf_idf_pairs: TF-IDF pairs of the document (section).
         :param section_name: the name of a specific section of the structure.
-        :return: TF-IDF keyword pair list for the document.
+        :return: list of pairs "keyword-ratio".
         """
-        if section_name:
-            return self.langproc.get_structure_rationized_keywords(documents, document_name, section_name)
-        return self.langproc.get_structure_rationized_keywords(documents, document_name)
+        weights = {term: weight for term, weight in tf_idf_pairs}
+
+        keywords_with_ratios = []
+        for keyword in self.extract_keywords(structure, section_name):
+            keyphrase_words = keyword.split()
+            if len(keyphrase_words) > 1:  # phrase
+                tf_idf_sum = sum(weights.get(self.langproc.get_normal_form(word), 0.0) for word in keyphrase_words)
+                if tf_idf_sum > 0:
+                    keywords_with_ratios.append([keyword, tf_idf_sum])
+            else:  # word
+                normal_word = self.langproc.get_normal_form(keyword)
+                if normal_word in weights:
+                    keywords_with_ratios.append([keyword, weights[normal_word]])
+        keywords_with_ratios.sort(key=lambda item: item[1], reverse=True)
+        return keywords_with_ratios
+
+    def get_term_vectors(self, structure: dict) -> Dict[str, Counter]:
+        """
+        Returns term vectors (lemma -> number of occurrences) of the whole structure (under the empty name)
+        and of each of its sections. Every leaf section is tokenized only once.
+
+        :param structure: section structure.
+        :return: dictionary containing pairs like "section name" — "term vector".
+        """
+        vectors = self.get_section_vectors(structure)
+
+        # as in `SectionsTree.get_content`, the first section with the given name is used
+        result: Dict[str, Counter] = {'': vectors[()]}
+        for path, section in self.iter_sections(structure):
+            result.setdefault(section['name'], vectors[path])
+        return result
+
+    def get_keyword_vector(self, keywords: List) -> Counter:
+        """
+        Returns the term vector of the document keywords.
+
+        :param keywords: keywords as they are stored: strings or pairs "keyword-ratio" (or TF-IDF pairs).
+        :return: term vector (lemma -> number of occurrences).
+        """
+        vector = Counter()
+        for keyword in keywords:
+            vector.update(self.langproc.tokenize(keyword if isinstance(keyword, str) else str(keyword[0])))
+        return vector
+
+    def get_section_vectors(self, structure: dict, path: Path = ()) -> Dict[Path, Counter]:
+        """
+        Returns term vectors of the structure (subtree) and of each of its sections by their paths.
+
+        :param structure: section structure (or a subtree of it).
+        :param path: the path of the subtree root in the whole structure.
+        :return: dictionary containing pairs like "section path" — "term vector".
+        """
+        vectors: Dict[Path, Counter] = {}
+
+        def vectorize(section: dict, section_path: Path) -> Counter:
+            if 'text' in section:
+                vector = Counter(self.langproc.tokenize(section['text']))
+            else:
+                vector = Counter()
+                for index, child in enumerate(section.get('children', [])):
+                    vector.update(vectorize(child, section_path + (index,)))
+            vectors[section_path] = vector
+            return vector
+
+        vectorize(structure, path)
+        return vectors
+
+    def update_term_vectors(self, sections: Dict[str, Dict[str, int]], skeleton: dict, path: Path,
+                            old_section: dict, new_section: dict,
+                            get_vector: Callable[[Path], Counter]) -> Dict[str, Counter]:
+        """
+        Returns term vectors of the structure (see :py:meth:`get_term_vectors`) after the section at `path`
+        is replaced, tokenizing only the old and the new section instead of the whole structure.
+
+        :param sections: term vectors of the structure before the replacement.
+        :param skeleton: the structure before the replacement, section texts may be omitted.
+            The skeleton is changed in place, so it matches the new structure.
+        :param path: the path of the replaced section.
+        :param old_section: the replaced section.
+        :param new_section: the section replacing it.
+        :param get_vector: function returning the term vector of an unchanged section by its path, called only
+            when the section becomes the first one with its name.
+        :return: dictionary containing pairs like "section name" — "term vector".
+        """
+        old_first = self.__get_first_paths(skeleton)
+        self.get_section(skeleton, path[:-1])['children'][path[-1]] = new_section
+        new_first = self.__get_first_paths(skeleton)
+
+        old_vector = self.get_section_vectors(old_section, path)[path]
+        new_vectors = self.get_section_vectors(new_section, path)
+        new_vector = new_vectors[path]
+
+        def replace(terms: Dict[str, int]) -> Counter:
+            # the ancestors of the section contain it, so only its own contribution is replaced
+            vector = Counter(terms)
+            vector.subtract(old_vector)
+            vector.update(new_vector)
+            return Counter({term: count for term, count in vector.items() if count > 0})
+
+        result: Dict[str, Counter] = {'': replace(sections.get('', {}))}
+        for name, section_path in new_first.items():
+            if section_path[:len(path)] == path:
+                result[name] = new_vectors[section_path]
+            elif section_path == path[:len(section_path)]:
+                result[name] = replace(sections.get(name, {}))
+            elif old_first.get(name) == section_path:
+                result[name] = Counter(sections.get(name, {}))
+            else:
+                # the first section with this name was in the replaced subtree
+                result[name] = get_vector(section_path)
+        return result
+
+    @staticmethod
+    def get_section_index(structure: dict, path: Path = ()) -> List[Dict]:
+        """
+        Returns the flattened section index of the structure: the sections in the pre-order with their names,
+        paths, depths and lengths (the number of characters of the section texts, including the nested sections).
+
+        :param structure: section structure (or a subtree of it).
+        :param path: the path of the subtree root in the whole structure.
+        :return: list of the section index entries.
+        """
+        index: List[Dict] = []
+
+        def visit(section: dict, section_path: Path) -> int:
+            entry = {'name': section['name'], 'path': list(section_path), 'depth': len(section_path),
+                     'length': len(section.get('text', ''))}
+            index.append(entry)
+            for child_index, child in enumerate(section.get('children', [])):
+                entry['length'] += visit(child, section_path + (child_index,))
+            return entry['length']
+
+        visit(structure, path)
+        return index
 
     @staticmethod
-    def save_file(filename: str, data):
-        with open(os.path.join('app', filename), 'wb') as f:
-            f.write(data)
+    def update_section_index(index: List[Dict], path: Path, section: dict) -> List[Dict]:
+        """
+        Returns the section index (see :py:meth:`get_section_index`) after the section at `path` is replaced.
+
+        :param index: the section index before the replacement.
+        :param path: the path of the replaced section.
+        :param section: the section replacing it.
+        :return: new section index.
+        """
+        # the subtree occupies a contiguous range of the pre-order
+        start = next(position for position, entry in enumerate(index) if entry['path'] == list(path))
+        end = start + 1
+        while end < len(index) and index[end]['path'][:len(path)] == list(path):
+            end += 1
+
+        subtree = ParserWrapper.get_section_index(section, path)
+        delta = subtree[0]['length'] - index[start]['length']
+        result = [dict(entry) for entry in index[:start]] + subtree + index[end:]
+        for entry in result[:start]:
+            if entry['path'] == list(path[:len(entry['path'])]):
+                entry['length'] += delta
+        return result
 
     @staticmethod
-    def get_section_names(structure: dict) -> List[str]:
+    def iter_sections(structure: dict, path: Path = ()) -> Iterator[Tuple[Path, dict]]:
         """
-        Returns the names of the sections that make up the structure.
+        Iterates over the sections of the structure in the pre-order (as :py:class:`SectionsTree` does).
 
         :param structure: section structure.
-        :return: section name list.
+        :param path: the path of the structure root.
+        :return: iterator of pairs (section path, section), the path is a tuple of child indexes.
         """
-        section_tree = SectionsTree(structure)
-        return section_tree.get_section_names()
+        yield path, structure
+        for index, child in enumerate(structure.get('children', [])):
+            yield from ParserWrapper.iter_sections(child, path + (index,))
+
+    @staticmethod
+    def find_section_path(index: List[Dict], section_name: str) -> Optional[Path]:
+        """
+        Returns the path of the first section with the name in the section index (see :py:meth:`get_section_index`)
+        or None if there is no such section.
+        """
+        return next((tuple(entry['path']) for entry in index if entry['name'] == section_name), None)
+
+    @staticmethod
+    def get_section(structure: dict, path: Path) -> Optional[dict]:
+        """
+        Returns the section of the structure by its path or None if there is no such section.
+        """
+        section = structure
+        for index in path:
+            children = section.get('children', [])
+            if not 0 <= index < len(children):
+                return None
+            section = children[index]
+        return section
+
+    @staticmethod
+    def __get_first_paths(structure: dict) -> Dict[str, Path]:
+        paths: Dict[str, Path] = {}
+        for path, section in ParserWrapper.iter_sections(structure):
+            paths.setdefault(section['name'], path)
+        return paths
+
+    @staticmethod
+    def get_content(structure: dict, section_name: Optional[str] = None) -> str:
+        """
+        Returns text content of the structure (or of its section).
+
+        :param structure: section structure.
+        :param section_name: the name of a specific section of the structure.
+        :return: leaf section texts joined together.
+        """
+        if section_name:
+            return SectionsTree(structure).get_content(section_name)
+        # the same as `SectionsTree.get_content` without looking the root up by its name
+        return '. '.join(section['text'] for _, section in ParserWrapper.iter_sections(structure) if 'text' in section)
 
     @staticmethod
     def is_valid(structure: dict) -> bool:
@@ -116,11 +351,3 @@ class ParserWrapper:
             return section_tree.validate()
         except AssertionError:
             return False
-
-    def clean_document(self, file_path: str):
-        timer = Timer(60, self.__clean_document, [file_path])
-        timer.start()
-
-    @staticmethod
-    def __clean_document(file_path: str):
-        os.remove(file_path)
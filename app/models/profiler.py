@@ -0,0 +1,252 @@
+import asyncio
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from io import StringIO
+from typing import Dict, Iterator, Optional, Tuple
+
+from app.errors import StateException
+
+# function of a stack frame: (file name, first line number, function name), the way pstats identifies functions
+Function = Tuple[str, int, str]
+
+# functions threads wait in while they are idle (waiting for work or for events), their samples are dropped
+IDLE_FUNCTIONS = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+    ('connection.py', 'wait'),
+}
+
+
+class Profile:
+    """
+    Stack samples collected by :py:class:`SamplingProfiler`.
+
+    The samples can be exported as folded stacks (the input of flamegraph.pl, speedscope and similar tools)
+    or as pstats statistics. Sampling does not count calls, so the call counts of the pstats statistics are
+    the numbers of samples the functions were seen in, and the times are estimated as the numbers of samples
+    multiplied by the sampling interval.
+    """
+
+    def __init__(self, interval: float):
+        """
+        :param interval: sampling interval in seconds (the time a sample stands for).
+        """
+        self.interval = interval
+        # numbers of samples by stacks (from the outermost frame to the innermost one)
+        self.samples: Counter = Counter()
+        self.duration = 0.0
+        self.requests = 0
+        self.stats: Dict = {}
+
+    def add(self, stack: Tuple[Function, ...]):
+        self.samples[stack] += 1
+
+    def to_collapsed(self) -> str:
+        """
+        Returns the samples as folded stacks: a line per stack with semicolon-separated frames and the number
+        of samples.
+        """
+        lines = []
+        for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+            frames = ';'.join(f'{name} ({os.path.basename(filename)}:{line})'.replace(';', ':')
+                              for filename, line, name in stack)
+            lines.append(f'{frames} {count}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def create_stats(self):
+        """
+        Fills `stats` in the format of :py:class:`cProfile.Profile`, so the profile can be loaded by
+        :py:class:`pstats.Stats`.
+        """
+        stats: Dict[Function, list] = {}
+        for stack, count in self.samples.items():
+            seconds = count * self.interval
+            # recursive functions are counted once per sample
+            for function in set(stack):
+                entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+                entry[0] += count
+                entry[1] += count
+                entry[3] += seconds
+            stats[stack[-1]][2] += seconds
+            for caller, callee in set(zip(stack, stack[1:])):
+                callers = stats[callee][4]
+                calls, primitive_calls, own_time, cumulative_time = callers.get(caller, (0, 0, 0.0, 0.0))
+                own = seconds if callee == stack[-1] and caller == stack[-2] else 0.0
+                callers[caller] = (calls + count, primitive_calls + count, own_time + own, cumulative_time + seconds)
+        self.stats = {function: (calls, primitive_calls, own_time, cumulative_time, callers)
+                      for function, (calls, primitive_calls, own_time, cumulative_time, callers) in stats.items()}
+
+    def to_pstats(self) -> bytes:
+        """
+        Returns the statistics in the binary format of :py:meth:`pstats.Stats.dump_stats`.
+        """
+        self.create_stats()
+        return marshal.dumps(self.stats)
+
+    def to_text(self, limit: int = 50) -> str:
+        """
+        Returns the report of :py:meth:`pstats.Stats.print_stats` sorted by the cumulative time.
+
+        :param limit: number of the functions in the report.
+        """
+        stream = StringIO()
+        if self.samples:
+            pstats.Stats(self, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+
+class _Session:
+    def __init__(self, profile: Profile, route: Optional[str], requests: int):
+        self.profile = profile
+        self.route = route
+        self.requests = requests
+        self.in_flight = 0
+        self.done = threading.Event()
+
+
+class SamplingProfiler:
+    """
+    Sampling profiler for the diagnosis of the running service.
+
+    The thread running a session takes the stacks of all other threads of the process (except the idle ones)
+    at a fixed interval, so the profiled code is not instrumented and the overhead does not depend on the number
+    of calls.
+    A session samples either for a time window or until the given number of requests to a route are processed,
+    in which case samples are taken only while requests to the route are in flight (requests to other routes
+    processed at the same time are sampled as well). Only one session runs at a time, and only the process
+    that serves the profiling request is profiled: files parsed by the parse pool and keyword jobs run in worker
+    processes and are not sampled (with `PARSE_WORKERS=0` files are parsed in the service process and their
+    parsing is profiled as well).
+    """
+
+    def __init__(self):
+        self.session: Optional[_Session] = None
+        self.lock = threading.Lock()
+
+    def profile(self, seconds: Optional[float] = None, route: Optional[str] = None, requests: int = 1,
+                timeout: float = 60, interval: float = 0.005) -> Profile:
+        """
+        Samples the stacks for a time window or for the next requests to a route and returns the profile.
+
+        :param seconds: duration of the time window (if `route` is not set).
+        :param route: the path template of the route whose requests are profiled.
+        :param requests: number of the profiled requests.
+        :param timeout: maximal time to wait for the requests in seconds, the profile is returned as is
+            when it expires.
+        :param interval: sampling interval in seconds.
+        """
+        return self.__run(self.__start(route, requests, interval), seconds if route is None else timeout)
+
+    async def profile_async(self, seconds: Optional[float] = None, route: Optional[str] = None, requests: int = 1,
+                            timeout: float = 60, interval: float = 0.005) -> Profile:
+        """
+        The same as :py:meth:`profile`, but the stacks are sampled by a thread of its own, so the session does not
+        hold a thread of the pool running the synchronous routes while it waits, and the event loop is sampled
+        as well. The session is stopped if the awaiting task is cancelled.
+        """
+        session = self.__start(route, requests, interval)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(error: Optional[BaseException]):
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(session.profile)
+
+        def run():
+            try:
+                self.__run(session, seconds if route is None else timeout)
+                loop.call_soon_threadsafe(resolve, None)
+            except BaseException as ex:
+                loop.call_soon_threadsafe(resolve, ex)
+
+        threading.Thread(target=run, name='profiler', daemon=True).start()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            session.done.set()
+            raise
+
+    def __start(self, route: Optional[str], requests: int, interval: float) -> _Session:
+        session = _Session(Profile(interval), route, requests)
+        with self.lock:
+            if self.session is not None:
+                raise StateException('profiling session is already running')
+            self.session = session
+        return session
+
+    def __run(self, session: _Session, duration: float) -> Profile:
+        profile = session.profile
+        interval = profile.interval
+        try:
+            start = time.perf_counter()
+            deadline = start + duration
+            ident = threading.get_ident()
+            ticks, sampled = 0, 0.0
+            while not session.done.is_set() and time.perf_counter() < deadline:
+                tick = time.perf_counter()
+                if session.route is None or session.in_flight > 0:
+                    self.__sample(profile, ident)
+                    session.done.wait(interval)
+                    ticks, sampled = ticks + 1, sampled + time.perf_counter() - tick
+                else:
+                    session.done.wait(interval)
+            profile.duration = time.perf_counter() - start
+            # sampling itself takes time, so the actual interval is longer than the requested one
+            if ticks:
+                profile.interval = sampled / ticks
+            return profile
+        finally:
+            with self.lock:
+                self.session = None
+
+    @contextmanager
+    def track(self, route: str) -> Iterator[None]:
+        """
+        Marks the request to the route processed within the context, so that the running session profiling
+        the route samples while it is in flight.
+        """
+        session = self.session
+        if session is None or session.route != route:
+            yield
+            return
+        with self.lock:
+            session.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                session.in_flight -= 1
+                session.profile.requests += 1
+                if session.profile.requests >= session.requests:
+                    session.done.set()
+
+    @staticmethod
+    def __sample(profile: Profile, ident: int):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == ident:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FUNCTIONS:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            profile.add(tuple(reversed(stack)))
+
+
+profiler = SamplingProfiler()
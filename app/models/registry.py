@@ -0,0 +1,68 @@
+import gc
+from threading import Lock
+from typing import Optional
+
+from pullenti.Sdk import Sdk
+from srsparser import LanguageProcessor
+
+from app.models.parseplan import ParsePlan
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of the natural language processing models.
+
+    The models (pymorphy2 dictionaries of :py:class:`LanguageProcessor` and the pullenti SDK) are loaded once,
+    on the first use or by :py:meth:`warm_up`, and shared by all the users in the process.
+    When the models are preloaded before worker processes are forked, the workers share their read-only pages
+    copy-on-write instead of loading them again.
+    """
+
+    def __init__(self):
+        self.langproc: Optional[LanguageProcessor] = None
+        self.pullenti = False
+        self.lock = Lock()
+
+    def get_language_processor(self, pullenti: bool = True) -> LanguageProcessor:
+        """
+        Returns the shared language processor.
+
+        :param pullenti: whether the pullenti SDK is required (it is initialized on demand).
+        """
+        if self.langproc is None or (pullenti and not self.pullenti):
+            with self.lock:
+                if self.langproc is None:
+                    self.langproc = LanguageProcessor(init_pullenti=False)
+                if pullenti and not self.pullenti:
+                    Sdk.initialize_all()
+                    self.pullenti = True
+        return self.langproc
+
+    def compile_template(self, template: dict) -> ParsePlan:
+        """
+        Returns the parse plan of the section template, its parsers use the shared language processor.
+        """
+        return ParsePlan(template, self.get_language_processor(pullenti=False))
+
+    def is_ready(self) -> bool:
+        return self.langproc is not None and self.pullenti
+
+    def warm_up(self):
+        """
+        Loads all the models and runs them once, so that the first request does not pay for the initialization.
+        """
+        langproc = self.get_language_processor()
+        langproc.tokenize('Система предназначена для учета документов')
+        langproc.get_keywords_pullenti('Система предназначена для учета документов')
+
+    def preload(self):
+        """
+        Warms the models up before worker processes are forked and moves all the objects loaded so far
+        to the permanent generation, so the garbage collector does not touch (and copy) the shared pages.
+        """
+        self.warm_up()
+        gc.collect()
+        gc.freeze()
+
+
+models = ModelRegistry()
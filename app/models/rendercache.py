@@ -0,0 +1,56 @@
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+
+class RenderCache:
+    """
+    LRU cache of documents rendered as .docx files.
+
+    Entries are keyed by the document id and a hash of its structure, so an updated document is rendered again.
+    The cache is bounded by the total size of the rendered files.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param max_bytes: maximal total size of the cached files in bytes.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: Dict[Tuple[str, str], bytes] = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def make_key(document_id: str, structure: dict) -> Tuple[str, str]:
+        """
+        Returns the cache key for the document and its structure.
+        """
+        dump = json.dumps(structure, ensure_ascii=False, sort_keys=True)
+        return document_id, hashlib.sha256(dump.encode('utf-8')).hexdigest()
+
+    def get(self, key: Tuple[str, str]) -> Optional[bytes]:
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+            return content
+
+    def put(self, key: Tuple[str, str], content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
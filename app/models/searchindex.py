@@ -0,0 +1,255 @@
+import heapq
+import math
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+TEXT = 'text'
+KEYWORDS = 'keywords'
+
+
+class SearchIndex:
+    """
+    Inverted index of lemmatized document texts and keywords ranked by BM25.
+
+    For every term the index stores postings: the documents containing it with the number of occurrences
+    in the whole structure and in each of its sections (or in the document keywords). Lengths of the documents
+    and of their sections, as well as the corpus statistics BM25 needs, are kept next to the postings and
+    updated with every change of a document, so a query reads only the postings of its terms.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, postings: Collection, documents: Collection, statistics: Collection):
+        """
+        :param postings: collection with postings (a term, a field and a document).
+        :param documents: collection with lengths of the indexed documents.
+        :param statistics: collection with the number of documents and their total length per field and section.
+        """
+        self.postings = postings
+        self.documents = documents
+        self.statistics = statistics
+
+    def ensure_indexes(self):
+        self.postings.create_index([('term', ASCENDING), ('field', ASCENDING), ('templateId', ASCENDING)])
+        self.postings.create_index([('documentId', ASCENDING)])
+
+    def add(self, document_id: str, template_id: str, sections: Dict[str, Counter], keywords: Counter):
+        """
+        Adds the document to the index.
+
+        :param document_id: string representation of the document object id.
+        :param template_id: the id of the template the document is created according to.
+        :param sections: term vectors of the document sections (see :py:meth:`ParserWrapper.get_term_vectors`).
+        :param keywords: term vector of the document keywords (see :py:meth:`ParserWrapper.get_keyword_vector`).
+        """
+        self.add_many([(document_id, template_id, sections, keywords)])
+
+    def add_many(self, documents: List[Tuple[str, str, Dict[str, Counter], Counter]]):
+        """
+        Adds several documents to the index with a single insert of their postings.
+
+        :param documents: quadruples (document id, template id, section term vectors, keyword term vector).
+        """
+        postings, entries = [], []
+        statistics: Dict[str, List[int]] = {}
+        for document_id, template_id, sections, keywords in documents:
+            object_id = ObjectId(document_id)
+            postings += self.__get_text_postings(object_id, template_id, sections)
+            postings += self.__get_keyword_postings(object_id, template_id, keywords)
+            entry = {'_id': object_id, 'templateId': template_id, 'sections': self.__get_lengths(sections),
+                     'keywords': sum(keywords.values())}
+            entries.append(entry)
+            self.__count(statistics, entry, 1)
+
+        if postings:
+            self.postings.insert_many(postings)
+        if entries:
+            self.documents.insert_many(entries)
+        self.__inc_statistics(statistics)
+
+    def update_text(self, document_id: str, sections: Dict[str, Counter]):
+        """
+        Replaces the postings of the document text. Documents that are not indexed are skipped.
+        """
+        object_id = ObjectId(document_id)
+        entry = self.documents.find_one({'_id': object_id})
+        if entry is None:
+            return
+
+        statistics: Dict[str, List[int]] = {}
+        self.__count(statistics, {'sections': entry['sections']}, -1)
+        entry['sections'] = self.__get_lengths(sections)
+        self.__count(statistics, {'sections': entry['sections']}, 1)
+
+        self.postings.delete_many({'documentId': object_id, 'field': TEXT})
+        postings = self.__get_text_postings(object_id, entry['templateId'], sections)
+        if postings:
+            self.postings.insert_many(postings)
+        self.documents.update_one({'_id': object_id}, {'$set': {'sections': entry['sections']}})
+        self.__inc_statistics(statistics)
+
+    def update_keywords(self, document_id: str, keywords: Counter):
+        """
+        Replaces the postings of the document keywords. Documents that are not indexed are skipped.
+        """
+        object_id = ObjectId(document_id)
+        entry = self.documents.find_one({'_id': object_id})
+        if entry is None:
+            return
+
+        length = sum(keywords.values())
+        self.postings.delete_many({'documentId': object_id, 'field': KEYWORDS})
+        postings = self.__get_keyword_postings(object_id, entry['templateId'], keywords)
+        if postings:
+            self.postings.insert_many(postings)
+        self.documents.update_one({'_id': object_id}, {'$set': {'keywords': length}})
+        self.__inc_statistics({KEYWORDS: [0, length - entry['keywords']]})
+
+    def remove(self, document_id: str):
+        """
+        Removes the document from the index.
+        """
+        object_id = ObjectId(document_id)
+        entry = self.documents.find_one_and_delete({'_id': object_id})
+        if entry is None:
+            return
+
+        self.postings.delete_many({'documentId': object_id})
+        statistics: Dict[str, List[int]] = {}
+        self.__count(statistics, entry, -1)
+        self.__inc_statistics(statistics)
+
+    def rebuild(self, documents: Iterable[Tuple[str, str, Dict[str, Counter], Counter]], batch_size: int = 100):
+        """
+        Drops the index and builds it again from scratch.
+
+        :param documents: quadruples (document id, template id, section term vectors, keyword term vector).
+        :param batch_size: number of documents added with a single insert.
+        """
+        self.postings.delete_many({})
+        self.documents.delete_many({})
+        self.statistics.delete_many({})
+
+        documents = iter(documents)
+        for batch in iter(lambda: list(islice(documents, batch_size)), []):
+            self.add_many(batch)
+
+    def count(self) -> int:
+        """
+        Returns the number of indexed documents.
+        """
+        return self.documents.estimated_document_count()
+
+    def contains(self, document_id: str) -> bool:
+        """
+        Checks whether the document is indexed.
+        """
+        return self.documents.find_one({'_id': ObjectId(document_id)}, {'_id': 1}) is not None
+
+    def search(self, terms: List[str], section_name: Optional[str] = None, template_id: Optional[str] = None,
+               fields: Iterable[str] = (TEXT, KEYWORDS), limit: int = 10) -> List[Tuple[str, float]]:
+        """
+        Finds the documents containing the terms and ranks them by BM25 (the scores of the fields are summed up).
+
+        :param terms: lemmatized query terms.
+        :param section_name: search the text of this section only.
+        :param template_id: search the documents created according to this template only.
+        :param fields: fields to search (`text` and `keywords`).
+        :param limit: maximal number of the found documents.
+        :return: pairs of string representations of the document object ids and their scores, best first.
+        """
+        terms = list(set(terms))
+        scores: Dict[ObjectId, float] = Counter()
+        for field in fields:
+            section = section_name if field == TEXT else None
+            statistics = self.statistics.find_one({'_id': self.__get_statistics_key(field, section or '')})
+            if not terms or statistics is None or statistics['documents'] <= 0:
+                continue
+            documents_count = statistics['documents']
+            average_length = statistics['length'] / documents_count or 1
+
+            query = {'term': {'$in': terms}, 'field': field}
+            if section:
+                query['sections.name'] = section
+            # document frequencies are counted over the whole corpus, so the template filter is applied after
+            frequencies = Counter()
+            postings = []
+            for posting in self.postings.find(query, {'term': 1, 'documentId': 1, 'templateId': 1, 'tf': 1,
+                                                      'sections': 1}):
+                frequencies[posting['term']] += 1
+                if template_id is None or posting['templateId'] == template_id:
+                    tf = posting['tf']
+                    if section:
+                        tf = next(item['tf'] for item in posting['sections'] if item['name'] == section)
+                    postings.append((posting['documentId'], posting['term'], tf))
+
+            lengths = self.__get_document_lengths(list({document_id for document_id, _, _ in postings}), field,
+                                                  section)
+            for document_id, term, tf in postings:
+                frequency = frequencies[term]
+                idf = math.log(1 + (documents_count - frequency + 0.5) / (frequency + 0.5))
+                norm = tf + self.K1 * (1 - self.B + self.B * lengths.get(document_id, 0) / average_length)
+                scores[document_id] += idf * tf * (self.K1 + 1) / norm
+
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return [(str(document_id), round(score, 6)) for document_id, score in best]
+
+    def __get_document_lengths(self, document_ids: List[ObjectId], field: str,
+                               section_name: Optional[str]) -> Dict[ObjectId, int]:
+        lengths = {}
+        for entry in self.documents.find({'_id': {'$in': document_ids}}):
+            if field == KEYWORDS:
+                lengths[entry['_id']] = entry['keywords']
+            else:
+                lengths[entry['_id']] = next((item['length'] for item in entry['sections']
+                                              if item['name'] == (section_name or '')), 0)
+        return lengths
+
+    @staticmethod
+    def __get_text_postings(document_id: ObjectId, template_id: str, sections: Dict[str, Counter]) -> List[dict]:
+        # every term of a section is a term of the whole structure (the empty name)
+        postings = {term: {'term': term, 'field': TEXT, 'documentId': document_id, 'templateId': template_id,
+                           'tf': count, 'sections': []} for term, count in sections.get('', {}).items()}
+        for name, terms in sections.items():
+            if name == '':
+                continue
+            for term, count in terms.items():
+                postings[term]['sections'].append({'name': name, 'tf': count})
+        return list(postings.values())
+
+    @staticmethod
+    def __get_keyword_postings(document_id: ObjectId, template_id: str, keywords: Counter) -> List[dict]:
+        return [{'term': term, 'field': KEYWORDS, 'documentId': document_id, 'templateId': template_id, 'tf': count}
+                for term, count in keywords.items()]
+
+    @staticmethod
+    def __get_lengths(sections: Dict[str, Counter]) -> List[dict]:
+        # section names may contain dots and dollar signs, so they are not used as keys
+        return [{'name': name, 'length': sum(terms.values())} for name, terms in sections.items()]
+
+    @staticmethod
+    def __get_statistics_key(field: str, section_name: str = '') -> str:
+        return f'{TEXT}:{section_name}' if field == TEXT else KEYWORDS
+
+    @staticmethod
+    def __count(statistics: Dict[str, List[int]], entry: dict, sign: int):
+        for section in entry.get('sections', []):
+            counts = statistics.setdefault(SearchIndex.__get_statistics_key(TEXT, section['name']), [0, 0])
+            counts[0] += sign
+            counts[1] += sign * section['length']
+        if 'keywords' in entry:
+            counts = statistics.setdefault(KEYWORDS, [0, 0])
+            counts[0] += sign
+            counts[1] += sign * entry['keywords']
+
+    def __inc_statistics(self, statistics: Dict[str, List[int]]):
+        for key, (documents, length) in statistics.items():
+            if documents or length:
+                self.statistics.update_one({'_id': key}, {'$inc': {'documents': documents, 'length': length}},
+                                           upsert=True)
@@ -0,0 +1,235 @@
+import math
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+
+class SimilarityIndex:
+    """
+    In-memory sparse matrix of TF-IDF vectors of the corpus (or of a section of its documents) used to find
+    the documents most similar to a given one by cosine similarity.
+
+    The vectors are weighted with the `ntc` scheme of :py:class:`CorpusIndex` and normalized, so cosine similarity
+    is a dot product. Exact lookups multiply the query by the matrix in batches of rows. Approximate lookups use
+    an inverted file index built on the first use: the documents are clustered by spherical k-means (about a square
+    root of the number of documents clusters) and the query is compared only with the documents of the clusters
+    whose centroids are the closest to it, so a lookup reads far fewer rows than there are documents. Further
+    clusters are probed in the order of their similarity while fewer than k similar documents are found, so an
+    approximate lookup returns as many results as the exact one.
+    """
+
+    def __init__(self, document_ids: List[str], vocabulary: Dict[str, int], idf: np.ndarray,
+                 matrix: sparse.csr_matrix, revision: int = 0):
+        """
+        :param document_ids: string representations of the document object ids (rows of the matrix).
+        :param vocabulary: columns of the matrix by terms.
+        :param idf: inverse document frequencies of the terms by columns.
+        :param matrix: normalized TF-IDF vectors of the documents.
+        :param revision: corpus revision the index is built for.
+        """
+        self.document_ids = document_ids
+        self.rows = {document_id: row for row, document_id in enumerate(document_ids)}
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = matrix
+        self.revision = revision
+        self.centroids: Optional[sparse.csr_matrix] = None
+        self.clusters: List[np.ndarray] = []
+        self.lock = Lock()
+
+    @classmethod
+    def build(cls, documents: Iterable[Tuple[str, Dict[str, int]]], frequencies: Dict[str, int],
+              documents_count: int, revision: int = 0) -> 'SimilarityIndex':
+        """
+        Builds the index.
+
+        :param documents: pairs of string representations of the document object ids and their term vectors
+            (see :py:meth:`CorpusIndex.iter_terms`).
+        :param frequencies: document frequencies of the terms.
+        :param documents_count: total number of documents in the corpus.
+        :param revision: corpus revision.
+        """
+        vocabulary = {term: column for column, term in enumerate(sorted(
+            term for term, frequency in frequencies.items() if frequency > 0))}
+        idf = np.zeros(len(vocabulary))
+        for term, column in vocabulary.items():
+            idf[column] = math.log2((documents_count + 1) / frequencies[term])
+
+        document_ids, rows, columns, values = [], [], [], []
+        for row, (document_id, terms) in enumerate(documents):
+            document_ids.append(document_id)
+            for term, count in terms.items():
+                column = vocabulary.get(term)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    values.append(count)
+        matrix = sparse.csr_matrix((values, (rows, columns)), shape=(len(document_ids), len(vocabulary)),
+                                   dtype=np.float64)
+        return cls(document_ids, vocabulary, idf, cls.__normalize(matrix.multiply(idf).tocsr()), revision)
+
+    def vectorize(self, vectors: List[Dict[str, int]]) -> sparse.csr_matrix:
+        """
+        Returns normalized TF-IDF vectors of the term vectors weighted with the statistics of the index.
+        """
+        rows, columns, values = [], [], []
+        for row, terms in enumerate(vectors):
+            for term, count in terms.items():
+                column = self.vocabulary.get(term)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    values.append(count)
+        matrix = sparse.csr_matrix((values, (rows, columns)), shape=(len(vectors), len(self.vocabulary)),
+                                   dtype=np.float64)
+        return self.__normalize(matrix.multiply(self.idf).tocsr())
+
+    def most_similar(self, queries: sparse.csr_matrix, k: int = 10, exclude: Optional[List[Optional[str]]] = None,
+                     approximate: bool = False, batch_size: int = 4096) -> List[List[Tuple[str, float]]]:
+        """
+        Finds the documents most similar to each of the queries.
+
+        :param queries: normalized TF-IDF vectors (see :py:meth:`vectorize`).
+        :param k: number of the documents to find for each query.
+        :param exclude: the document excluded from the results of each query (usually the query itself).
+        :param approximate: compare the queries only with the documents of the closest clusters.
+        :param batch_size: number of matrix rows multiplied at once in the exact mode.
+        :return: pairs of document ids and similarities for each query, most similar first.
+        """
+        exclude = exclude or [None] * queries.shape[0]
+        if approximate:
+            self.__ensure_clusters()
+            return [self.__search_clusters(queries[row], k, excluded) for row, excluded in enumerate(exclude)]
+
+        best_rows = [np.empty(0, dtype=np.int64) for _ in range(queries.shape[0])]
+        best_scores = [np.empty(0) for _ in range(queries.shape[0])]
+        for start in range(0, self.matrix.shape[0], batch_size):
+            block = (queries @ self.matrix[start:start + batch_size].T).toarray()
+            for query, scores in enumerate(block):
+                # only the best k (and the excluded document) of every batch can make it to the results
+                top = np.argpartition(-scores, min(k, len(scores) - 1))[:k + 1]
+                best_rows[query] = np.concatenate([best_rows[query], top + start])
+                best_scores[query] = np.concatenate([best_scores[query], scores[top]])
+        return [self.__top(rows, scores, k, excluded)
+                for rows, scores, excluded in zip(best_rows, best_scores, exclude)]
+
+    def __top(self, rows: np.ndarray, scores: np.ndarray, k: int,
+              excluded: Optional[str] = None) -> List[Tuple[str, float]]:
+        excluded_row = self.rows.get(excluded)
+        order = np.lexsort((rows, -scores))
+        result = []
+        for position in order:
+            if len(result) == k:
+                break
+            if scores[position] <= 0 or rows[position] == excluded_row:
+                continue
+            result.append((self.document_ids[rows[position]], round(float(scores[position]), 6)))
+        return result
+
+    def __ensure_clusters(self, iterations: int = 5, max_terms: int = 256, seed: int = 0):
+        with self.lock:
+            if self.centroids is not None:
+                return
+            rows = self.matrix.shape[0]
+            clusters = max(1, int(math.sqrt(rows)))
+            random = np.random.default_rng(seed)
+            centroids = self.matrix[random.choice(rows, clusters, replace=False)] if rows else self.matrix
+            for _ in range(iterations):
+                members = sparse.csr_matrix((np.ones(rows), (self.__assign(centroids), np.arange(rows))),
+                                            shape=(clusters, rows))
+                # centroids are kept sparse: only their heaviest terms are left
+                centroids = self.__normalize(self.__prune(members @ self.matrix, max_terms))
+
+            assignment = self.__assign(centroids)
+            order = np.argsort(assignment, kind='stable')
+            bounds = np.searchsorted(assignment[order], np.arange(clusters + 1))
+            self.clusters = [order[bounds[cluster]:bounds[cluster + 1]] for cluster in range(clusters)]
+            self.centroids = centroids
+
+    def __assign(self, centroids: sparse.csr_matrix, batch_size: int = 4096) -> np.ndarray:
+        assignment = [np.asarray((self.matrix[start:start + batch_size] @ centroids.T).toarray().argmax(axis=1))
+                      for start in range(0, self.matrix.shape[0], batch_size)]
+        return np.concatenate(assignment).ravel() if assignment else np.empty(0, dtype=np.int64)
+
+    def __search_clusters(self, query: sparse.csr_matrix, k: int,
+                          excluded: Optional[str] = None) -> List[Tuple[str, float]]:
+        similarities = (query @ self.centroids.T).toarray().ravel()
+        probes = max(1, round(math.sqrt(len(self.clusters))))
+        excluded_row = self.rows.get(excluded)
+        rows, scores, found = [], [], 0
+        for position, cluster in enumerate(np.argsort(-similarities, kind='stable')):
+            # the closest clusters are always probed, the next closest ones are added while there are fewer than k
+            # similar candidates; when all of them are probed, the lookup is the exact scan
+            if position >= probes and found >= k:
+                break
+            members = self.clusters[cluster]
+            member_scores = (self.matrix[members] @ query.T).toarray().ravel()
+            rows.append(members)
+            scores.append(member_scores)
+            found += int(np.count_nonzero((member_scores > 0) & (members != excluded_row)))
+        if not rows:
+            return []
+        return self.__top(np.concatenate(rows), np.concatenate(scores), k, excluded)
+
+    @staticmethod
+    def __prune(matrix: sparse.csr_matrix, max_terms: int) -> sparse.csr_matrix:
+        matrix = sparse.csr_matrix(matrix)
+        for row in range(matrix.shape[0]):
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            if end - start > max_terms:
+                values = matrix.data[start:end]
+                values[np.argpartition(values, end - start - max_terms)[:end - start - max_terms]] = 0
+        matrix.eliminate_zeros()
+        return matrix
+
+    @staticmethod
+    def __normalize(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.csr_matrix(matrix.multiply(1 / norms[:, np.newaxis]))
+
+
+class SimilarityIndexCache:
+    """
+    Cache of similarity indexes of the corpus sections.
+
+    An index is rebuilt when the corpus has changed more than `tolerance` of its documents since it was built,
+    so the indexes of a frequently changing corpus are not rebuilt on every lookup.
+    """
+
+    def __init__(self, size: int = 4, tolerance: float = 0.05):
+        """
+        :param size: maximal number of the cached indexes.
+        :param tolerance: share of corpus changes after which an index is rebuilt.
+        """
+        self.size = size
+        self.tolerance = tolerance
+        self.indexes: Dict[str, SimilarityIndex] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, section_name: str, revision: int, documents_count: int,
+            build: Callable[[], SimilarityIndex]) -> SimilarityIndex:
+        """
+        Returns the index of the section building it if it is missing or stale.
+
+        :param section_name: the name of the section (the empty name stands for the whole structure).
+        :param revision: current corpus revision.
+        :param documents_count: current number of documents in the corpus.
+        :param build: function building the index.
+        """
+        with self.lock:
+            index = self.indexes.get(section_name)
+            if index is None or revision - index.revision > self.tolerance * documents_count:
+                index = build()
+                self.indexes[section_name] = index
+            self.indexes.move_to_end(section_name)
+            while len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+            return index
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
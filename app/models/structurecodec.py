@@ -0,0 +1,122 @@
+import json
+import zlib
+from typing import Dict, List, Optional
+
+from bson.binary import Binary
+
+PLAIN = 'plain'
+COMPACT = 'compact'
+
+# fields of the stored documents holding the structure in the plain and in the compact format
+STRUCTURE_FIELDS = {PLAIN: 'structure', COMPACT: 'tree'}
+
+
+class StructureCodec:
+    """
+    Storage format of the document structures.
+
+    In the plain format a structure is stored as the nested section dictionary. In the compact format it is
+    stored as a flat tree: section names and numbers of children in the pre-order (-1 marks leaf sections)
+    and the texts of the leaf sections compressed with zlib into a single binary field. Repeated keys of
+    the nested dictionaries disappear and texts of specifications take several times less space, so less
+    data is stored and transferred, and the skeleton of the tree can be read without the texts.
+
+    Documents in both formats are decoded transparently, so the format can be switched and the stored
+    documents can be migrated while the service runs. Structures the compact format cannot represent
+    (sections with other fields or texts that are not strings) are always stored in the plain format.
+    """
+
+    def __init__(self, storage_format: str = PLAIN, level: int = 6):
+        """
+        :param storage_format: format new structures are stored in (`plain` or `compact`).
+        :param level: zlib compression level of the section texts.
+        """
+        if storage_format not in STRUCTURE_FIELDS:
+            raise ValueError(f'unknown storage format {storage_format}')
+        self.storage_format = storage_format
+        self.level = level
+
+    @property
+    def field(self) -> str:
+        """
+        The field holding the structures stored in the current format.
+        """
+        return STRUCTURE_FIELDS[self.storage_format]
+
+    def encode(self, structure: Dict) -> Dict:
+        """
+        Returns the fields of the stored document holding the structure.
+        """
+        if self.storage_format == COMPACT:
+            tree = self.encode_tree(structure, self.level)
+            if tree is not None:
+                return {STRUCTURE_FIELDS[COMPACT]: tree}
+        return {STRUCTURE_FIELDS[PLAIN]: structure}
+
+    def get_unset_fields(self, fields: Dict) -> Dict:
+        """
+        Returns the `$unset` operand removing the structure stored in the other format than `fields`.
+        """
+        return {field: '' for field in STRUCTURE_FIELDS.values() if field not in fields}
+
+    @staticmethod
+    def decode(document: Dict) -> Optional[Dict]:
+        """
+        Returns the structure of the stored document in any format (None if it is not read).
+        """
+        tree = document.get(STRUCTURE_FIELDS[COMPACT])
+        if tree is not None:
+            return StructureCodec.decode_tree(tree)
+        return document.get(STRUCTURE_FIELDS[PLAIN])
+
+    @staticmethod
+    def encode_tree(structure: Dict, level: int = 6) -> Optional[Dict]:
+        """
+        Returns the compact tree of the structure or None if the structure cannot be represented by it.
+        """
+        names: List[str] = []
+        children: List[int] = []
+        texts: List[str] = []
+        stack = [structure]
+        while stack:
+            section = stack.pop()
+            if not isinstance(section, dict) or not isinstance(section.get('name'), str):
+                return None
+            if section.keys() == {'name', 'text'} and isinstance(section['text'], str):
+                children.append(-1)
+                texts.append(section['text'])
+            elif section.keys() == {'name', 'children'} and isinstance(section['children'], list):
+                children.append(len(section['children']))
+                stack.extend(reversed(section['children']))
+            else:
+                return None
+            names.append(section['name'])
+        content = json.dumps(texts, ensure_ascii=False).encode('utf-8')
+        return {'names': names, 'children': children, 'texts': Binary(zlib.compress(content, level))}
+
+    @staticmethod
+    def decode_tree(tree: Dict) -> Dict:
+        """
+        Returns the structure of the compact tree. Leaf sections of a tree read without texts
+        (see :py:data:`SKELETON_PROJECTION`) have no texts.
+        """
+        texts = iter(json.loads(zlib.decompress(tree['texts']).decode('utf-8'))) if 'texts' in tree else None
+        root = None
+        # lists of children of the sections being filled and the numbers of their children left
+        stack: List[list] = []
+        for name, count in zip(tree['names'], tree['children']):
+            if count < 0:
+                section = {'name': name, 'text': next(texts)} if texts is not None else {'name': name}
+            else:
+                section = {'name': name, 'children': []}
+            if stack:
+                parent = stack[-1]
+                parent[0].append(section)
+                parent[1] -= 1
+                if not parent[1]:
+                    stack.pop()
+            else:
+                root = section
+            if count > 0:
+                stack.append([section['children'], count])
+        return root
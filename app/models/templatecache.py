@@ -0,0 +1,111 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from app.models.parseplan import ParsePlan
+from app.models.parserwrapper import ParserWrapper
+from app.schemas.schema import Template
+
+
+class CompiledTemplate:
+    """
+    Section template with its version (a hash of the structure) and its parse plan, which is compiled
+    on the first parse in the process.
+    """
+
+    def __init__(self, template: Template):
+        self.template = template
+        self.id = template.id
+        self.structure: dict = template.structure[0]
+        dump = json.dumps(self.structure, ensure_ascii=False, sort_keys=True)
+        self.version = hashlib.sha256(dump.encode('utf-8')).hexdigest()
+        self.plan: Optional[ParsePlan] = None
+
+    def get_plan(self, parser: ParserWrapper) -> ParsePlan:
+        if self.plan is None:
+            self.plan = parser.compile_template(self.structure)
+        return self.plan
+
+
+class TemplateCache:
+    """
+    LRU cache of the compiled section templates keyed by template ids and versions.
+
+    Templates are read from the database once, and their parse plans are compiled once, instead of on every
+    upload or every created document. Created and deleted templates are invalidated by :py:class:`Database`,
+    templates that are not found are not cached (so new templates are visible at once), and entries expire after
+    `ttl` seconds, so templates changed bypassing the API are read again. A template read again with the same
+    version revalidates its entry and keeps the compiled parse plan, a new version replaces the entry.
+    """
+
+    def __init__(self, size: int = 64, ttl: int = 60):
+        """
+        :param size: maximal number of cached templates.
+        :param ttl: lifetime of the entries in seconds.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.entries: Dict[Tuple[str, str], dict] = OrderedDict()
+        # the current version of every cached template
+        self.versions: Dict[str, str] = {}
+        self.lock = Lock()
+        self.statistics = {'hits': 0, 'misses': 0, 'revalidations': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, template_id: str) -> Optional[CompiledTemplate]:
+        """
+        Returns the current version of the template or None if it is not cached or its entry has expired.
+        """
+        with self.lock:
+            version = self.versions.get(template_id)
+            entry = self.entries.get((template_id, version)) if version is not None else None
+            if entry is None or entry['expires'] < time.monotonic():
+                self.statistics['misses'] += 1
+                return None
+            self.entries.move_to_end((template_id, version))
+            self.statistics['hits'] += 1
+            return entry['value']
+
+    def put(self, template: CompiledTemplate) -> CompiledTemplate:
+        """
+        Caches the template read from the database as the current version of the template.
+
+        :return: the cached template of the same version if there is one (its entry is revalidated),
+            otherwise the given template.
+        """
+        key = (template.id, template.version)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.statistics['revalidations'] += 1
+                template = entry['value']
+            else:
+                self.__remove(template.id)
+            self.entries[key] = {'value': template, 'expires': time.monotonic() + self.ttl}
+            self.entries.move_to_end(key)
+            self.versions[template.id] = template.version
+            while len(self.entries) > self.size:
+                (template_id, _), _ = self.entries.popitem(last=False)
+                del self.versions[template_id]
+                self.statistics['evictions'] += 1
+            return template
+
+    def invalidate(self, template_id: str):
+        with self.lock:
+            if self.__remove(template_id):
+                self.statistics['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.versions.clear()
+
+    def get_statistics(self) -> Dict[str, int]:
+        with self.lock:
+            return {'size': len(self.entries), **self.statistics}
+
+    def __remove(self, template_id: str) -> bool:
+        version = self.versions.pop(template_id, None)
+        return version is not None and self.entries.pop((template_id, version), None) is not None
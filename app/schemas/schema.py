@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 from enum import Enum
 
 
@@ -38,3 +38,66 @@ class KeywordExtractionMode(str, Enum):
     pullenti = 'pullenti'
     tf_idf = 'tf_idf'
     combine = 'combine'
+
+
+class KeywordGenerationBatch(BaseModel):
+    # list of document ids or 'all'
+    documents: Union[List[str], str] = 'all'
+    mode: KeywordExtractionMode
+    sectionName: Optional[str] = None
+
+
+class JobStatus(str, Enum):
+    pending = 'pending'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class KeywordJob(BaseModel):
+    id: str
+    documentId: str
+    mode: KeywordExtractionMode
+    sectionName: Optional[str] = None
+    save: bool = False
+    status: JobStatus
+    error: Optional[str] = None
+
+
+class CacheStatistics(BaseModel):
+    size: int
+    hits: int
+    persistentHits: int
+    misses: int
+    stale: int
+    evictions: int
+    invalidations: int
+
+
+class SearchField(str, Enum):
+    text = 'text'
+    keywords = 'keywords'
+    all = 'all'
+
+
+class SearchResult(BaseModel):
+    id: str
+    name: Optional[str] = None
+    templateId: Optional[str] = None
+    score: float
+
+
+class ProfileFormat(str, Enum):
+    # folded stacks for flame graphs
+    collapsed = 'collapsed'
+    # binary pstats statistics
+    pstats = 'pstats'
+    # pstats report sorted by the cumulative time
+    text = 'text'
+
+
+class SimilarDocument(BaseModel):
+    id: str
+    name: Optional[str] = None
+    templateId: Optional[str] = None
+    similarity: float
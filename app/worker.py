@@ -0,0 +1,42 @@
+"""
+Runs the worker refreshing the derived data of the documents changed bypassing the API:
+
+    python -m app.worker
+    python -m app.worker --tenant <name>
+
+The database of the tenant (MONGODB_CONNSTRING by default) must be a replica set (change streams are not available on
+standalone servers). The worker stops on SIGINT or SIGTERM and resumes from the stored resume token on restart.
+"""
+import argparse
+import logging
+import signal
+import sys
+import threading
+from typing import List, Optional
+
+from app import databases, derived_data_options, DEFAULT_TENANT
+from app.models.derivedworker import DerivedDataWorker
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Refreshes the derived data of the documents changed bypassing '
+                                                 'the API.')
+    parser.add_argument('--tenant', default=DEFAULT_TENANT, help='tenant whose documents are watched')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    database = databases.get(args.tenant)
+    # documents created according to a changed template are refreshed as if their templates were changed
+    derived_data_worker = DerivedDataWorker(database, template_listeners=[
+        lambda template_id: database.refresh_template_documents(template_id, derived_data_options['batch_size'])
+    ], **derived_data_options)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    derived_data_worker.run(stop)
+    logging.getLogger(__name__).info('stopped: %s', derived_data_worker.statistics)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import random
+from typing import Iterator, Tuple
+
+# the template of a requirements specification the synthetic documents are created according to
+TEMPLATE = {
+    'name': 'Техническое задание',
+    'children': [
+        {'name': 'Введение', 'children': [
+            {'name': 'Наименование программы', 'text': ''},
+            {'name': 'Краткая характеристика области применения', 'text': ''},
+        ]},
+        {'name': 'Основания для разработки', 'text': ''},
+        {'name': 'Назначение разработки', 'children': [
+            {'name': 'Функциональное назначение', 'text': ''},
+            {'name': 'Эксплуатационное назначение', 'text': ''},
+        ]},
+        {'name': 'Требования к программе', 'children': [
+            {'name': 'Требования к функциональным характеристикам', 'text': ''},
+            {'name': 'Требования к надежности', 'text': ''},
+            {'name': 'Условия эксплуатации', 'text': ''},
+            {'name': 'Требования к составу и параметрам технических средств', 'text': ''},
+        ]},
+        {'name': 'Требования к программной документации', 'text': ''},
+        {'name': 'Стадии и этапы разработки', 'text': ''},
+        {'name': 'Порядок контроля и приемки', 'text': ''},
+    ]
+}
+
+WORDS = (
+    'система программа пользователь документ требование модуль интерфейс данные база сервер клиент отчет запрос '
+    'ответ хранение обработка анализ поиск ключевой слово раздел структура шаблон файл формат загрузка выгрузка '
+    'проверка ошибка сообщение журнал событие доступ роль администратор оператор настройка параметр значение '
+    'время задержка производительность надежность отказ восстановление резервный копия безопасность защита '
+    'шифрование авторизация аутентификация сеть протокол обмен передача прием приемка испытание контроль этап '
+    'стадия разработка внедрение сопровождение документация руководство описание спецификация версия обновление '
+    'должен обеспечивать выполнять поддерживать отображать сохранять формировать передавать принимать проверять '
+    'автоматический ручной основной дополнительный технический программный функциональный эксплуатационный '
+    'текстовый электронный государственный стандарт гост организация предприятие отдел сотрудник специалист'
+).split()
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    """
+    Returns sentences of random words from the vocabulary of requirements specifications.
+    """
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(6, 14))
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + '.')
+        words -= length
+    return ' '.join(sentences)
+
+
+def make_structure(rng: random.Random, template: dict, words: int) -> dict:
+    """
+    Returns the section structure filled according to the template with random texts.
+
+    :param rng: random number generator.
+    :param template: section template.
+    :param words: average number of words of a leaf section.
+    """
+    if 'children' in template:
+        return {'name': template['name'],
+                'children': [make_structure(rng, child, words) for child in template['children']]}
+    return {'name': template['name'], 'text': make_text(rng, rng.randint(words // 2, words * 3 // 2))}
+
+
+def make_documents(count: int, words: int = 60, seed: int = 0, start: int = 0) -> Iterator[Tuple[str, dict]]:
+    """
+    Generates synthetic documents. The same seed and index always give the same document, so a corpus can be
+    grown gradually.
+
+    :param count: number of documents.
+    :param words: average number of words of a leaf section.
+    :param seed: seed of the random number generator.
+    :param start: index of the first document.
+    :return: iterator of pairs (document name, section structure).
+    """
+    for index in range(start, start + count):
+        rng = random.Random(f'{seed}:{index}')
+        yield f'Техническое задание {index}', make_structure(rng, TEMPLATE, words)
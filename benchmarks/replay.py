@@ -0,0 +1,392 @@
+"""
+Load testing by replaying request logs.
+
+A request log is a JSON lines file with a request per line, for example:
+
+    {"route": "parse_file", "method": "POST", "path": "/api/files", "data": {"template_id": "{template_id}"},
+     "files": {"file": 1}, "at": 0.25}
+
+`params`, `json`, `data` and `headers` are passed as is, `files` gives the number of synthetic .docx files
+uploaded in every form field, `at` is the time of the request in seconds from the start of the log (used
+by `--timed`). The placeholders `{template_id}` and `{document_id}` are replaced by the ids of the template
+and of a random document of the corpus, so logs recorded against another database can be replayed.
+
+Logs are either recorded or synthesized from a weighted mix of the routes of :py:data:`SCENARIOS`:
+
+    python -m benchmarks.replay --mix parse_file=1,list_documents=4,download=2 --requests 500 --concurrency 16
+    python -m benchmarks.replay --mix parse_file=1,get_document=9 --requests 1000 --rps 50 --write-log mix.jsonl
+    python -m benchmarks.replay --log mix.jsonl --timed --speed 2
+
+By default the application runs in-process against an in-memory MongoDB stand-in (mongomock) or a local mongod
+(`--mongodb-uri`) and is seeded with a synthetic corpus. All requests share a single event loop, as they do
+in a uvicorn worker, so the lag of the event loop and the usage of the threadpool running the synchronous
+routes are sampled as well: they show when the service saturates because of blocked event loop or exhausted
+threads. With `--url` the requests are sent to a running server that already has documents (only the latency
+and the errors are measured then).
+
+With `--concurrency` the requests are sent by a fixed number of clients, each waiting for its response before
+sending the next request (closed loop). With `--rps` or `--timed` they are sent on schedule regardless of
+the responses (open loop) and latencies are counted from the scheduled time, so a stalled server is not hidden
+by the clients slowing down. The report gives throughput, latency percentiles, statuses and error rates
+per route.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.corpus import TEMPLATE, make_documents
+from benchmarks.run import PERCENTILES, git_revision, reset_database, setup_environment
+
+# synthetic requests by routes, the placeholders are replaced when the requests are sent
+SCENARIOS = {
+    'parse_file': {'method': 'POST', 'path': '/api/files', 'data': {'template_id': '{template_id}'},
+                   'files': {'file': 1}},
+    'parse_batch': {'method': 'POST', 'path': '/api/files/batch', 'data': {'template_id': '{template_id}'},
+                    'files': {'files': 4}},
+    'keywords_pullenti': {'method': 'GET', 'path': '/api/documents/{document_id}/keywords/generation',
+                          'params': {'mode': 'pullenti'}},
+    'keywords_tf_idf': {'method': 'GET', 'path': '/api/documents/{document_id}/keywords/generation',
+                        'params': {'mode': 'tf_idf'}},
+    'keywords_combine': {'method': 'GET', 'path': '/api/documents/{document_id}/keywords/generation',
+                         'params': {'mode': 'combine'}},
+    'keyword_job': {'method': 'POST', 'path': '/api/documents/{document_id}/keywords/jobs',
+                    'params': {'mode': 'pullenti'}},
+    'list_documents': {'method': 'GET', 'path': '/api/documents', 'params': {'short': False, 'limit': 100}},
+    'list_documents_short': {'method': 'GET', 'path': '/api/documents'},
+    'get_document': {'method': 'GET', 'path': '/api/documents/{document_id}'},
+    'search': {'method': 'GET', 'path': '/api/documents/search', 'params': {'query': 'требования к надежности'}},
+    'similar': {'method': 'GET', 'path': '/api/documents/{document_id}/similar'},
+    'download': {'method': 'GET', 'path': '/api/documents/{document_id}/download'},
+}
+
+DEFAULT_MIX = 'parse_file=1,keywords_tf_idf=2,list_documents_short=4,get_document=4,download=2'
+
+# interval of the event loop lag and threadpool samples in seconds
+SAMPLE_INTERVAL = 0.01
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load testing by replaying request logs.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--log', help='request log to replay (JSON lines)')
+    source.add_argument('--mix', default=DEFAULT_MIX,
+                        help='comma-separated weights of the routes of the synthetic log (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests of the synthetic log')
+    parser.add_argument('--write-log', help='file to write the synthetic log to, so it can be replayed later')
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument('--rps', type=float, help='send requests at this rate regardless of the responses')
+    pacing.add_argument('--timed', action='store_true', help='send requests at the times recorded in the log')
+    parser.add_argument('--speed', type=float, default=1.0, help='speed-up of the recorded times (with --timed)')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of clients (without --rps and --timed)')
+    parser.add_argument('--timeout', type=float, default=120, help='timeout of a request in seconds')
+    parser.add_argument('--url', help='base URL of a running server to send requests to (in-process by default)')
+    parser.add_argument('--documents', type=int, default=100, help='size of the synthetic corpus (in-process)')
+    parser.add_argument('--words', type=int, default=60, help='average number of words of a leaf section')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpus and log')
+    parser.add_argument('--mongodb-uri', help='URI of a local mongod to use instead of mongomock (in-process)')
+    parser.add_argument('--drop', action='store_true', help='drop the existing data of the mongod database')
+    parser.add_argument('--parse-workers', type=int,
+                        help='worker processes parsing files (the service default by default, 0 parses in the '
+                             'server process)')
+    parser.add_argument('--output', help='file to write the report to (standard output by default)')
+    return parser.parse_args(args)
+
+
+def make_log(mix: str, requests: int, seed: int = 0, rps: Optional[float] = None) -> List[Dict]:
+    """
+    Returns a synthetic request log with routes drawn with the weights of the mix. Requests are spaced
+    by 1 / `rps` seconds (by 0.1 seconds if the rate is not set).
+    """
+    weights = {}
+    for item in mix.split(','):
+        route, _, weight = item.partition('=')
+        route = route.strip()
+        if route not in SCENARIOS:
+            sys.exit(f'unknown route {route}, known routes: {", ".join(SCENARIOS)}')
+        weights[route] = float(weight or 1)
+    rng = random.Random(f'log:{seed}')
+    routes = rng.choices(list(weights), list(weights.values()), k=requests)
+    step = 1 / rps if rps else 0.1
+    return [{'route': route, **SCENARIOS[route], 'at': round(i * step, 6)} for i, route in enumerate(routes)]
+
+
+def read_log(path: str) -> List[Dict]:
+    with open(path, encoding='utf-8') as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    for entry in entries:
+        entry.setdefault('route', f'{entry.get("method", "GET")} {entry["path"]}')
+    return entries
+
+
+def write_log(path: str, entries: List[Dict]):
+    with open(path, 'w', encoding='utf-8') as file:
+        for entry in entries:
+            file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+class Target:
+    """
+    The ids the placeholders of the requests are replaced with and the content of the uploaded files.
+    """
+
+    def __init__(self, template_id: str, document_ids: List[str], docx_content: bytes, seed: int = 0):
+        self.template_id = template_id
+        self.document_ids = document_ids
+        self.docx_content = docx_content
+        self.rng = random.Random(f'target:{seed}')
+
+    def prepare(self, entry: Dict) -> Dict:
+        """
+        Returns the keyword arguments of :py:meth:`httpx.AsyncClient.request` for the log entry.
+        """
+        values = {'template_id': self.template_id,
+                  'document_id': self.rng.choice(self.document_ids) if self.document_ids else ''}
+
+        def substitute(value):
+            if isinstance(value, str):
+                for name, replacement in values.items():
+                    value = value.replace('{' + name + '}', replacement)
+                return value
+            if isinstance(value, dict):
+                return {key: substitute(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [substitute(item) for item in value]
+            return value
+
+        request = {'method': entry.get('method', 'GET'), 'url': substitute(entry['path'])}
+        for field in ('params', 'json', 'data', 'headers'):
+            if field in entry:
+                request[field] = substitute(entry[field])
+        if entry.get('files'):
+            request['files'] = [(field, (f'document{i}.docx', self.docx_content)) for field, count in
+                                entry['files'].items() for i in range(count)]
+        return request
+
+
+class Sampler:
+    """
+    Samples the lag of the event loop and the usage of the threadpool running the synchronous routes
+    (the default thread limiter of anyio) while the requests are replayed in-process.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lags: List[float] = []
+        self.borrowed: List[int] = []
+        self.waiting: List[int] = []
+        self.limit = 0
+
+    async def run(self, stop: asyncio.Event):
+        import anyio.to_thread
+
+        loop = asyncio.get_running_loop()
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        self.limit = int(limiter.total_tokens)
+        while not stop.is_set():
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(loop.time() - start - self.interval, 0.0))
+            statistics = limiter.statistics()
+            self.borrowed.append(statistics.borrowed_tokens)
+            self.waiting.append(statistics.tasks_waiting)
+
+    def report(self) -> Dict:
+        if not self.lags:
+            return {}
+        lags = np.array(self.lags) * 1000
+        return {
+            'event_loop_lag_ms': {'mean': round(float(lags.mean()), 3), 'max': round(float(lags.max()), 3),
+                                  **{f'p{percentile}': round(float(np.percentile(lags, percentile)), 3)
+                                     for percentile in PERCENTILES}},
+            'threadpool': {'limit': self.limit, 'max_busy': max(self.borrowed),
+                           'saturated_share': round(sum(busy >= self.limit for busy in self.borrowed)
+                                                    / len(self.borrowed), 4),
+                           'max_waiting': max(self.waiting)},
+        }
+
+
+async def replay(client, target: Target, entries: List[Dict], concurrency: int, schedule: Optional[List[float]],
+                 timeout: float) -> List[Dict]:
+    """
+    Sends the requests and returns their outcomes: the route, the status (None if the request failed),
+    the error and the latency in seconds.
+
+    :param schedule: times of the requests in seconds from the start (closed loop if it is not set).
+    """
+    outcomes: List[Dict] = []
+
+    async def send(entry: Dict, scheduled: float):
+        outcome = {'route': entry['route'], 'status': None, 'error': None}
+        try:
+            response = await client.request(**target.prepare(entry), timeout=timeout)
+            outcome['status'] = response.status_code
+        except Exception as ex:
+            outcome['error'] = type(ex).__name__
+        outcome['latency'] = time.perf_counter() - scheduled
+        outcomes.append(outcome)
+
+    start = time.perf_counter()
+    if schedule is None:
+        queue = iter(entries)
+
+        async def client_loop():
+            for entry in queue:
+                await send(entry, time.perf_counter())
+
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    else:
+        tasks = []
+        for entry, at in zip(entries, schedule):
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(entry, start + at)))
+        await asyncio.gather(*tasks)
+    return outcomes
+
+
+def summarize(outcomes: List[Dict], elapsed: float) -> Dict:
+    """
+    Returns throughput, latency percentiles (in milliseconds), statuses and error rates by routes and in total.
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for outcome in outcomes:
+        groups.setdefault(outcome['route'], []).append(outcome)
+    groups['total'] = outcomes
+
+    summary = {}
+    for route, items in groups.items():
+        values = np.array([item['latency'] for item in items]) * 1000
+        statuses: Dict[str, int] = {}
+        for item in items:
+            key = str(item['status']) if item['status'] is not None else item['error']
+            statuses[key] = statuses.get(key, 0) + 1
+        errors = sum(item['status'] is None or item['status'] >= 400 for item in items)
+        summary[route] = {
+            'requests': len(items), 'errors': errors, 'error_rate': round(errors / len(items), 4),
+            'throughput_rps': round(len(items) / elapsed, 3), 'statuses': statuses,
+            'latency_ms': {'mean': round(float(values.mean()), 3), 'max': round(float(values.max()), 3),
+                           **{f'p{percentile}': round(float(np.percentile(values, percentile)), 3)
+                              for percentile in PERCENTILES}},
+        }
+    return summary
+
+
+async def run(args: argparse.Namespace, entries: List[Dict]) -> Dict:
+    try:
+        import httpx
+    except ImportError:
+        sys.exit('httpx is required to replay request logs: pip install httpx')
+
+    if args.timed:
+        entries = sorted(entries, key=lambda entry: float(entry.get('at', 0)))
+        schedule = [float(entry.get('at', 0)) / args.speed for entry in entries]
+    elif args.rps:
+        schedule = [i / args.rps for i in range(len(entries))]
+    else:
+        schedule = None
+
+    sampler = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url)
+        template_id, document_ids = await discover(client)
+        # the uploaded file is a document of the server rendered by the server
+        docx_content = (await client.get(f'/api/documents/{document_ids[0]}/download')).content
+    else:
+        from app import db, models
+        from app.main import app
+        from app.schemas.schema import TemplateCreateStructure
+
+        reset_database(args.drop)
+        print('loading models', file=sys.stderr)
+        models.warm_up()
+        db.create_template(TemplateCreateStructure(name='Техническое задание', structure=TEMPLATE))
+        template_id = str(db.templates.find_one({}, {'_id': 1})['_id'])
+        sample = next(make_documents(1, args.words, args.seed + 1))[1]
+        docx_content = db.parser.render_docx(sample)
+        print(f'creating {args.documents} documents', file=sys.stderr)
+        documents = list(make_documents(args.documents, args.words, args.seed))
+        document_ids = []
+        for start in range(0, len(documents), 500):
+            document_ids += db.create_documents(template_id, documents[start:start + 500])
+        await app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
+                                   base_url='http://replay')
+        sampler = Sampler()
+
+    target = Target(template_id, document_ids, docx_content, args.seed)
+    stop = asyncio.Event()
+    sampling = asyncio.ensure_future(sampler.run(stop)) if sampler else None
+    print(f'replaying {len(entries)} requests', file=sys.stderr)
+    start = time.perf_counter()
+    try:
+        outcomes = await replay(client, target, entries, args.concurrency, schedule, args.timeout)
+    finally:
+        elapsed = time.perf_counter() - start
+        stop.set()
+        if sampling:
+            await sampling
+        await client.aclose()
+        if not args.url:
+            await app.router.shutdown()
+    return {'elapsed_s': round(elapsed, 3), 'routes': summarize(outcomes, elapsed),
+            'saturation': sampler.report() if sampler else None}
+
+
+async def discover(client) -> tuple:
+    """
+    Returns the id of a template and the ids of documents of a running server.
+    """
+    templates = (await client.get('/api/templates', params={'limit': 1})).json()['data']
+    documents = (await client.get('/api/documents', params={'limit': 1000})).json()['data']
+    if not templates or not documents:
+        sys.exit('the server has no templates or documents to send requests for')
+    return templates[0]['id'], [document['id'] for document in documents]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.log:
+        entries = read_log(args.log)
+    else:
+        entries = make_log(args.mix, args.requests, args.seed, args.rps)
+        if args.write_log:
+            write_log(args.write_log, entries)
+
+    if not args.url:
+        setup_environment(args)
+    report = asyncio.run(run(args, entries))
+    for route, result in sorted(report['routes'].items(), key=lambda item: item[0] == 'total'):
+        latency = result['latency_ms']
+        print(f'{route:<22} {result["requests"]:>6} req  p50 {latency["p50"]:>9.1f} ms  p99 {latency["p99"]:>9.1f} ms  '
+              f'{result["throughput_rps"]:>8.1f} req/s  errors {result["error_rate"]:>7.2%}', file=sys.stderr)
+    saturation = report['saturation']
+    if saturation:
+        lag, threadpool = saturation['event_loop_lag_ms'], saturation['threadpool']
+        print(f'event loop lag p99 {lag["p99"]:.1f} ms, max {lag["max"]:.1f} ms; threadpool busy up to '
+              f'{threadpool["max_busy"]}/{threadpool["limit"]}, saturated {threadpool["saturated_share"]:.1%} '
+              f'of the time, up to {threadpool["max_waiting"]} waiting', file=sys.stderr)
+
+    report['meta'] = {'revision': git_revision(), 'timestamp': datetime.utcnow().isoformat() + 'Z',
+                      'python': platform.python_version(), 'platform': platform.platform(),
+                      'target': args.url or ('mongod' if args.mongodb_uri else 'mongomock'),
+                      'arguments': vars(args)}
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Benchmarks of the API hot paths.
+
+The application runs in-process (requests are made with the FastAPI test client) against an in-memory MongoDB
+stand-in (mongomock, install it with `pip install mongomock`) or against a local mongod given by `--mongodb-uri`.
+A synthetic corpus of requirements specifications grows through the given sizes and every operation is measured
+at every size. Results are written as JSON, so they can be compared between revisions:
+
+    python -m benchmarks.run --sizes 10,100,1000 --output bench.json
+    python -m benchmarks.run --sizes 10,100,1000 --baseline bench.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import local
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.corpus import TEMPLATE, make_documents
+
+OPERATIONS = ('parse_file', 'keywords_pullenti', 'keywords_tf_idf', 'keywords_combine', 'list_documents',
+              'list_documents_short', 'download')
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks of the API hot paths.')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma-separated corpus sizes the corpus grows through (default: %(default)s)')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma-separated operations to measure (default: all)')
+    parser.add_argument('--requests', type=int, default=20, help='requests per operation and size')
+    parser.add_argument('--warmup', type=int, default=2, help='requests per operation that are not measured')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of concurrent clients')
+    parser.add_argument('--words', type=int, default=60, help='average number of words of a leaf section')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpus')
+    parser.add_argument('--warm-caches', action='store_true',
+                        help='keep keyword and render caches between requests (they are cleared by default)')
+    parser.add_argument('--mongodb-uri', help='URI of a local mongod to use instead of mongomock')
+    parser.add_argument('--drop', action='store_true', help='drop the existing data of the mongod database')
+    parser.add_argument('--parse-workers', type=int,
+                        help='worker processes parsing files (the service default by default, 0 parses in the '
+                             'server process)')
+    parser.add_argument('--output', help='file to write the results to (standard output by default)')
+    parser.add_argument('--baseline', help='results of a previous run to compare median latencies with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative growth of the median latency over the baseline')
+    return parser.parse_args(args)
+
+
+def setup_environment(args: argparse.Namespace):
+    """
+    Configures the application before it is imported (it connects to the database at import time).
+    """
+    os.environ['MONGODB_CONNSTRING'] = args.mongodb_uri or 'mongodb://localhost:27017'
+    # the pools are sized the way the service sizes them unless the benchmark overrides them
+    if args.parse_workers is not None:
+        os.environ['PARSE_WORKERS'] = str(args.parse_workers)
+    if not args.mongodb_uri:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is required to run the benchmarks without mongod: '
+                     'pip install -r requirements-dev.txt')
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+
+def reset_database(drop: bool):
+    """
+    Checks that the database of the default tenant is empty or drops its data (with `drop`), then connects
+    the tenant again through the registry of the service, so it starts with empty caches and indexes.
+    """
+    from app import databases, DEFAULT_TENANT, DATABASE_NAME
+
+    database = databases.get(DEFAULT_TENANT)
+    if database.documents.estimated_document_count() or database.templates.estimated_document_count():
+        if not drop:
+            sys.exit('the database is not empty, use --drop to drop its data')
+    for collection in database.documents.database.list_collection_names():
+        database.documents.database.drop_collection(collection)
+    # the registry closes the client of the tenant and creates a new one the way it is done at startup
+    databases.close()
+    databases.register(DEFAULT_TENANT, os.environ['MONGODB_CONNSTRING'], database_name=DATABASE_NAME)
+
+
+def measure(request: Callable[[object, int], object], make_client: Callable[[], object], requests: int,
+            concurrency: int, prepare: Optional[Callable[[], None]] = None) -> Dict:
+    """
+    Makes the requests and returns latency percentiles (in milliseconds) and throughput.
+
+    :param request: function making the request number `i` with the client.
+    :param make_client: function creating a client for every concurrent worker.
+    :param requests: number of requests.
+    :param concurrency: number of concurrent workers.
+    :param prepare: function called before every request, its time is not measured.
+    """
+    clients = local()
+    latencies: List[float] = []
+    statuses: List[int] = []
+
+    def run(i: int):
+        if not hasattr(clients, 'client'):
+            clients.client = make_client()
+        if prepare:
+            prepare()
+        start = time.perf_counter()
+        response = request(clients.client, i)
+        latencies.append(time.perf_counter() - start)
+        statuses.append(response.status_code)
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(run, range(requests)))
+    else:
+        for i in range(requests):
+            run(i)
+    elapsed = time.perf_counter() - start
+
+    values = np.array(latencies) * 1000
+    result = {'requests': requests, 'errors': sum(status >= 400 for status in statuses), 'concurrency': concurrency,
+              'throughput_rps': round(requests / elapsed, 3),
+              'latency_ms': {'mean': round(float(values.mean()), 3), 'max': round(float(values.max()), 3)}}
+    for percentile in PERCENTILES:
+        result['latency_ms'][f'p{percentile}'] = round(float(np.percentile(values, percentile)), 3)
+    return result
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """
+    Returns descriptions of the operations whose median latency grew more than `tolerance` over the baseline.
+    """
+    previous = {(item['documents'], item['operation']): item for item in baseline}
+    regressions = []
+    for item in results:
+        base = previous.get((item['documents'], item['operation']))
+        if base is None:
+            continue
+        old, new = base['latency_ms']['p50'], item['latency_ms']['p50']
+        if old > 0 and (new - old) / old > tolerance:
+            regressions.append(f'{item["operation"]} at {item["documents"]} documents: '
+                               f'p50 {old:.1f} ms -> {new:.1f} ms')
+    return regressions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    operations = [operation.strip() for operation in args.operations.split(',') if operation.strip()]
+    for operation in operations:
+        if operation not in OPERATIONS:
+            sys.exit(f'unknown operation {operation}, known operations: {", ".join(OPERATIONS)}')
+
+    setup_environment(args)
+    from fastapi.testclient import TestClient
+    from app import db, models, render_cache, keyword_job_workers, parse_workers
+    from app.main import app
+    from app.schemas.schema import TemplateCreateStructure
+
+    reset_database(args.drop)
+
+    print('loading models', file=sys.stderr)
+    models.warm_up()
+    db.create_template(TemplateCreateStructure(name='Техническое задание', structure=TEMPLATE))
+    template_id = str(db.templates.find_one({}, {'_id': 1})['_id'])
+    sample = next(make_documents(1, args.words, args.seed + 1))[1]
+    docx_content = db.parser.render_docx(sample)
+
+    def clear_caches():
+        if not args.warm_caches:
+            db.keyword_cache.clear()
+            render_cache.clear()
+
+    results = []
+    document_ids: List[str] = []
+    with TestClient(app) as client:
+        for size in sizes:
+            print(f'growing the corpus to {size} documents', file=sys.stderr)
+            documents = list(make_documents(size - len(document_ids), args.words, args.seed, len(document_ids)))
+            for start in range(0, len(documents), 500):
+                document_ids += db.create_documents(template_id, documents[start:start + 500])
+            db.corpus_index_checked = db.search_index_checked = False
+
+            requests = {
+                'parse_file': lambda c, i: c.post('/api/files', data={'template_id': template_id}, files={
+                    'file': ('document.docx', docx_content)}),
+                'keywords_pullenti': lambda c, i: c.get(
+                    f'/api/documents/{document_ids[i % size]}/keywords/generation', params={'mode': 'pullenti'}),
+                'keywords_tf_idf': lambda c, i: c.get(
+                    f'/api/documents/{document_ids[i % size]}/keywords/generation', params={'mode': 'tf_idf'}),
+                'keywords_combine': lambda c, i: c.get(
+                    f'/api/documents/{document_ids[i % size]}/keywords/generation', params={'mode': 'combine'}),
+                'list_documents': lambda c, i: c.get('/api/documents', params={'short': False, 'limit': 100}),
+                'list_documents_short': lambda c, i: c.get('/api/documents'),
+                'download': lambda c, i: c.get(f'/api/documents/{document_ids[i % size]}/download'),
+            }
+            for operation in operations:
+                if args.warmup:
+                    measure(requests[operation], lambda: client, args.warmup, 1, clear_caches)
+                # every concurrent worker gets its own client
+                result = measure(requests[operation], lambda: TestClient(app), args.requests, args.concurrency,
+                                 clear_caches)
+                results.append({'documents': size, 'operation': operation, **result})
+                latency = result['latency_ms']
+                print(f'{size:>7} {operation:<22} p50 {latency["p50"]:>9.1f} ms  p99 {latency["p99"]:>9.1f} ms  '
+                      f'{result["throughput_rps"]:>8.1f} req/s  errors {result["errors"]}', file=sys.stderr)
+
+    report = {
+        'meta': {'revision': git_revision(), 'timestamp': datetime.utcnow().isoformat() + 'Z',
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'mongodb': 'mongod' if args.mongodb_uri else 'mongomock', 'arguments': vars(args),
+                 'workers': {'parse': parse_workers, 'keywords': keyword_job_workers}},
+        'results': results
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
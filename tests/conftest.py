@@ -0,0 +1,84 @@
+import os
+import uuid
+from typing import Dict, List
+
+import mongomock
+import pymongo
+import pytest
+
+# the application connects to the database at import time, so the in-memory MongoDB stand-in is installed
+# and the worker pools are turned off before it is imported (test dependencies are in requirements-dev.txt)
+
+os.environ.setdefault('MONGODB_CONNSTRING', 'mongodb://localhost:27017')
+os.environ.setdefault('PARSE_WORKERS', '0')
+os.environ.setdefault('KEYWORD_JOB_WORKERS', '1')
+pymongo.MongoClient = mongomock.MongoClient
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import databases, DEFAULT_TENANT, DATABASE_NAME  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models.database import Database  # noqa: E402
+from app.schemas.schema import DocumentCreateStructure  # noqa: E402
+
+TEMPLATE = {'name': 'root', 'children': [
+    {'name': 'Общие сведения', 'children': [{'name': 'Назначение', 'text': ''}]},
+    {'name': 'Требования', 'text': ''},
+]}
+
+TEXTS = [
+    ('система учета жителей товарищества', 'требования к системе надежность учет'),
+    ('учет платежей жителей', 'система должна работать круглосуточно'),
+    ('справочник квартир система', 'надежность работы системы хранения'),
+]
+
+
+def make_structure(purpose: str, requirements: str) -> Dict:
+    """
+    Returns the structure of a document created according to :py:data:`TEMPLATE`.
+    """
+    return {'name': 'root', 'children': [
+        {'name': 'Общие сведения', 'children': [{'name': 'Назначение', 'text': purpose}]},
+        {'name': 'Требования', 'text': requirements},
+    ]}
+
+
+@pytest.fixture
+def database() -> Database:
+    """
+    Database of the service on a fresh in-memory MongoDB database.
+    """
+    return Database(database=mongomock.MongoClient()[f'test{uuid.uuid4().hex}'])
+
+
+@pytest.fixture
+def template_id(database: Database) -> str:
+    return str(database.templates.insert_one({'name': 'template', 'structure': TEMPLATE}).inserted_id)
+
+
+@pytest.fixture
+def document_ids(database: Database, template_id: str) -> List[str]:
+    """
+    Ids of the documents created from :py:data:`TEXTS` in the order of the texts.
+    """
+    for i, texts in enumerate(TEXTS):
+        assert database.create_document(DocumentCreateStructure(name=f'document{i}', templateId=template_id,
+                                                                structure=[make_structure(*texts)]))
+    return [str(document['_id']) for document in database.documents.find({}, {'_id': 1}).sort('_id')]
+
+
+@pytest.fixture
+def client() -> TestClient:
+    """
+    Client of the service whose default tenant is served from a fresh database with the documents created
+    from :py:data:`TEXTS` through the API.
+    """
+    uri = os.environ['MONGODB_CONNSTRING']
+    database = databases.register(DEFAULT_TENANT, uri, database_name=f'test{uuid.uuid4().hex}')
+    template_id = str(database.templates.insert_one({'name': 'template', 'structure': TEMPLATE}).inserted_id)
+    client = TestClient(app)
+    for i, texts in enumerate(TEXTS):
+        assert client.post('/api/documents', json={'name': f'document{i}', 'templateId': template_id,
+                                                   'structure': [make_structure(*texts)]}).status_code == 200
+    yield client
+    databases.register(DEFAULT_TENANT, uri, database_name=DATABASE_NAME)
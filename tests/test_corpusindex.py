@@ -0,0 +1,103 @@
+from collections import Counter
+
+import pytest
+from bson.objectid import ObjectId
+
+from app.models.corpusindex import CorpusIndex
+from tests.conftest import make_structure
+
+
+def expected_pairs(database, document_id: str, section_name: str = '') -> list:
+    # TF-IDF pairs computed the way srsparser does it, by building the model over the whole collection
+    documents = list(database.documents.find({}))
+    name = next(document['name'] for document in documents if str(document['_id']) == document_id)
+    pairs = database.parser.langproc.get_structure_tf_idf_pairs(documents, name, section_name)
+    return sorted([term, float(weight)] for term, weight in pairs)
+
+
+@pytest.mark.parametrize('section_name', ['', 'Требования', 'Общие сведения', 'Назначение', 'Нет такого'])
+def test_tf_idf_pairs_match_srsparser(database, document_ids, section_name):
+    for document_id in document_ids:
+        assert sorted(database.get_document_tf_idf_pairs(document_id, section_name)) == \
+            expected_pairs(database, document_id, section_name)
+
+
+def test_tf_idf_pairs_follow_updates_and_removals(database, document_ids):
+    database.update_document_structure(document_ids[0], [make_structure('новый текст квартир', 'хранение')])
+    database.delete_document(document_ids[1])
+    for document_id in (document_ids[0], document_ids[2]):
+        assert sorted(database.get_document_tf_idf_pairs(document_id)) == expected_pairs(database, document_id)
+
+
+def test_index_is_rebuilt_when_it_does_not_match_documents(database, document_ids):
+    database.corpus_index.vectors.delete_many({})
+    database.corpus_index.frequencies.delete_many({})
+    database.corpus_index_checked = False
+    assert sorted(database.get_document_tf_idf_pairs(document_ids[1])) == expected_pairs(database, document_ids[1])
+
+
+def test_frequencies_and_revision(database):
+    index = CorpusIndex(database.documents.database['vectors'], database.documents.database['frequencies'])
+    first, second = str(ObjectId()), str(ObjectId())
+    index.add(first, {'': Counter({'a': 2, 'b': 1}), 'x': Counter({'a': 2})})
+    index.add_many([(second, {'': Counter({'b': 3})})])
+    assert index.count() == 2
+    assert index.revision() == 2
+    assert index.get_all_frequencies() == {'a': 1, 'b': 2}
+
+    index.update(first, {'': Counter({'c': 1})})
+    assert index.get_all_frequencies() == {'a': 0, 'b': 1, 'c': 1}
+    assert index.get_all_frequencies('x') == {'a': 0}
+    index.remove(second)
+    assert index.get_all_frequencies() == {'a': 0, 'b': 0, 'c': 1}
+    assert index.revision() == 4
+    assert index.get_terms(first) == {'c': 1}
+    assert index.get_terms(first, 'x') == {}
+    assert index.get_terms(second) is None
+
+
+def test_weigh_normalizes_and_skips_terms_in_every_document():
+    pairs = CorpusIndex.weigh({'a': 1, 'b': 1, 'c': 1}, {'a': 3, 'b': 1, 'c': 2}, 2)
+    assert [term for term, _ in pairs] == ['b', 'c']
+    assert sum(weight ** 2 for _, weight in pairs) == pytest.approx(1, abs=1e-3)
+
+
+class InterleavedVectors:
+    """
+    Vectors collection running a concurrent writer right before the first write of the index.
+    """
+
+    def __init__(self, vectors, writer):
+        self.vectors = vectors
+        self.writer = writer
+
+    def __getattr__(self, name):
+        attribute = getattr(self.vectors, name)
+        if name not in ('update_one', 'find_one_and_replace') or self.writer is None:
+            return attribute
+        writer, self.writer = self.writer, None
+        writer()
+        return attribute
+
+
+def test_concurrent_updates_keep_frequencies_consistent(database):
+    # regression: the old vectors were read before they were replaced, so a concurrent update of the document
+    # in between was followed by the difference from the stale vectors and the document frequencies drifted
+    vectors = database.documents.database['vectors']
+    index = CorpusIndex(vectors, database.documents.database['frequencies'])
+    document_id = str(ObjectId())
+    index.add(document_id, {'': Counter({'a': 1})})
+    index.add(document_id, {'': Counter({'a': 1})})
+    assert index.get_all_frequencies() == {'a': 1}
+
+    index.vectors = InterleavedVectors(vectors, lambda: index.update(document_id, {'': Counter({'b': 1})}))
+    index.update(document_id, {'': Counter({'c': 1}), 'x': Counter({'a': 1})})
+    assert index.get_sections(document_id) == {'': {'c': 1}, 'x': {'a': 1}}
+    assert index.get_all_frequencies() == {'a': 0, 'b': 0, 'c': 1}
+    assert index.get_all_frequencies('x') == {'a': 1}
+    assert index.revision() == 4
+
+    index.vectors = InterleavedVectors(vectors, lambda: index.remove(document_id))
+    index.remove(document_id)
+    assert index.get_all_frequencies() == {'a': 0, 'b': 0, 'c': 0}
+    assert index.revision() == 5
@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+import uuid
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.mongo_client import MongoClient
+
+from app.models.database import Database, INDEX_REVISION
+from app.models.derivedworker import DerivedDataWorker
+from app.schemas.schema import DocumentCreateStructure
+from tests.conftest import make_structure
+
+REPLICA_SET_URI = os.environ.get('TEST_REPLICA_SET_URI', 'mongodb://localhost:27017/?replicaSet=rs0')
+
+
+class FakeChangeStream:
+    """
+    Change stream returning the given events, then reporting it is idle and stopping the worker.
+    """
+
+    def __init__(self, events, stop: threading.Event, reads: list):
+        self.events = list(events)
+        self.stop = stop
+        self.reads = reads
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def try_next(self):
+        self.reads.append(time.monotonic())
+        if not self.events:
+            self.stop.set()
+            return None
+        event = self.events.pop(0)
+        self.resume_token = event['_id']
+        return event
+
+
+def event(number: int, operation: str, document_id, collection: str = 'requirementsSpecifications', **fields):
+    return {'_id': {'_data': f'{number:08d}'}, 'operationType': operation, 'ns': {'coll': collection},
+            'documentKey': {'_id': document_id}, **fields}
+
+
+@pytest.fixture
+def watch(database, monkeypatch):
+    """
+    Replaces the change stream of the database by fake streams returning the given batches of events,
+    returns the options the streams were opened with.
+    """
+    opened = []
+
+    def install(*batches):
+        stop = threading.Event()
+        batches = list(batches)
+        reads = []
+
+        def fake_watch(pipeline, max_await_time_ms=None, **options):
+            opened.append(options)
+            return FakeChangeStream(batches.pop(0) if batches else [], stop, reads)
+
+        monkeypatch.setattr(database.documents.database, 'watch', fake_watch, raising=False)
+        return stop, reads
+
+    install.opened = opened
+    return install
+
+
+def test_external_changes_are_refreshed_in_batches(database, template_id, document_ids, watch, monkeypatch):
+    refreshed = []
+    refresh_documents = database.refresh_documents
+    monkeypatch.setattr(database, 'refresh_documents', lambda changes: refreshed.append(dict(changes)) or
+                        refresh_documents(changes))
+    changed = ObjectId(document_ids[0])
+    database.documents.update_one({'_id': changed}, {'$set': {'keywords': ['учет']}})
+    inserted = database.documents.insert_one({'name': 'external', 'templateId': template_id,
+                                              'structure': make_structure('справочник', 'хранение')}).inserted_id
+    events = [
+        event(1, 'update', changed, updateDescription={'updatedFields': {'keywords': ['учет']}}),
+        # writes of the API are marked with a new revision and skipped
+        event(2, 'update', ObjectId(document_ids[1]), updateDescription={'updatedFields': {INDEX_REVISION: 1}}),
+        event(3, 'insert', inserted, fullDocument={'name': 'external'}),
+        event(4, 'update', changed, updateDescription={'updatedFields': {'structure.children.1.text': 'x'}}),
+        event(5, 'delete', ObjectId(document_ids[2])),
+    ]
+    stop, _ = watch(events)
+    worker = DerivedDataWorker(database, batch_size=2, max_wait=60, workers=1)
+    worker.run(stop)
+
+    assert worker.statistics == {'events': 5, 'skipped': 1, 'batches': 2, 'refreshed': 4, 'failed': 0}
+    # a batch is refreshed when it is full, changes of a document within a batch are coalesced
+    assert refreshed == [{document_ids[0]: {'keywords'}, str(inserted): {'text', 'keywords', 'template'}},
+                         {document_ids[0]: {'text'}, document_ids[2]: {'text', 'keywords', 'template'}}]
+    assert database.corpus_index.get_sections(str(inserted)) is not None
+    assert database.search_index.contains(str(inserted))
+    assert worker.load_token() == ({'_data': '00000005'}, False)
+
+
+def test_worker_resumes_from_stored_token(database, document_ids, watch):
+    stop, _ = watch([event(1, 'update', ObjectId(document_ids[0]),
+                           updateDescription={'updatedFields': {'keywords': []}})])
+    DerivedDataWorker(database, max_wait=60).run(stop)
+    stop, _ = watch([])
+    DerivedDataWorker(database, max_wait=60).run(stop)
+    assert watch.opened == [{'resume_after': None}, {'resume_after': {'_data': '00000001'}}]
+
+    # after an invalidated stream the worker starts after the invalidating event
+    stop, _ = watch([{'_id': {'_data': '00000002'}, 'operationType': 'invalidate'}], [])
+    worker = DerivedDataWorker(database, max_wait=60)
+    worker.run(stop)
+    assert worker.load_token() == ({'_data': '00000002'}, True)
+    assert watch.opened[-1] == {'start_after': {'_data': '00000002'}}
+
+
+def test_refresh_is_bounded_and_applies_backpressure(database, document_ids, watch, monkeypatch):
+    lock = threading.Lock()
+    running, peak, reads_while_refreshing = [0], [0], []
+
+    def refresh_documents(changes):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        reads_before = len(reads)
+        time.sleep(0.05)
+        reads_while_refreshing.append(len(reads) - reads_before)
+        with lock:
+            running[0] -= 1
+
+    monkeypatch.setattr(database, 'refresh_documents', refresh_documents)
+    events = [event(number, 'update', ObjectId(), updateDescription={'updatedFields': {'keywords': []}})
+              for number in range(12)]
+    stop, reads = watch(events)
+    worker = DerivedDataWorker(database, batch_size=6, max_wait=60, workers=2)
+    worker.run(stop)
+
+    assert worker.statistics['batches'] == 2 and worker.statistics['refreshed'] == 12
+    assert peak[0] == 2
+    # the stream is not read while a batch is being refreshed
+    assert reads_while_refreshing == [0] * len(reads_while_refreshing)
+
+
+def test_failing_documents_are_counted(database, document_ids, watch, monkeypatch):
+    refresh_documents = database.refresh_documents
+
+    def failing(changes):
+        if document_ids[0] in changes:
+            raise RuntimeError('broken document')
+        refresh_documents(changes)
+
+    monkeypatch.setattr(database, 'refresh_documents', failing)
+    stop, _ = watch([event(number, 'update', ObjectId(document_id), updateDescription={'updatedFields': {
+        'keywords': []}}) for number, document_id in enumerate(document_ids)])
+    worker = DerivedDataWorker(database, max_wait=60, workers=1)
+    worker.run(stop)
+    assert (worker.statistics['refreshed'], worker.statistics['failed']) == (2, 1)
+
+
+def test_template_changes_refresh_documents_of_the_template(database, template_id, document_ids, watch):
+    other = str(database.templates.insert_one({'name': 'other', 'structure': make_structure('', '')}).inserted_id)
+    assert database.create_document(DocumentCreateStructure(name='other', templateId=other,
+                                                            structure=[make_structure('учет', 'хранение')]))
+    database.get_compiled_template(template_id)
+    revisions = {str(document['_id']): document[INDEX_REVISION] for document in database.documents.find()}
+    changed = []
+
+    def listener(changed_id):
+        changed.append(changed_id)
+        assert database.refresh_template_documents(changed_id, batch_size=2) == len(document_ids)
+
+    stop, _ = watch([event(1, 'update', ObjectId(template_id), collection='sectionTreeTemplates',
+                           updateDescription={'updatedFields': {'structure': {}}})])
+    worker = DerivedDataWorker(database, max_wait=60, template_listeners=[listener])
+    worker.run(stop)
+
+    assert changed == [template_id]
+    assert database.template_cache.get(template_id) is None
+    for document in database.documents.find():
+        changed_revision = document[INDEX_REVISION] != revisions[str(document['_id'])]
+        assert changed_revision == (document['templateId'] == template_id)
+
+
+@pytest.fixture
+def replica_set() -> Database:
+    client = MongoClient(REPLICA_SET_URI, serverSelectionTimeoutMS=1000)
+    try:
+        if not client.admin.command('hello').get('setName'):
+            pytest.skip('the server is not a replica set')
+    except Exception as ex:
+        pytest.skip(f'replica set is not reachable: {ex}')
+    name = f'test{uuid.uuid4().hex}'
+    yield Database(database=client[name])
+    client.drop_database(name)
+    client.close()
+
+
+def test_worker_on_replica_set(replica_set, monkeypatch):
+    database = replica_set
+    template_id = str(database.templates.insert_one({'name': 'template',
+                                                     'structure': make_structure('', '')}).inserted_id)
+    stop = threading.Event()
+    worker = DerivedDataWorker(database, batch_size=10, max_wait=0.2, workers=2)
+    thread = threading.Thread(target=worker.run, args=(stop,))
+    thread.start()
+    try:
+        time.sleep(1)
+        inserted = database.documents.insert_one({'name': 'external', 'templateId': template_id,
+                                                  'structure': make_structure('учет', 'хранение')}).inserted_id
+        deadline = time.monotonic() + 10
+        while not database.search_index.contains(str(inserted)) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert database.search_index.contains(str(inserted))
+    finally:
+        stop.set()
+        thread.join()
+    assert worker.load_token()[0] is not None
@@ -0,0 +1,69 @@
+from fastapi.testclient import TestClient
+
+from app.handlers.compression import strip_encoding
+from tests.conftest import TEXTS, make_structure
+
+
+def get(client: TestClient, url: str, etag: str = None, **params):
+    return client.get(url, params=params, headers={'If-None-Match': etag} if etag else {})
+
+
+def test_documents_not_modified(client):
+    response = get(client, '/api/documents', limit=2)
+    etag = response.headers['ETag']
+    assert len(response.json()['data']) == 2
+    assert get(client, '/api/documents', etag, limit=2).status_code == 304
+    assert get(client, '/api/documents', f'W/{etag}, "other"', limit=2).status_code == 304
+    assert get(client, '/api/documents', etag, limit=3).status_code == 200
+
+    document_id = response.json()['data'][0]['id']
+    assert client.patch(f'/api/documents/{document_id}', json={'keywords': ['учет']}).status_code == 200
+    assert get(client, '/api/documents', etag, limit=2).status_code == 200
+
+
+def test_representations_have_different_etags(client):
+    # regression: the ETag depended only on the page, so a cached short listing answered a full one
+    representations = [{'short': True}, {'short': False}, {'fields': 'name,templateId'}, {'fields': 'keywords'},
+                       {'short': True, 'stream': True}, {'short': False, 'stream': True}]
+    etags = [get(client, '/api/documents', **params).headers['ETag'] for params in representations]
+    assert len(set(etags)) == len(etags)
+
+    for params, etag in zip(representations, etags):
+        assert get(client, '/api/documents', etag, **params).status_code == 304
+        for other in etags:
+            if other != etag:
+                assert get(client, '/api/documents', other, **params).status_code == 200
+
+
+def test_stream(client):
+    response = get(client, '/api/documents', stream=True, short=False)
+    assert response.headers['Content-Type'] == 'application/x-ndjson'
+    assert len(response.text.splitlines()) == len(TEXTS)
+    assert get(client, '/api/documents', response.headers['ETag'], stream=True, short=False).status_code == 304
+
+
+def test_document_not_modified(client):
+    document_id = get(client, '/api/documents').json()['data'][0]['id']
+    response = get(client, f'/api/documents/{document_id}')
+    etag = response.headers['ETag']
+    assert response.json()['name'] == 'document0'
+    assert get(client, f'/api/documents/{document_id}', etag).status_code == 304
+
+    assert client.patch(f'/api/documents/{document_id}',
+                        json={'structure': [make_structure('учет', 'хранение')]}).status_code == 200
+    assert get(client, f'/api/documents/{document_id}', etag).status_code == 200
+
+
+def test_not_modified_keeps_etag_of_encoding(client):
+    # regression: 304 responses carried the ETag of the uncompressed representation
+    response = client.get('/api/documents', params={'short': False}, headers={'Accept-Encoding': 'gzip'})
+    etag = response.headers['ETag']
+    assert response.headers['Content-Encoding'] == 'gzip' and etag.endswith('-gzip"')
+    for if_none_match in (etag, f'W/{etag}', f'"other", {etag}'):
+        not_modified = client.get('/api/documents', params={'short': False},
+                                  headers={'Accept-Encoding': 'gzip', 'If-None-Match': if_none_match})
+        assert not_modified.status_code == 304
+        assert not_modified.headers['ETag'] == etag
+
+    identity = get(client, '/api/documents', strip_encoding(etag), short=False)
+    assert identity.status_code == 304 and identity.headers['ETag'] == strip_encoding(etag)
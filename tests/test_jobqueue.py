@@ -0,0 +1,123 @@
+from concurrent.futures import Future
+
+import pytest
+
+from app.handlers import routes
+from app.models.jobqueue import KeywordJobQueue
+from app.schemas.schema import JobStatus, KeywordExtractionMode
+
+PAIRS = [['учет', 0.8], ['житель', 0.6]]
+
+
+class ManualExecutor:
+    """
+    Executor whose futures are completed by the test instead of worker processes.
+    """
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, function, *args):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+@pytest.fixture
+def queue() -> KeywordJobQueue:
+    saved = []
+    scope = ['first']
+    queue = KeywordJobQueue(lambda document_id, keywords: saved.append((document_id, keywords)), workers=1,
+                            history_size=2, scope=lambda: scope[0])
+    queue.executor.shutdown()
+    queue.executor = ManualExecutor()
+    queue.saved, queue.current_scope = saved, scope
+    return queue
+
+
+def test_job_lifecycle(queue):
+    job = queue.submit('document', KeywordExtractionMode.tf_idf, {}, PAIRS, save=True)
+    assert job.status == JobStatus.pending
+    future = queue.executor.futures[0]
+
+    assert future.set_running_or_notify_cancel()
+    assert queue.get(job.id).status == JobStatus.running
+    future.set_result(PAIRS)
+    assert queue.get(job.id).status == JobStatus.done
+    found, result = queue.get_result(job.id)
+    assert found.status == JobStatus.done and result.result() == PAIRS
+    # the result of the job submitted with `save` is written back to the document
+    assert queue.saved == [('document', PAIRS)]
+
+
+def test_failed_job(queue):
+    job = queue.submit('document', KeywordExtractionMode.pullenti, {}, save=True)
+    queue.executor.futures[0].set_exception(RuntimeError('extraction failed'))
+    failed = queue.get(job.id)
+    assert (failed.status, failed.error) == (JobStatus.failed, 'extraction failed')
+    assert queue.saved == []
+
+    job = queue.submit('document', KeywordExtractionMode.pullenti, {})
+    queue.executor.futures[1].cancel()
+    assert (queue.get(job.id).status, queue.get(job.id).error) == (JobStatus.failed, 'job is cancelled')
+
+
+def test_in_flight_jobs_are_deduplicated(queue):
+    job = queue.submit('document', KeywordExtractionMode.combine, {}, PAIRS)
+    assert queue.submit('document', KeywordExtractionMode.combine, {}, PAIRS, save=True).id == job.id
+    assert queue.find_in_flight('document', KeywordExtractionMode.combine).id == job.id
+    assert queue.find_in_flight('document', KeywordExtractionMode.combine, 'Требования') is None
+    assert len(queue.executor.futures) == 1
+
+    queue.executor.futures[0].set_result(PAIRS)
+    # the identical job submitted with `save` made the result saved, a finished job is not in flight
+    assert queue.saved == [('document', PAIRS)]
+    assert queue.find_in_flight('document', KeywordExtractionMode.combine) is None
+    assert queue.submit('document', KeywordExtractionMode.combine, {}, PAIRS).id != job.id
+
+
+def test_unknown_jobs(queue):
+    assert queue.get('unknown') is None and queue.get_result('unknown') is None
+    first = queue.submit('first', KeywordExtractionMode.tf_idf, {}, PAIRS)
+    # jobs of other scopes are not visible
+    queue.current_scope[0] = 'second'
+    assert queue.get(first.id) is None
+    queue.current_scope[0] = 'first'
+
+    # finished jobs are kept until `history_size` newer jobs are submitted
+    for document_id in ('second', 'third'):
+        queue.submit(document_id, KeywordExtractionMode.tf_idf, {}, PAIRS)
+    assert queue.get(first.id) is None
+
+
+@pytest.fixture
+def executor(monkeypatch) -> ManualExecutor:
+    # jobs submitted through the API are completed by the test
+    executor = ManualExecutor()
+    monkeypatch.setattr(routes.jobs, 'executor', executor)
+    return executor
+
+
+def test_job_routes(client, executor):
+    document_ids = [document['id'] for document in client.get('/api/documents').json()['data']]
+    response = client.post(f'/api/documents/{document_ids[0]}/keywords/jobs', params={'mode': 'pullenti'})
+    job_id = response.json()['id']
+    assert response.json()['status'] == 'pending'
+    assert client.get(f'/api/jobs/{job_id}').json()['status'] == 'pending'
+    assert client.get(f'/api/jobs/{job_id}/result').status_code == 409
+
+    executor.futures[0].set_result(PAIRS)
+    assert client.get(f'/api/jobs/{job_id}').json()['status'] == 'done'
+    assert client.get(f'/api/jobs/{job_id}/result').json() == PAIRS
+
+    response = client.post(f'/api/documents/{document_ids[1]}/keywords/jobs', params={'mode': 'pullenti'})
+    executor.futures[1].set_exception(RuntimeError('extraction failed'))
+    failed = client.get(f'/api/jobs/{response.json()["id"]}').json()
+    assert (failed['status'], failed['error']) == ('failed', 'extraction failed')
+    assert client.get(f'/api/jobs/{response.json()["id"]}/result').status_code == 500
+
+    assert client.get('/api/jobs/unknown').status_code == 404
+    assert client.get('/api/jobs/unknown/result').status_code == 404
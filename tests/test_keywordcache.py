@@ -0,0 +1,88 @@
+import time
+
+from bson.objectid import ObjectId
+
+from app.models.keywordcache import KeywordCache
+from app.schemas.schema import DocumentCreateStructure, KeywordExtractionMode
+from tests.conftest import make_structure
+
+
+def test_same_text_in_different_sections_is_not_shared(database, template_id, document_ids):
+    # regression: tf_idf results depend on the document frequencies of the section, not only on its text
+    text = 'сервер модуль журнал событие'
+    for name, structure in (('first', make_structure(text, 'сервер модуль')),
+                            ('second', make_structure('модуль справочник', text))):
+        assert database.create_document(DocumentCreateStructure(name=name, templateId=template_id,
+                                                                structure=[structure]))
+    first = str(database.documents.find_one({'name': 'first'})['_id'])
+    second = str(database.documents.find_one({'name': 'second'})['_id'])
+
+    mode = KeywordExtractionMode.tf_idf
+    assert database.generate_document_keywords(first, mode, 'Назначение') == \
+        database.get_document_tf_idf_pairs(first, 'Назначение')
+    assert database.generate_document_keywords(second, mode, 'Требования') == \
+        database.get_document_tf_idf_pairs(second, 'Требования')
+    assert database.get_document_tf_idf_pairs(first, 'Назначение') != \
+        database.get_document_tf_idf_pairs(second, 'Требования')
+
+
+def test_keys():
+    tf_idf, pullenti = KeywordExtractionMode.tf_idf, KeywordExtractionMode.pullenti
+    assert KeywordCache.make_key('text', tf_idf) == KeywordCache.make_key('text', tf_idf, '')
+    assert KeywordCache.make_key('text', tf_idf, 'a') != KeywordCache.make_key('text', tf_idf, 'b')
+    assert KeywordCache.make_key('text', tf_idf) != KeywordCache.make_key('text', KeywordExtractionMode.combine)
+    # pullenti keywords depend only on the text
+    assert KeywordCache.make_key('text', pullenti, 'a') == KeywordCache.make_key('text', pullenti, 'b')
+
+
+def test_results_are_reused_and_invalidated(database, document_ids):
+    mode = KeywordExtractionMode.tf_idf
+    keywords = database.generate_document_keywords(document_ids[0], mode)
+    assert database.generate_document_keywords(document_ids[0], mode) == keywords
+    assert database.keyword_cache.get_statistics().hits == 1
+
+    database.update_document_structure(document_ids[0], [make_structure('учет квартир', 'хранение')])
+    assert database.keyword_cache.get_statistics().invalidations == 1
+    assert database.generate_document_keywords(document_ids[0], mode) != keywords
+
+
+def test_corpus_dependent_entries_become_stale():
+    cache = KeywordCache(idf_tolerance=0.1)
+    document_id = str(ObjectId())
+    tf_idf = KeywordCache.make_key('text', KeywordExtractionMode.tf_idf)
+    pullenti = KeywordCache.make_key('text', KeywordExtractionMode.pullenti)
+    cache.put(tf_idf, document_id, KeywordExtractionMode.tf_idf, [['text', 1.0]], revision=10)
+    cache.put(pullenti, document_id, KeywordExtractionMode.pullenti, ['text'], revision=10)
+
+    assert cache.get(tf_idf, revision=11, documents_count=10) == [['text', 1.0]]
+    assert cache.get(pullenti, revision=100, documents_count=10) == ['text']
+    assert cache.get(tf_idf, revision=12, documents_count=10) is None
+    assert cache.get_statistics().stale == 1
+
+
+def test_size_and_ttl(monkeypatch):
+    cache = KeywordCache(size=2, ttl=60)
+    mode = KeywordExtractionMode.pullenti
+    for text in ('a', 'b', 'c'):
+        cache.put(KeywordCache.make_key(text, mode), str(ObjectId()), mode, [text])
+    assert cache.get(KeywordCache.make_key('a', mode)) is None
+    assert cache.get_statistics().evictions == 1
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert cache.get(KeywordCache.make_key('c', mode)) is None
+
+
+def test_persistent_tier(database):
+    cache = KeywordCache(persistent=True)
+    cache.bind(database.documents.database['keywordCache'])
+    mode = KeywordExtractionMode.pullenti
+    key, document_id = KeywordCache.make_key('text', mode), str(ObjectId())
+    cache.put(key, document_id, mode, ['text'])
+
+    other = KeywordCache(persistent=True)
+    other.bind(database.documents.database['keywordCache'])
+    assert other.get(key) == ['text']
+    assert other.get_statistics().persistentHits == 1
+    other.invalidate_document(document_id)
+    assert cache.collection.count_documents({}) == 0
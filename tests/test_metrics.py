@@ -0,0 +1,40 @@
+import pytest
+from fastapi import HTTPException
+
+from app.models.metrics import Metrics
+
+
+def test_requests_and_phases_are_exposed():
+    metrics = Metrics()
+    with metrics.track_request('GET', '/api/documents/{document_id}') as request:
+        with metrics.timer('mongo'):
+            pass
+        metrics.observe_phase('mongo', 0.02)
+        assert set(request.timings) == {'mongo'}
+    with pytest.raises(HTTPException):
+        with metrics.track_request('GET', '/api/documents/{document_id}'):
+            raise HTTPException(status_code=404)
+    with pytest.raises(RuntimeError):
+        with metrics.track_request('POST', '/api/files'):
+            raise RuntimeError()
+
+    lines = metrics.render().splitlines()
+    route = 'method="GET",route="/api/documents/{document_id}"'
+    assert f'http_request_duration_seconds_count{{{route},status="200"}} 1' in lines
+    assert f'http_request_duration_seconds_count{{{route},status="404"}} 1' in lines
+    assert 'http_request_duration_seconds_count{method="POST",route="/api/files",status="500"} 1' in lines
+    assert f'http_requests_in_flight{{{route}}} 0' in lines
+    assert 'phase_duration_seconds_bucket{phase="mongo",le="0.025"} 2' in lines
+    assert 'phase_duration_seconds_bucket{phase="mongo",le="0.01"} 1' in lines
+    assert 'phase_duration_seconds_count{phase="mongo"} 2' in lines
+
+
+def test_server_timing():
+    assert Metrics.format_server_timing({'total': 0.0123, 'mongo': 0.001}) == 'mongo;dur=1.0, total;dur=12.3'
+
+
+def test_metrics_route(client):
+    client.get('/api/documents')
+    response = client.get('/metrics')
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/documents",status="200"}' in response.text
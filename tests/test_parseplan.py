@@ -0,0 +1,144 @@
+import asyncio
+import io
+import threading
+import time
+
+import docx
+import pytest
+from bson.objectid import ObjectId
+from fastapi import UploadFile
+from srsparser import Parser
+
+from app.models.parserwrapper import ParserWrapper
+from app.models.templatecache import CompiledTemplate, TemplateCache
+from app.schemas.schema import Template, TemplateCreateStructure
+from tests.conftest import TEMPLATE, TEXTS, make_structure
+
+parser = ParserWrapper()
+
+
+def make_docx_with_table() -> bytes:
+    # paragraphs repeating the cells of a table are not headings, headings differ from the names of the sections
+    document = docx.Document()
+    document.add_paragraph('Общие сведения')
+    document.add_paragraph('Назначение системы')
+    document.add_paragraph('Система предназначена для учета жителей.')
+    table = document.add_table(rows=1, cols=2)
+    table.rows[0].cells[0].text = 'Требования'
+    table.rows[0].cells[1].text = 'надежность'
+    document.add_paragraph('Требования')
+    document.add_paragraph('Требования к надежности и хранению данных.')
+    document.add_paragraph('Требования')
+    stream = io.BytesIO()
+    document.save(stream)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize('content', [parser.render_docx(make_structure(*texts)) for texts in TEXTS] +
+                         [parser.render_docx(make_structure('', '')), make_docx_with_table()],
+                         ids=[f'text{i}' for i in range(len(TEXTS))] + ['empty', 'table'])
+def test_plan_parses_like_parser(content):
+    plan = parser.compile_template(TEMPLATE)
+    expected = Parser(TEMPLATE).get_sections_structure(docx.Document(io.BytesIO(content)))
+    assert plan.create_parser().get_sections_structure(docx.Document(io.BytesIO(content))) == expected
+    assert parser.parse_docx(TEMPLATE, io.BytesIO(content), plan) == expected
+    # parsers of the same plan do not share the filled trees
+    assert plan.create_parser().get_sections_structure(docx.Document(io.BytesIO(content))) == expected
+
+
+def test_plan_tokens():
+    plan = parser.compile_template(TEMPLATE)
+    assert len(plan.leaf_tokens) == 2
+    assert plan.leaf_tokens[1] == frozenset(parser.langproc.tokenize('Требования'))
+
+
+def test_compiled_templates_are_cached(database, template_id):
+    template = database.get_compiled_template(template_id)
+    assert template.structure == TEMPLATE
+    assert database.get_compiled_template(template_id) is template
+    assert template.get_plan(parser) is template.get_plan(parser)
+    assert database.template_cache.get_statistics()['hits'] == 1
+
+    assert database.get_compiled_template(str(template_id)[::-1]) is None
+    assert database.get_compiled_template('invalid') is None
+    assert database.template_cache.get_statistics()['size'] == 1
+
+    database.delete_template(template_id)
+    assert database.template_cache.get_statistics()['invalidations'] == 1
+    assert database.get_compiled_template(template_id) is None
+
+
+def test_template_versions(database):
+    for name, structure in (('first', TEMPLATE), ('second', TEMPLATE), ('third', make_structure('a', 'b'))):
+        assert database.create_template(TemplateCreateStructure(name=name, structure=structure))
+    ids = [str(template['_id']) for template in database.templates.find({}, {'_id': 1}).sort('_id')]
+    versions = [database.get_compiled_template(template_id).version for template_id in ids]
+    assert versions[0] == versions[1] != versions[2]
+
+
+def test_cache_size_and_ttl(database, monkeypatch):
+    database.template_cache = TemplateCache(size=1, ttl=60)
+    ids = [str(database.templates.insert_one({'name': name, 'structure': TEMPLATE}).inserted_id)
+           for name in ('first', 'second')]
+    first = database.get_compiled_template(ids[0])
+    database.get_compiled_template(ids[1])
+    assert database.template_cache.get_statistics()['evictions'] == 1
+    assert database.get_compiled_template(ids[0]) is not first
+
+    # templates changed bypassing the API are read again when their entries expire
+    database.templates.update_one({'name': 'first'}, {'$set': {'structure': make_structure('a', 'b')}})
+    assert database.get_compiled_template(ids[0]).structure == TEMPLATE
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert database.get_compiled_template(ids[0]).structure == make_structure('a', 'b')
+
+
+def test_cache_is_keyed_by_versions(database, monkeypatch):
+    template_id = str(database.templates.insert_one({'name': 'template', 'structure': TEMPLATE}).inserted_id)
+    template = database.get_compiled_template(template_id)
+    plan = template.get_plan(parser)
+
+    # an expired entry of an unchanged template is revalidated and keeps its parse plan
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert database.get_compiled_template(template_id) is template
+    assert template.get_plan(parser) is plan
+    assert database.template_cache.get_statistics()['revalidations'] == 1
+
+    # a new version replaces the entry of the template
+    database.templates.update_one({'_id': ObjectId(template_id)}, {'$set': {'structure': make_structure('a', 'b')}})
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 122)
+    changed = database.get_compiled_template(template_id)
+    assert changed.version != template.version
+    assert database.get_compiled_template(template_id) is changed
+    assert database.template_cache.get_statistics()['size'] == 1
+
+
+def test_created_templates_invalidate_their_entries(database, monkeypatch):
+    # an entry left by a template with the same id is not served for the created template
+    template_id = ObjectId()
+    database.template_cache.put(CompiledTemplate(Template(id=str(template_id), name='stale',
+                                                          structure=[make_structure('a', 'b')])))
+    insert_one = database.templates.insert_one
+    monkeypatch.setattr(database.templates, 'insert_one',
+                        lambda document: insert_one({'_id': template_id, **document}))
+    assert database.create_template(TemplateCreateStructure(name='template', structure=TEMPLATE))
+    assert database.template_cache.get_statistics()['invalidations'] == 1
+    assert database.get_compiled_template(str(template_id)).structure == TEMPLATE
+
+
+def test_uploads_are_parsed_off_the_event_loop(monkeypatch):
+    # regression: without the parse pool the CPU-bound parsing blocked the event loop
+    threads = []
+    parse_docx = parser.parse_docx
+    monkeypatch.setattr(parser, 'parse_docx', lambda *args: threads.append(threading.current_thread()) or
+                        parse_docx(*args))
+    content = parser.render_docx(make_structure(*TEXTS[0]))
+
+    async def parse():
+        upload = UploadFile('document.docx', io.BytesIO(content))
+        return threading.current_thread(), await parser.parse_docx_by_template(TEMPLATE, upload)
+
+    loop_thread, structure = asyncio.run(parse())
+    assert structure == Parser(TEMPLATE).get_sections_structure(docx.Document(io.BytesIO(content)))
+    assert threads and threads[0] is not loop_thread
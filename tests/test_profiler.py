@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from app.errors import StateException
+from app.models.profiler import Profile, SamplingProfiler
+
+
+def busy(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profiler_samples_busy_threads():
+    profiler = SamplingProfiler()
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,))
+    thread.start()
+    try:
+        profile = profiler.profile(seconds=0.2, interval=0.001)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert profile.samples and profile.duration >= 0.2
+    assert any('busy' in {name for _, _, name in stack} for stack in profile.samples)
+    assert 'busy (test_profiler.py:' in profile.to_collapsed()
+    assert 'busy' in profile.to_text()
+    assert profiler.session is None
+
+
+def test_profiler_sessions_by_route():
+    profiler = SamplingProfiler()
+    stop = threading.Event()
+    errors = []
+
+    def request():
+        with profiler.track('/api/files'):
+            busy_until = time.perf_counter() + 0.05
+            while time.perf_counter() < busy_until:
+                sum(range(1000))
+
+    def requests():
+        # requests are sent once the session is running
+        while profiler.session is None and not stop.is_set():
+            time.sleep(0.001)
+        try:
+            profiler.profile(seconds=1)
+        except StateException as ex:
+            errors.append(str(ex))
+        for _ in range(2):
+            request()
+
+    thread = threading.Thread(target=requests)
+    thread.start()
+    try:
+        profile = profiler.profile(route='/api/files', requests=2, timeout=10, interval=0.001)
+    finally:
+        stop.set()
+        thread.join()
+    # only one session runs at a time
+    assert errors == ['profiling session is already running']
+    assert profile.requests == 2 and profile.samples
+    assert profile.duration < 10
+
+
+def test_profile_exports():
+    profile = Profile(0.01)
+    outer, inner = ('app.py', 1, 'outer'), ('app.py', 5, 'inner')
+    profile.add((outer, inner))
+    profile.add((outer, inner))
+    profile.add((outer,))
+    assert profile.to_collapsed() == 'outer (app.py:1);inner (app.py:5) 2\nouter (app.py:1) 1\n'
+    profile.create_stats()
+    assert profile.stats[outer][:4] == (3, 3, pytest.approx(0.01), pytest.approx(0.03))
+    assert profile.stats[inner][:4] == (2, 2, pytest.approx(0.02), pytest.approx(0.02))
+    assert profile.stats[inner][4][outer][:2] == (2, 2)
@@ -0,0 +1,58 @@
+import pytest
+
+from app.handlers import routes
+from app.models.rendercache import RenderCache
+from tests.conftest import make_structure
+
+
+def test_keys_follow_structures():
+    structure = make_structure('учет', 'хранение')
+    key = RenderCache.make_key('document', structure)
+    assert RenderCache.make_key('document', make_structure('учет', 'хранение')) == key
+    assert RenderCache.make_key('document', make_structure('учет', 'надежность')) != key
+    assert RenderCache.make_key('other', structure) != key
+
+
+def test_cache_is_bounded_by_size():
+    cache = RenderCache(max_bytes=10)
+    cache.put(('first', ''), b'1234')
+    cache.put(('second', ''), b'1234')
+    assert cache.get(('first', '')) == b'1234'
+    # the least recently used file is evicted
+    cache.put(('third', ''), b'1234')
+    assert cache.get(('second', '')) is None
+    assert cache.get(('first', '')) == b'1234' and cache.size == 8
+
+    cache.put(('first', ''), b'12')
+    assert cache.size == 6
+    # files larger than the cache are not cached
+    cache.put(('large', ''), b'12345678901')
+    assert cache.get(('large', '')) is None and cache.size == 6
+    cache.clear()
+    assert cache.get(('first', '')) is None and cache.size == 0
+
+
+@pytest.fixture
+def renders(monkeypatch) -> list:
+    # the cache is shared by the tests, so every test starts with an empty one
+    routes.render_cache.clear()
+    rendered = []
+    render_docx = routes.parser.render_docx
+    monkeypatch.setattr(routes.parser, 'render_docx', lambda structure: rendered.append(structure) or
+                        render_docx(structure))
+    yield rendered
+    routes.render_cache.clear()
+
+
+def test_downloads_are_rendered_once(client, renders):
+    document_id = client.get('/api/documents').json()['data'][0]['id']
+    first = client.get(f'/api/documents/{document_id}/download')
+    assert first.status_code == 200
+    assert client.get(f'/api/documents/{document_id}/download').content == first.content
+    assert len(renders) == 1
+
+    # an updated document is rendered again
+    structure = make_structure('справочник', 'хранение')
+    assert client.patch(f'/api/documents/{document_id}', json={'structure': [structure]}).status_code == 200
+    assert client.get(f'/api/documents/{document_id}/download').content != first.content
+    assert renders[1:] == [structure]
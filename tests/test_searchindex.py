@@ -0,0 +1,116 @@
+import math
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import pytest
+from bson.objectid import ObjectId
+
+from app.models.searchindex import SearchIndex, TEXT, KEYWORDS
+from app.schemas.schema import DocumentCreateStructure
+from tests.conftest import mongomock, make_structure
+
+DOCUMENTS = [
+    (str(ObjectId()), 'a', {'': Counter(система=2, учет=1, житель=1), 'Назначение': Counter(система=1, учет=1),
+                            'Требования': Counter(система=1, житель=1)}, Counter(учет=1)),
+    (str(ObjectId()), 'a', {'': Counter(система=1, платеж=3), 'Назначение': Counter(платеж=3),
+                            'Требования': Counter(система=1)}, Counter()),
+    (str(ObjectId()), 'b', {'': Counter(справочник=1, квартира=1, надежность=2), 'Назначение': Counter(справочник=1,
+                                                                                                     квартира=1),
+                            'Требования': Counter(надежность=2)}, Counter(надежность=1, система=1)),
+]
+
+
+def bm25(documents: List[Tuple[str, str, Dict[str, Counter], Counter]], terms: List[str], section: str = '',
+         template_id: str = None, fields=(TEXT, KEYWORDS)) -> List[Tuple[str, float]]:
+    """
+    Reference BM25 scores computed directly from the term vectors.
+    """
+    scores = Counter()
+    for field in fields:
+        vectors = {document_id: (sections.get(section) if field == TEXT else keywords, document_template_id)
+                   for document_id, document_template_id, sections, keywords in documents
+                   if field == KEYWORDS or section in sections}
+        if not vectors:
+            continue
+        average_length = sum(sum(vector.values()) for vector, _ in vectors.values()) / len(vectors) or 1
+        for term in set(terms):
+            frequency = sum(1 for vector, _ in vectors.values() if vector[term])
+            idf = math.log(1 + (len(vectors) - frequency + 0.5) / (frequency + 0.5))
+            for document_id, (vector, document_template_id) in vectors.items():
+                if vector[term] and template_id in (None, document_template_id):
+                    tf = vector[term]
+                    norm = tf + SearchIndex.K1 * (1 - SearchIndex.B + SearchIndex.B * sum(vector.values()) /
+                                                  average_length)
+                    scores[document_id] += idf * tf * (SearchIndex.K1 + 1) / norm
+    best = sorted(scores.items(), key=lambda item: (item[1], ObjectId(item[0])), reverse=True)
+    return [(document_id, round(score, 6)) for document_id, score in best]
+
+
+@pytest.fixture
+def index() -> SearchIndex:
+    database = mongomock.MongoClient()['test']
+    index = SearchIndex(database['postings'], database['documents'], database['statistics'])
+    index.ensure_indexes()
+    index.add_many(DOCUMENTS)
+    return index
+
+
+@pytest.mark.parametrize('terms, section, template_id, fields', [
+    (['система'], '', None, (TEXT, KEYWORDS)),
+    (['система', 'учет', 'житель'], '', None, (TEXT,)),
+    (['система', 'надежность'], 'Требования', None, (TEXT,)),
+    (['платеж', 'учет'], 'Назначение', None, (TEXT, KEYWORDS)),
+    (['система'], '', 'a', (TEXT, KEYWORDS)),
+    (['надежность', 'учет'], '', None, (KEYWORDS,)),
+    (['нет'], '', None, (TEXT, KEYWORDS)),
+])
+def test_scores(index, terms, section, template_id, fields):
+    assert index.search(terms, section or None, template_id, fields) == bm25(DOCUMENTS, terms, section,
+                                                                            template_id, fields)
+
+
+def test_limit_and_empty_query(index):
+    assert index.search(['система'], limit=2) == bm25(DOCUMENTS, ['система'])[:2]
+    assert index.search([]) == []
+
+
+def test_updates_match_rebuild(index):
+    document_id, template_id, _, keywords = DOCUMENTS[1]
+    sections = {'': Counter(система=4, житель=1), 'Требования': Counter(система=4, житель=1)}
+    index.update_text(document_id, sections)
+    index.update_keywords(DOCUMENTS[0][0], Counter(система=2))
+    index.remove(DOCUMENTS[2][0])
+    index.update_text(DOCUMENTS[2][0], {'': Counter(нет=1)})
+
+    documents = [(DOCUMENTS[0][0], 'a', DOCUMENTS[0][2], Counter(система=2)),
+                 (document_id, template_id, sections, keywords)]
+    assert index.count() == 2 and not index.contains(DOCUMENTS[2][0])
+    for terms, section in ((['система', 'житель'], ''), (['система'], 'Требования'), (['учет'], 'Назначение')):
+        expected = bm25(documents, terms, section)
+        assert index.search(terms, section or None) == expected
+
+    index.rebuild(iter(documents), batch_size=1)
+    assert index.search(['система', 'житель']) == bm25(documents, ['система', 'житель'])
+
+
+def test_search_documents(database, template_id, document_ids):
+    found = database.search_documents('надежность системы', section_name='Требования')
+    assert {document['id'] for document in found} == set(document_ids)
+    assert all(document['templateId'] == template_id for document in found)
+    assert [document['score'] for document in found] == sorted((document['score'] for document in found),
+                                                               reverse=True)
+
+    database.update_document_structure(document_ids[1], [make_structure('учет', 'надежность надежность')])
+    assert document_ids[1] in [document['id'] for document in database.search_documents('надежность')]
+    database.delete_document(document_ids[0])
+    assert document_ids[0] not in [document['id'] for document in database.search_documents('система')]
+    assert database.search_documents('') == []
+
+
+def test_index_is_built_for_existing_documents(database, template_id):
+    structure = make_structure('учет жителей', 'надежность')
+    database.documents.insert_one({'name': 'imported', 'templateId': template_id, 'structure': structure})
+    assert [document['name'] for document in database.search_documents('учет жителей')] == ['imported']
+    assert database.create_document(DocumentCreateStructure(name='created', templateId=template_id,
+                                                            structure=[structure]))
+    assert {document['name'] for document in database.search_documents('учет жителей')} == {'imported', 'created'}
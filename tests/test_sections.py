@@ -0,0 +1,66 @@
+import uuid
+
+import pytest
+
+from app.errors import StateException
+from app.models.database import Database
+from app.models.structurecodec import StructureCodec, COMPACT, PLAIN
+from app.schemas.schema import DocumentCreateStructure
+from tests.conftest import mongomock, make_structure, TEMPLATE
+
+
+@pytest.fixture(params=[PLAIN, COMPACT])
+def database(request) -> Database:
+    return Database(database=mongomock.MongoClient()[f'test{uuid.uuid4().hex}'], codec=StructureCodec(request.param))
+
+
+@pytest.fixture
+def document_id(database) -> str:
+    template_id = str(database.templates.insert_one({'name': 'template', 'structure': TEMPLATE}).inserted_id)
+    assert database.create_document(DocumentCreateStructure(name='document', templateId=template_id,
+                                                            structure=[make_structure('учет жителей', 'надежность')]))
+    return str(database.documents.find_one({}, {'_id': 1})['_id'])
+
+
+def test_section_update(database, document_id):
+    assert database.update_document_section(document_id, (1,), {'name': 'Требования', 'text': 'хранение'}) == 'OK'
+    assert database.get_document_section(document_id, (1,)) == {'name': 'Требования', 'text': 'хранение'}
+    assert database.get_document(document_id).structure[0] == make_structure('учет жителей', 'хранение')
+    assert database.get_section_index(document_id)[-1]['length'] == len('хранение')
+    assert database.update_document_section(document_id, (5,), {'name': 'Нет', 'text': ''}) is None
+
+
+def test_concurrent_section_updates_are_not_lost(database, document_id, monkeypatch):
+    find_one = database.documents.find_one
+    concurrent = []
+
+    def find_one_racing(*args, **kwargs):
+        # another request updates the other section after this one has read the document
+        document = find_one(*args, **kwargs)
+        if not concurrent:
+            concurrent.append(None)
+            concurrent[0] = database.update_document_section(
+                document_id, (0, 0), {'name': 'Назначение', 'text': 'справочник квартир'})
+        return document
+
+    monkeypatch.setattr(database.documents, 'find_one', find_one_racing)
+    assert database.update_document_section(document_id, (1,), {'name': 'Требования', 'text': 'хранение'}) == 'OK'
+    monkeypatch.undo()
+    assert concurrent == ['OK']
+    assert database.get_document(document_id).structure[0] == make_structure('справочник квартир', 'хранение')
+    assert [entry['length'] for entry in database.get_section_index(document_id)] == \
+        [len('справочник квартир') + len('хранение'), len('справочник квартир'), len('справочник квартир'),
+         len('хранение')]
+
+
+def test_section_update_gives_up_when_the_document_keeps_changing(database, document_id, monkeypatch):
+    find_one = database.documents.find_one
+
+    def find_one_racing(*args, **kwargs):
+        document = find_one(*args, **kwargs)
+        database.documents.update_one({'_id': document['_id']}, {'$set': {'indexRevision': uuid.uuid4().hex}})
+        return document
+
+    monkeypatch.setattr(database.documents, 'find_one', find_one_racing)
+    with pytest.raises(StateException):
+        database.update_document_section(document_id, (1,), {'name': 'Требования', 'text': 'хранение'})
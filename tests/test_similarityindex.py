@@ -0,0 +1,94 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from app.models.similarityindex import SimilarityIndex, SimilarityIndexCache
+
+WORDS = ['система', 'учет', 'житель', 'платеж', 'квартира', 'справочник', 'надежность', 'хранение', 'работа',
+         'модуль', 'журнал', 'сервер']
+
+
+def build(documents):
+    frequencies = Counter(term for _, terms in documents for term in terms)
+    return SimilarityIndex.build(documents, frequencies, len(documents))
+
+
+def random_documents(count: int, seed: int = 0):
+    random = np.random.default_rng(seed)
+    return [(f'document{i}', Counter(random.choice(WORDS, size=random.integers(1, 6)).tolist()))
+            for i in range(count)]
+
+
+def cosine(index: SimilarityIndex, documents, query: Counter, k: int, excluded: str = None):
+    """
+    Reference results: cosine similarities of dense vectors, ties broken by the order of the documents.
+    """
+    vectors = index.vectorize([terms for _, terms in documents]).toarray()
+    scores = vectors @ index.vectorize([query]).toarray().ravel()
+    order = sorted(range(len(documents)), key=lambda row: (-scores[row], row))
+    return [(documents[row][0], round(float(scores[row]), 6)) for row in order
+            if scores[row] > 0 and documents[row][0] != excluded][:k]
+
+
+@pytest.mark.parametrize('count', [5, 40, 200])
+def test_exact(count):
+    documents = random_documents(count)
+    index = build(documents)
+    for document_id, terms in documents[:10]:
+        queries = index.vectorize([terms])
+        assert index.most_similar(queries, 3, [document_id], batch_size=16) == \
+            [cosine(index, documents, terms, 3, document_id)]
+
+
+def test_approximate_returns_as_many_results_as_exact():
+    # regression: with a fixed number of probed clusters, a small corpus returned fewer than k results
+    documents = [('a', Counter(система=2, учет=1)), ('b', Counter(система=1, житель=1)),
+                 ('c', Counter(платеж=1, квартира=1)), ('d', Counter(квартира=2, справочник=1)),
+                 ('e', Counter(учет=1, надежность=1))]
+    index = build(documents)
+    for document_id, terms in documents:
+        queries = index.vectorize([terms])
+        for k in range(1, len(documents)):
+            exact = index.most_similar(queries, k, [document_id])[0]
+            approximate = index.most_similar(queries, k, [document_id], approximate=True)[0]
+            assert len(approximate) == len(exact)
+            assert set(approximate) <= set(cosine(index, documents, terms, len(documents), document_id))
+
+
+@pytest.mark.parametrize('k', [1, 5, 20])
+def test_approximate_on_larger_corpus(k):
+    documents = random_documents(400, seed=1)
+    index = build(documents)
+    for document_id, terms in documents[:20]:
+        exact = index.most_similar(index.vectorize([terms]), k, [document_id])[0]
+        approximate = index.most_similar(index.vectorize([terms]), k, [document_id], approximate=True)[0]
+        assert len(approximate) == len(exact)
+        # every approximate result is a real similarity of the document
+        assert set(approximate) <= set(cosine(index, documents, terms, len(documents), document_id))
+
+
+def test_empty_index():
+    index = build([])
+    assert index.most_similar(index.vectorize([Counter(система=1)]), 3) == [[]]
+    assert index.most_similar(index.vectorize([Counter(система=1)]), 3, approximate=True) == [[]]
+
+
+def test_cache():
+    cache = SimilarityIndexCache(size=1, tolerance=0.1)
+    built = []
+
+    def factory(revision):
+        def build_index():
+            built.append(revision)
+            index = build(random_documents(5))
+            index.revision = revision
+            return index
+        return build_index
+
+    index = cache.get('', 0, 100, factory(0))
+    assert cache.get('', 10, 100, factory(10)) is index
+    assert cache.get('', 11, 100, factory(11)) is not index
+    cache.get('Требования', 11, 100, factory(11))
+    cache.get('', 11, 100, factory(11))
+    assert built == [0, 11, 11, 11]
@@ -0,0 +1,80 @@
+import uuid
+
+import pytest
+
+from app.models.database import Database
+from app.models.structurecodec import StructureCodec, COMPACT, PLAIN
+from app.schemas.schema import DocumentCreateStructure
+from tests.conftest import mongomock, make_structure, TEXTS
+
+STRUCTURES = [
+    make_structure(*TEXTS[0]),
+    {'name': 'root', 'text': ''},
+    {'name': 'root', 'children': []},
+    {'name': 'root', 'children': [{'name': 'empty', 'children': []}, {'name': 'leaf', 'text': 'текст "в кавычках"\n'}]},
+    {'name': '', 'children': [{'name': 'a', 'children': [{'name': 'b', 'children': [{'name': 'c', 'text': 'x'}]}]},
+                              {'name': 'a', 'text': 'same name'}, {'name': 'd.$e', 'text': '\u0000 ퟿ 😀'}]},
+]
+
+# structures the compact format cannot represent
+IRREGULAR = [
+    {'name': 'root', 'text': 'text', 'children': []},
+    {'name': 'root', 'children': [{'name': 'leaf', 'text': 1}]},
+    {'name': 'root', 'children': [{'name': 'leaf', 'text': 'text', 'extra': True}]},
+    {'name': 1, 'text': 'text'},
+    {'name': 'root', 'children': ['text']},
+    {'name': 'root', 'children': {'name': 'leaf', 'text': 'text'}},
+]
+
+
+@pytest.mark.parametrize('structure', STRUCTURES)
+def test_round_trip(structure):
+    tree = StructureCodec.encode_tree(structure)
+    assert len(tree['names']) == len(tree['children'])
+    assert StructureCodec.decode_tree(tree) == structure
+    assert StructureCodec.decode(StructureCodec(COMPACT).encode(structure)) == structure
+    assert StructureCodec.decode(StructureCodec(PLAIN).encode(structure)) == structure
+
+
+@pytest.mark.parametrize('structure', IRREGULAR)
+def test_irregular_structures_are_stored_plain(structure):
+    assert StructureCodec.encode_tree(structure) is None
+    assert StructureCodec(COMPACT).encode(structure) == {'structure': structure}
+
+
+def test_skeleton():
+    tree = StructureCodec.encode_tree(STRUCTURES[0])
+    del tree['texts']
+    assert StructureCodec.decode_tree(tree) == {'name': 'root', 'children': [
+        {'name': 'Общие сведения', 'children': [{'name': 'Назначение'}]}, {'name': 'Требования'}]}
+
+
+def test_fields():
+    compact = StructureCodec(COMPACT, level=9)
+    assert compact.field == 'tree' and StructureCodec().field == 'structure'
+    assert compact.get_unset_fields(compact.encode(STRUCTURES[0])) == {'structure': ''}
+    assert compact.get_unset_fields(compact.encode(IRREGULAR[0])) == {'tree': ''}
+    assert StructureCodec.decode({'name': 'document'}) is None
+    with pytest.raises(ValueError):
+        StructureCodec('bson')
+
+
+def test_migration():
+    database = Database(database=mongomock.MongoClient()[f'test{uuid.uuid4().hex}'], codec=StructureCodec(COMPACT))
+    template_id = str(database.templates.insert_one({'name': 'template', 'structure': STRUCTURES[0]}).inserted_id)
+    for i, texts in enumerate(TEXTS):
+        assert database.create_document(DocumentCreateStructure(name=f'document{i}', templateId=template_id,
+                                                                structure=[make_structure(*texts)]))
+    database.documents.insert_one({'name': 'irregular', 'templateId': template_id, 'structure': IRREGULAR[0]})
+    ids = [str(document['_id']) for document in database.documents.find({}, {'_id': 1}).sort('_id')]
+    structures = [database.get_document(document_id).structure for document_id in ids]
+    assert database.documents.count_documents({'tree': {'$exists': True}}) == len(TEXTS)
+
+    assert database.migrate_structures(StructureCodec(PLAIN), batch_size=2) == len(TEXTS)
+    assert database.documents.count_documents({'tree': {'$exists': True}}) == 0
+    assert [database.get_document(document_id).structure for document_id in ids] == structures
+
+    assert database.migrate_structures(batch_size=2) == len(TEXTS)
+    assert database.documents.count_documents({'structure': {'$exists': True}}) == 1
+    assert [database.get_document(document_id).structure for document_id in ids] == structures
+    assert database.migrate_structures() == 0
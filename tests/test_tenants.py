@@ -0,0 +1,83 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.errors import FoundException, StateException
+from app.handlers import routes
+from app.main import app
+from app.models.database import Database
+from app.models.databaseregistry import DatabaseRegistry, DEFAULT_TENANT
+
+URI = 'mongodb://localhost:27017'
+OTHER_URI = 'mongodb://other:27017'
+
+
+class FailingDatabase(Database):
+    def ensure_indexes(self):
+        raise ConnectionError('server is not available')
+
+
+@pytest.fixture
+def registry() -> DatabaseRegistry:
+    registry = DatabaseRegistry(lambda database: Database(database=database))
+    registry.register(DEFAULT_TENANT, URI, database_name='default')
+    yield registry
+    registry.close()
+
+
+def test_tenants_share_clients(registry):
+    first = registry.register('first', URI, database_name='first')
+    assert registry.register('first', URI, database_name='first') is first
+    assert registry.register('second', URI, database_name='second').documents.database.name == 'second'
+    assert len(registry.clients) == 1 and registry.clients[(URI, False)].references == 3
+    assert registry.register('third', OTHER_URI + '/third').documents.database.name == 'third'
+    registry.remove('third')
+
+    registry.register('first', OTHER_URI, database_name='first')
+    assert registry.clients[(OTHER_URI, False)].references == 1
+    registry.remove('first')
+    assert (OTHER_URI, False) not in registry.clients
+    with pytest.raises(FoundException):
+        registry.get('first')
+    with pytest.raises(StateException):
+        registry.remove(DEFAULT_TENANT)
+
+
+def test_failed_connection_does_not_replace_tenant(registry):
+    database = registry.register('tenant', URI, database_name='tenant')
+    registry.create = lambda mongo_database: FailingDatabase(database=mongo_database)
+    with pytest.raises(ConnectionError):
+        registry.register('tenant', OTHER_URI, database_name='tenant', verify=True)
+    assert registry.get('tenant') is database
+    # the client created for the new connection is released
+    assert (OTHER_URI, False) not in registry.clients
+    assert registry.clients[(URI, False)].references == 2
+
+
+@pytest.fixture
+def client(monkeypatch) -> TestClient:
+    monkeypatch.setattr(routes, 'admin_token', 'secret')
+    return TestClient(app)
+
+
+def test_admin_routes_require_admin_token(client, monkeypatch):
+    administrative = (('PUT', '/api/db'), ('GET', '/api/tenants'), ('PUT', '/api/tenants/tenant'),
+               ('DELETE', '/api/tenants/tenant'), ('DELETE', '/api/cache/keywords'),
+               ('DELETE', '/api/cache/templates'))
+    for method, url in administrative:
+        assert client.request(method, url, params={'uri': OTHER_URI}).status_code == 403
+        assert client.request(method, url, params={'uri': OTHER_URI},
+                              headers={'X-Admin-Token': 'wrong'}).status_code == 403
+
+    headers = {'X-Admin-Token': 'secret'}
+    assert 'tenant' not in client.get('/api/tenants', headers=headers).json()
+    assert client.put('/api/tenants/tenant', params={'uri': OTHER_URI}, headers=headers).status_code == 200
+    assert 'tenant' in client.get('/api/tenants', headers=headers).json()
+    assert client.delete('/api/tenants/tenant', headers=headers).status_code == 200
+    assert client.delete('/api/tenants/tenant', headers=headers).status_code == 404
+    assert client.delete('/api/cache/keywords', headers=headers).status_code == 200
+    assert client.delete('/api/cache/templates', headers=headers).status_code == 200
+
+    # administrative operations are disabled unless the token is configured
+    monkeypatch.setattr(routes, 'admin_token', None)
+    for method, url in administrative:
+        assert client.request(method, url, params={'uri': OTHER_URI}, headers=headers).status_code == 403